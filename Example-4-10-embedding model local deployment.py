@@ -5,18 +5,24 @@
 
 from sentence_transformers import SentenceTransformer
 import numpy as np
-from numpy import dot
 from numpy.linalg import norm
 
 def cos_sim(a, b):
-    '''余弦距离 -- 越大越相似'''
-    return dot(a, b)/(norm(a)*norm(b))
+    '''余弦距离 -- 越大越相似（a、b 可以是单个向量，也可以是每行一个向量的矩阵）'''
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    # 只做一次归一化，一次矩阵乘法算出所有两两相似度
+    return (a/norm(a, axis=-1, keepdims=True)) @ (b/norm(b, axis=-1, keepdims=True)).T
 
 
 def l2(a, b):
-    '''欧式距离 -- 越小越相似'''
-    x = np.asarray(a)-np.asarray(b)
-    return norm(x)
+    '''欧式距离 -- 越小越相似（a、b 可以是单个向量，也可以是每行一个向量的矩阵）'''
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    # |a-b|^2 = |a|^2 + |b|^2 - 2a.b
+    a2, b2 = np.atleast_2d(a), np.atleast_2d(b)
+    d2 = (a2*a2).sum(axis=1)[:, None] + (b2*b2).sum(axis=1) - 2*(a2 @ b2.T)
+    return np.sqrt(np.maximum(d2, 0)).reshape(a.shape[:-1] + b.shape[:-1])
 
 model = SentenceTransformer('BAAI/bge-large-zh-v1.5') #中文
 # model_name = 'moka-ai/m3e-base'  # 中英双语，但效果一般
@@ -35,17 +41,15 @@ documents = [
 
 query_vec = model.encode(query, normalize_embeddings=True)
 
-doc_vecs = [
-    model.encode(doc, normalize_embeddings=True)
-    for doc in documents
-]
+# 一次编码所有文档，得到每行一个向量的矩阵
+doc_vecs = model.encode(documents, normalize_embeddings=True)
 
 print("Cosine distance:")  # 越大越相似
 print(cos_sim(query_vec, query_vec))
-for vec in doc_vecs:
-    print(cos_sim(query_vec, vec))
+for score in cos_sim(query_vec, doc_vecs):
+    print(score)
 
 print("Euclidean distance:")  # 越小越相似
 print(l2(query_vec, query_vec))
-for vec in doc_vecs:
-    print(l2(query_vec, vec))
\ No newline at end of file
+for distance in l2(query_vec, doc_vecs):
+    print(distance)
\ No newline at end of file
@@ -20,38 +20,13 @@ top_nc=5 # The number of results returned for each query
 n_queries=4 # The number of multiple queries generated based on the original query
 
 
-from pdfminer.high_level import extract_pages
-from pdfminer.layout import LTTextContainer
-
-def extract_text_from_pdf(filename, page_numbers=None, min_line_length=10):
-    '''Extract text from a PDF file (by specified page number)'''
-    paragraphs = []
-    buffer = ''
-    full_text = ''
-    # Extract all text
-    for i, page_layout in enumerate(extract_pages(filename)):
-        # If a page range is specified, skip pages outside the range
-        if page_numbers is not None and i not in page_numbers:
-            continue
-        for element in page_layout:
-            if isinstance(element, LTTextContainer):
-                full_text += element.get_text() + '\n'
-    # Separate by blank lines and reorganize the text into paragraphs
-    lines = full_text.split('\n')
-    for text in lines:
-        if len(text) >= min_line_length:
-            buffer += (' '+text) if not text.endswith('-') else text.strip('-')
-        elif buffer:
-            paragraphs.append(buffer)
-            buffer = ''
-    if buffer:
-        paragraphs.append(buffer)
-    return paragraphs
-
-import chromadb
+from pdf_utils import cached_extract_text_from_pdf
+# The parsed text is cached in .rag_cache by file content, an unchanged file is not parsed again
+from cache_utils import make_key  # Content-hash ids of the chroma documents
 
 class MyVectorDBConnector: # Memory mode
     def __init__(self, collection_name, embedding_fn):
+        import chromadb  # Only needed when the chroma server is used
         chroma_client = chromadb.HttpClient(host='localhost', port=8000)
            
         # No need to clear previous content
@@ -62,12 +37,20 @@ class MyVectorDBConnector: # Memory mode
         self.embedding_fn = embedding_fn
 
     def add_documents(self, documents, metadatainputs=None):
-        '''Add documents and vectors to the collection'''
+        '''Add documents and vectors to the collection, documents already stored are skipped'''
+        metadata = {"source": metadatainputs}
+        # Ids are hashes of document and metadata, as in LocalVectorDBConnector:
+        # adding another PDF, or the same one again, does not overwrite earlier chunks
+        new = {make_key(doc, metadata): doc for doc in documents}
+        for id_ in (self.collection.get(ids=list(new), include=[])["ids"] if new else []):
+            del new[id_]
+        if not new:
+            return
         self.collection.add(
-            embeddings=self.embedding_fn(documents),  # Vector of each document
-            documents=documents,  # Original text of the document
-            metadatas=[{"source": metadatainputs} for _ in documents],  # Metadata of each document
-            ids=[f"id{i}" for i in range(len(documents))]  # id of each document
+            embeddings=self.embedding_fn(list(new.values())),  # Vector of each document
+            documents=list(new.values()),  # Original text of the document
+            metadatas=[metadata for _ in new],  # Metadata of each document
+            ids=list(new)  # id of each document
         )
 
     def search(self, query, top_n):
@@ -85,8 +68,10 @@ _ = load_dotenv(find_dotenv())  # Read the local .env file, which defines the OP
 
 client = OpenAI()
 
-# Function to generate queries using OpenAI's ChatGPT
-def generate_queries_chatgpt(original_query, model="gpt-3.5-turbo", n_queries=4):
+from hybrid_search_utils import iter_lines
+
+# Function to generate queries using OpenAI's ChatGPT, streamed: every query is yielded as soon as its line is complete
+def generate_queries_chatgpt_stream(original_query, model="gpt-3.5-turbo", n_queries=4):
 
     response = client.chat.completions.create(
         model=model,
@@ -94,10 +79,12 @@ def generate_queries_chatgpt(original_query, model="gpt-3.5-turbo", n_queries=4)
             {"role": "system", "content": "You are a helpful assistant that generates multiple search queries based on a single input query."},
             {"role": "user", "content": f"Generate multiple search queries related to: {original_query}"},
             {"role": "user", "content": f"OUTPUT ({n_queries} queries):"}
-        ]
+        ],
+        stream=True
     )
-    generated_queries = response.choices[0].message.content.strip().split("\n")
-    return generated_queries
+    return iter_lines(chunk.choices[0].delta.content or "" for chunk in response if chunk.choices)
+
+
 def get_embeddings(texts, model="text-embedding-3-small",dimensions=None):# text-embedding-3-large
     '''Encapsulate the Embedding model interface of OpenAI'''
     if model == "text-embedding-ada-002":
@@ -118,25 +105,20 @@ def get_completion(prompt, model="gpt-3.5-turbo"):
     )
     return response.choices[0].message.content
 
-def build_prompt(prompt_template, **kwargs):
-    '''Assign values to the Prompt template'''
-    # Initialize an empty dictionary to store the processed input
-    inputs = {}
-
-    # Traverse the input keyword parameters
-    for k, v in kwargs.items():
-        # If the value of the parameter is a list of strings
-        if isinstance(v, list) and all(isinstance(elem, str) for elem in v):
-            # Join all the strings in the list with two newline characters
-            val = '\n\n'.join(v)
-        else:
-            # Otherwise, use the value of the parameter directly
-            val = v
-        # Add the processed value to the dictionary
-        inputs[k] = val
-
-    # Use the processed input parameters to format the template, and return the result
-    return prompt_template.format(**inputs)
+def get_completion_stream(prompt, model="gpt-3.5-turbo"):
+    '''Encapsulate the openai interface, streamed: the answer is returned piece by piece as it is generated'''
+    messages = [{"role": "user", "content": prompt}]
+    response = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0,  # The randomness of the model output, 0 means the least randomness
+        stream=True  # See Example-1-4
+    )
+    return iter_completion(response)
+
+# Assign values to the Prompt template: sentences repeated by overlapping chunks are dropped and the chunks are packed
+# in rank order into a token budget (default 2000, budget=None keeps all of them), see prompt_utils.py
+from prompt_utils import build_prompt
 
 # Prompt template
 prompt_template = """
@@ -154,36 +136,19 @@ prompt_template = """
 请用中文回答用户问题。
 """
 
-from nltk.tokenize import sent_tokenize  # Import the sent_tokenize function from the NLTK library for splitting text into sentences
-
-def split_text(paragraphs, chunk_size=300, overlap_size=100):  # Define a function that takes a list of paragraphs and two optional parameters: chunk_size and overlap_size
-    '''Split the text by the specified chunk_size and overlap_size'''  # The function's docstring, explaining what the function does
-    sentences = [s.strip() for p in paragraphs for s in sent_tokenize(p)]  # Split each paragraph into sentences, and remove leading and trailing whitespace from each sentence
-    chunks = []  # Initialize an empty list to store the generated chunks
-    i = 0  # Initialize a variable i for indexing in the list of sentences
-    while i < len(sentences):  # Execute the loop while i is less than the length of the list of sentences
-        chunk = sentences[i]  # Take the i-th sentence from the list of sentences as the current chunk
-        overlap = ''  # Initialize an empty string to store the overlap with the previous chunk
-        prev = i - 1  # Initialize a variable prev, representing the index of the sentence before the current one
-        # Calculate the overlap forward
-        while prev >= 0 and len(sentences[prev])+len(overlap) <= overlap_size:  # Execute the loop while prev is not less than 0 and the length of the previous sentence plus the length of the overlap does not exceed overlap_size
-            overlap = sentences[prev] + ' ' + overlap  # Add the previous sentence to the front of the overlap
-            prev -= 1  # Decrement prev by 1, moving to the next sentence forward
-        chunk = overlap+chunk  # Add the overlap to the front of the current chunk
-        next = i + 1  # Initialize a variable next, representing the index of the sentence after the current one
-        # Calculate the current chunk backward
-        while next < len(sentences) and len(sentences[next])+len(chunk) <= chunk_size:  # Execute the loop while next is less than the length of the list of sentences and the length of the next sentence plus the length of the current chunk does not exceed chunk_size
-            chunk = chunk + ' ' + sentences[next]  # Add the next sentence to the end of the current chunk
-            next += 1  # Increment next by 1, moving to the next sentence backward
-        chunks.append(chunk)  # Add the current chunk to the list of chunks
-        i = next  # Set i to next, i.e., move to the next sentence to be processed
-    return chunks  # Return the generated list of chunks
+# Split the text into overlapping chunks, see text_split_utils.py (chunk size can also be measured in tokens with tiktoken_length)
+from text_split_utils import split_text
+
+# chat_stream of the bots returns the sources first, then the answer as it is generated, and the time to first token
+import time
+from stream_utils import iter_completion, print_stream, stream_answer
 
 class RAG_Bot:
-    def __init__(self, vector_db, llm_api, n_results=2):
+    def __init__(self, vector_db, llm_api, n_results=2, llm_stream_api=None):
         self.vector_db = vector_db
         self.llm_api = llm_api
         self.n_results = n_results
+        self.llm_stream_api = llm_stream_api  # Streamed llm_api, used by chat_stream
 
     def chat(self, user_query):
         # 1. Search
@@ -198,12 +163,29 @@ class RAG_Bot:
         # 3. Call LLM
         response = self.llm_api(prompt)
         return response
+
+    def chat_stream(self, user_query):
+        '''Like chat, but returns events: the sources first, then the answer piece by piece (see stream_utils)'''
+        start = time.monotonic()
+        # 1. Search
+        search_results = self.vector_db.search(user_query, self.n_results)
+        sources = [{"id": doc_id, "distance": distance, "text": doc}
+                   for doc_id, doc, distance in zip(search_results['ids'][0], search_results['documents'][0],
+                                                    search_results['distances'][0])]
+
+        # 2. Build Prompt
+        prompt = build_prompt(
+            prompt_template, info=search_results['documents'][0], query=user_query)
+
+        # 3. Call LLM, streamed
+        return stream_answer(sources, self.llm_stream_api(prompt), start)
     
 class RAG_BotC:
-    def __init__(self, vector_db, llm_api, n_results=5):
+    def __init__(self, vector_db, llm_api, n_results=5, llm_stream_api=None):
         self.vector_db = vector_db
         self.llm_api = llm_api
         self.n_results = n_results
+        self.llm_stream_api = llm_stream_api  # Streamed llm_api, used by chat_stream
 
     def chat(self, user_query, search_results):
         # 1. Build Prompt
@@ -216,76 +198,80 @@ class RAG_BotC:
         response = self.llm_api(prompt)
         return response
 
+    def chat_stream(self, user_query, search_results, scores=None):
+        '''Like chat, but returns events: the sources first, then the answer piece by piece (see stream_utils)'''
+        start = time.monotonic()
+        sources = [{"score": score, "text": doc}
+                   for doc, score in zip(search_results, scores or [None] * len(search_results))]
+        # 1. Build Prompt
+        prompt = build_prompt(
+            prompt_template, info=search_results, query=user_query)
+
+        # 2. Call LLM, streamed
+        return stream_answer(sources, self.llm_stream_api(prompt), start)
+
+# Cache embeddings on disk (.rag_cache): texts embedded before with the same model are not sent to the API again
+# Cache misses are split into batches within the per-request input and token limits and sent concurrently
+from embedding_utils import BatchedEmbeddings, CachedEmbeddings
+embedding_fn = CachedEmbeddings(BatchedEmbeddings(get_embeddings, max_concurrency=4), provider="openai", model="text-embedding-3-small")
+
 # Create or associate a vector database object
-vector_db = MyVectorDBConnector("demo_split", get_embeddings)
+# LocalVectorDBConnector keeps the vectors in a local memory-mapped file (.rag_cache/vector_db), no chroma server is needed
+# To use the chroma server instead: vector_db = MyVectorDBConnector("demo_split", embedding_fn)
+from vector_db_utils import LocalVectorDBConnector
+vector_db = LocalVectorDBConnector("demo_split", embedding_fn, space="cosine")
 
 if isFirstRun:
     # Extract text from PDF
-    paragraphs = extract_text_from_pdf("llama2.pdf", page_numbers=[
+    paragraphs = cached_extract_text_from_pdf("llama2.pdf", page_numbers=[
                                       2, 3], min_line_length=10)
-    chunks = split_text(paragraphs, 300, 100)
-    # Add documents to the vector database
-    vector_db.add_documents(chunks, metadatainputs="llama2.pdf")
+    chunks = split_text(paragraphs, chunk_size, overlap_size)
+    # Add documents to the vector database: ids are content hashes, so only new or changed chunks are embedded
+    # and chunks that are no longer in the file are deleted
+    vector_db.sync(chunks, metadatainputs="llama2.pdf")
 
 if isResultSort==False:
     # Create a RAG bot
     bot = RAG_Bot(
         vector_db,
         llm_api=get_completion,
-        n_results=top_n
+        n_results=top_n,
+        llm_stream_api=get_completion_stream
     )
-    search_results = vector_db.search(user_query, top_n)
-    for doc in search_results['documents'][0]:
-        print(doc+"\n")
-    print("====Reply====")
-    print(bot.chat(user_query)) 
+    # The sources are printed first, then the answer as it is generated
+    print_stream(bot.chat_stream(user_query))
 else:
-    from sentence_transformers import CrossEncoder
-    generated_queries = generate_queries_chatgpt(user_query, n_queries=n_queries)
-    generated_queries.insert(0, 'original. "' + user_query + '"')
-    print("====原始查询及生成的查询====\n")
-    print(generated_queries)
-    
-    search_results = []
-    # Vector search
-    for query in generated_queries:
-        print("====查询====\n")
-        print(query)
-        tresult=vector_db.search(query, top_nc)
-        if tresult is None:
-            continue
-        print(tresult["ids"][0])
-        vector_search_results = {
+    import itertools
+    from hybrid_search_utils import MultiQueryRetriever
+    # 基于 RRF 的融合排序
+    from rank_fusion_utils import rrf
+
+    # Vector search of one query, as a ranking {id: {"text", "rank"}} for rrf
+    def vector_search(query, top_n):
+        results = vector_db.search(query, top_n)
+        return {
             "doc_"+doc_id: {
                 "text" : doc,
                 "rank" : i
-            }          
+            }
             for i, (doc, doc_id) in enumerate(
-                zip(tresult["documents"][0],tresult["ids"][0])
+                zip(results["documents"][0], results["ids"][0])
             )
         }
-        print(vector_search_results)
-        search_results.append(vector_search_results)
-    #print("====向量检索结果====\n")
-    #print(search_results)
 
-    # 基于 RRF 的融合排序
-    def rrf(ranks, k=1):
-        ret = {}
-        # 遍历每次的排序结果
-        for rank in ranks: 
-            # 遍历排序中每个元素
-            for id, val in rank.items():
-                if id not in ret:
-                    ret[id] = { "score": 0, "text": val["text"] }
-                # 计算 RRF 得分
-                ret[id]["score"] += 1.0/(k+val["rank"])
-        # 按 RRF 得分排序，并返回
-        return dict(sorted(ret.items(), key=lambda item: item[1]["score"], reverse=True))
+    # The original query is searched at once, every generated query as soon as its line is streamed,
+    # while the model is still writing the next ones; the rankings are fused as the searches complete
+    queries = itertools.chain(['original. "' + user_query + '"'],
+                              generate_queries_chatgpt_stream(user_query, n_queries=n_queries))
+    reranked = {}
+    with MultiQueryRetriever(vector_search, fuse_fn=lambda ranks: rrf(ranks, k=1)) as retriever:
+        for query, vector_search_results, reranked in retriever.iter_retrieve(queries, top_nc):
+            print("====查询====\n")
+            print(query)
+            print(vector_search_results)
+        print(retriever.last_stats)  # 总耗时、查询生成耗时与出错的查询
 
     import json
-    # 融合两次检索的排序结果
-    reranked = rrf(search_results)
     print("====融合排序结果====\n")
     print(json.dumps(reranked,indent=4,ensure_ascii=False))
     
@@ -293,8 +279,9 @@ else:
     bot = RAG_BotC(
         vector_db,
         llm_api=get_completion,
-        n_results=top_nc
+        n_results=top_nc,
+        llm_stream_api=get_completion_stream
     )
-    print("====回复====")
-    reranked_list = list(reranked.items())
-    print(bot.chat(user_query,[text for score, text in reranked_list[:top_n]]))
\ No newline at end of file
+    reranked_list = list(reranked.values())
+    print_stream(bot.chat_stream(user_query, [val["text"] for val in reranked_list[:top_n]],
+                                 [val["score"] for val in reranked_list[:top_n]]))
\ No newline at end of file
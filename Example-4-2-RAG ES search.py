@@ -6,8 +6,7 @@
 # Install NLTK (text processing method library)
 # !pip install nltk
 
-from pdfminer.high_level import extract_pages
-from pdfminer.layout import LTTextContainer
+from pdf_utils import extract_text_from_pdf
 
 from elasticsearch7 import Elasticsearch, helpers
 from nltk.stem import PorterStemmer
@@ -22,31 +21,6 @@ warnings.simplefilter("ignore")  # Shield some warnings of ES
 # nltk.download('punkt')  # English word segmentation, root, sentence segmentation, etc.
 # nltk.download('stopwords')  # English stop word library
 
-def extract_text_from_pdf(filename, page_numbers=None, min_line_length=1):
-    '''Extract text from a PDF file (by specified page number)'''
-    paragraphs = []
-    buffer = ''
-    full_text = ''
-    # Extract all text
-    for i, page_layout in enumerate(extract_pages(filename)):
-        # If a page range is specified, skip pages outside the range
-        if page_numbers is not None and i not in page_numbers:
-            continue
-        for element in page_layout:
-            if isinstance(element, LTTextContainer):
-                full_text += element.get_text() + '\n'
-    # Separate the text into paragraphs by blank lines
-    lines = full_text.split('\n')
-    for text in lines:
-        if len(text) >= min_line_length:
-            buffer += (' '+text) if not text.endswith('-') else text.strip('-')
-        elif buffer:
-            paragraphs.append(buffer)
-            buffer = ''
-    if buffer:
-        paragraphs.append(buffer)
-    return paragraphs
-
 # Here to_keywords is implemented for English, for Chinese implementation please refer to chinese_utils.py
 def to_keywords(input_string):
     '''(English) Text only retains keywords'''
@@ -193,6 +167,12 @@ user_query="Does llama 2 have a chat version?"
 #user_query = "Does llama 2 have a conversational variant?"
 
 
+# Without an Elasticsearch cluster the same BM25 retrieval can run in-process (bm25_utils):
+# from bm25_utils import LocalBM25Connector
+# bm25_connector = LocalBM25Connector(to_keywords)
+# bm25_connector.add_documents(paragraphs)
+# search = lambda query_string, top_n=3: [hit["text"] for hit in bm25_connector.search(query_string, top_n).values()]
+
 # 1. Retrieval
 search_results = search(user_query, 2)
 
@@ -8,7 +8,6 @@ In layman's terms: the larger, the more accurate; the smaller, the faster.
 """
 
 import numpy as np
-from numpy import dot
 from numpy.linalg import norm
 
 # LLM interface encapsulation
@@ -19,23 +18,25 @@ _ = load_dotenv(find_dotenv())  # Read the local .env file, which defines OPENAI
 
 client = OpenAI()
 
-# Cosine similarity
+# Cosine similarity, a and b can be single vectors or matrices with one vector per row
 def cos_sim(a, b):
-    return dot(a, b)/(norm(a)*norm(b))
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    # Normalize once, then one matrix multiplication scores every pair
+    return (a/norm(a, axis=-1, keepdims=True)) @ (b/norm(b, axis=-1, keepdims=True)).T
 
+# Euclidean distance, a and b can be single vectors or matrices with one vector per row
 def l2(a, b):
-    x = np.asarray(a)-np.asarray(b)
-    return norm(x)
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    # |a-b|^2 = |a|^2 + |b|^2 - 2a.b
+    a2, b2 = np.atleast_2d(a), np.atleast_2d(b)
+    d2 = (a2*a2).sum(axis=1)[:, None] + (b2*b2).sum(axis=1) - 2*(a2 @ b2.T)
+    return np.sqrt(np.maximum(d2, 0)).reshape(a.shape[:-1] + b.shape[:-1])
 
-def get_embeddings(texts, model="text-embedding-3-small",dimensions=None):# text-embedding-3-large
-    '''Encapsulate OpenAI's Embedding model interface'''
-    if model == "text-embedding-ada-002":
-        dimensions = None
-    if dimensions:
-        data = client.embeddings.create(input=texts, model=model, dimensions=dimensions).data
-    else:
-        data = client.embeddings.create(input=texts, model=model).data
-    return [x.embedding for x in data]
+# Returns one numpy matrix (n, dimensions) decoded directly from the API response
+# dtype can also be "float16", or "int8" to store vectors in a quarter of the memory
+from embedding_utils import get_embeddings_array as get_embeddings
 
 # And it supports cross-language
 # query = "global conflicts"
@@ -51,19 +52,19 @@ documents = [
 model = "text-embedding-3-large"
 dimensions = 128
 query = "国际争端"
-query_vec = get_embeddings([query],model=model,dimensions=dimensions)[0]
-doc_vecs = get_embeddings(documents,model=model,dimensions=dimensions)
+query_vec = get_embeddings([query],model=model,dimensions=dimensions,client=client)[0]
+doc_vecs = get_embeddings(documents,model=model,dimensions=dimensions,client=client)
 
 print("Dim: {}".format(len(query_vec)))
 
 print("Cosine distance between Query and itself: {:.2f}".format(cos_sim(query_vec, query_vec)))
 print("Cosine distance between Query and Documents:")
-for vec in doc_vecs:
-    print(cos_sim(query_vec, vec))
+for score in cos_sim(query_vec, doc_vecs):
+    print(score)
 
 print()
 
 print("Euclidean distance between Query and itself: {:.2f}".format(l2(query_vec, query_vec)))
 print("Euclidean distance between Query and Documents:")
-for vec in doc_vecs:
-    print(l2(query_vec, vec))
\ No newline at end of file
+for distance in l2(query_vec, doc_vecs):
+    print(distance)
\ No newline at end of file
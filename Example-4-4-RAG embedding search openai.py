@@ -33,33 +33,7 @@ Test the ability of the large model: given the premise of the question and the t
 
 # !pip install chromadb
 
-from pdfminer.high_level import extract_pages
-from pdfminer.layout import LTTextContainer
-
-def extract_text_from_pdf(filename, page_numbers=None, min_line_length=1):
-    '''Extract text from PDF file (by specified page number)'''
-    paragraphs = []
-    buffer = ''
-    full_text = ''
-    # Extract all text
-    for i, page_layout in enumerate(extract_pages(filename)):
-        # If a page range is specified, skip pages outside the range
-        if page_numbers is not None and i not in page_numbers:
-            continue
-        for element in page_layout:
-            if isinstance(element, LTTextContainer):
-                full_text += element.get_text() + '\n'
-    # Separate by blank lines and reorganize the text into paragraphs
-    lines = full_text.split('\n')
-    for text in lines:
-        if len(text) >= min_line_length:
-            buffer += (' '+text) if not text.endswith('-') else text.strip('-')
-        elif buffer:
-            paragraphs.append(buffer)
-            buffer = ''
-    if buffer:
-        paragraphs.append(buffer)
-    return paragraphs
+from pdf_utils import extract_text_from_pdf
 
 import chromadb
 from chromadb.config import Settings
@@ -176,8 +150,13 @@ class RAG_Bot:
 paragraphs = extract_text_from_pdf("llama2.pdf", page_numbers=[
                                    2, 3], min_line_length=10)
 
+# Cache embeddings on disk (.rag_cache): texts embedded before with the same model are not sent to the API again
+# Cache misses are split into batches within the per-request input and token limits and sent concurrently
+from embedding_utils import BatchedEmbeddings, CachedEmbeddings
+embedding_fn = CachedEmbeddings(BatchedEmbeddings(get_embeddings, max_concurrency=4), provider="openai", model="text-embedding-3-small")
+
 # Create a vector database object
-vector_db = MyVectorDBConnector("demo", get_embeddings)
+vector_db = MyVectorDBConnector("demo", embedding_fn)
 # Add documents to the vector database
 vector_db.add_documents(paragraphs)
 
@@ -1,33 +1,7 @@
 # RAG example based on vector search
 # Here we use Wenxin Qianfan's embedding and dialogue interface
 
-from pdfminer.high_level import extract_pages
-from pdfminer.layout import LTTextContainer
-
-def extract_text_from_pdf(filename, page_numbers=None, min_line_length=1):
-    '''Extract text from a PDF file (by specified page number)'''
-    paragraphs = []
-    buffer = ''
-    full_text = ''
-    # Extract all text
-    for i, page_layout in enumerate(extract_pages(filename)):
-        # If a page range is specified, skip pages outside the range
-        if page_numbers is not None and i not in page_numbers:
-            continue
-        for element in page_layout:
-            if isinstance(element, LTTextContainer):
-                full_text += element.get_text() + '\n'
-    # Reorganize the text into paragraphs separated by blank lines
-    lines = full_text.split('\n')
-    for text in lines:
-        if len(text) >= min_line_length:
-            buffer += (' '+text) if not text.endswith('-') else text.strip('-')
-        elif buffer:
-            paragraphs.append(buffer)
-            buffer = ''
-    if buffer:
-        paragraphs.append(buffer)
-    return paragraphs
+from pdf_utils import extract_text_from_pdf
 
 import chromadb
 from chromadb.config import Settings
@@ -7,39 +7,13 @@
 user_query = "how many parameters does llama 2 have?"
 isFirstRun = False #是否第一次运行，如果是，则需要建立向量数据库
 
-from pdfminer.high_level import extract_pages
-from pdfminer.layout import LTTextContainer
-
-def extract_text_from_pdf(filename, page_numbers=None, min_line_length=1):
-    '''从 PDF 文件中（按指定页码）提取文字'''
-    paragraphs = []
-    buffer = ''
-    full_text = ''
-    # 提取全部文本
-    for i, page_layout in enumerate(extract_pages(filename)):
-        # 如果指定了页码范围，跳过范围外的页
-        if page_numbers is not None and i not in page_numbers:
-            continue
-        for element in page_layout:
-            if isinstance(element, LTTextContainer):
-                full_text += element.get_text() + '\n'
-    # 按空行分隔，将文本重新组织成段落
-    lines = full_text.split('\n')
-    for text in lines:
-        if len(text) >= min_line_length:
-            buffer += (' '+text) if not text.endswith('-') else text.strip('-')
-        elif buffer:
-            paragraphs.append(buffer)
-            buffer = ''
-    if buffer:
-        paragraphs.append(buffer)
-    return paragraphs
-
-import chromadb
-from chromadb.config import Settings
+from pdf_utils import cached_extract_text_from_pdf
+# 解析结果按文件内容缓存在 .rag_cache 中，文件不变时不会重新解析
+from cache_utils import make_key  # chroma 文档的内容哈希 id
 
 class MyVectorDBConnector: #内存模式
     def __init__(self, collection_name, embedding_fn):
+        import chromadb  # 只有使用 chroma 服务时才需要安装 chromadb
         chroma_client = chromadb.HttpClient(host='localhost', port=8000)
 
         # 不用清空以前内容
@@ -50,12 +24,19 @@ class MyVectorDBConnector: #内存模式
         self.embedding_fn = embedding_fn
 
     def add_documents(self, documents, metadatainputs=None):
-        '''向 collection 中添加文档与向量'''
+        '''向 collection 中添加文档与向量，已经存入的文档会跳过'''
+        metadata = {"source": metadatainputs}
+        # id 是文档与元数据的哈希，与 LocalVectorDBConnector 一致：再添加一个 PDF 或重复添加时不会覆盖之前的文档
+        new = {make_key(doc, metadata): doc for doc in documents}
+        for id_ in (self.collection.get(ids=list(new), include=[])["ids"] if new else []):
+            del new[id_]
+        if not new:
+            return
         self.collection.add(
-            embeddings=self.embedding_fn(documents),  # 每个文档的向量
-            documents=documents,  # 文档的原文
-            metadatas=[{"source": metadatainputs} for _ in documents],  # 每个文档的元数据
-            ids=[f"id{i}" for i in range(len(documents))]  # 每个文档的 id
+            embeddings=self.embedding_fn(list(new.values())),  # 每个文档的向量
+            documents=list(new.values()),  # 文档的原文
+            metadatas=[metadata for _ in new],  # 每个文档的元数据
+            ids=list(new)  # 每个文档的 id
         )
 
     def search(self, query, top_n):
@@ -93,25 +74,8 @@ def get_completion(prompt, model="gpt-3.5-turbo"):
     )
     return response.choices[0].message.content
 
-def build_prompt(prompt_template, **kwargs):
-    '''Assign values to the Prompt template'''
-    # Initialize an empty dictionary to store the processed input
-    inputs = {}
-
-    # Traverse the input keyword parameters
-    for k, v in kwargs.items():
-        # If the value of the parameter is a list of strings
-        if isinstance(v, list) and all(isinstance(elem, str) for elem in v):
-            # Join all the strings in the list with two newline characters
-            val = '\n\n'.join(v)
-        else:
-            # Otherwise, use the value of the parameter directly
-            val = v
-        # Add the processed value to the dictionary
-        inputs[k] = val
-
-    # Use the processed input parameters to format the template, and return the result
-    return prompt_template.format(**inputs)
+# 组装 Prompt：去掉检索结果之间重叠的句子，按排序把检索结果装进 token 预算（默认 2000，build_prompt(..., budget=None) 保留全部）
+from prompt_utils import build_prompt
 
 # Prompt template
 prompt_template = """
@@ -130,12 +94,19 @@ prompt_template = """
 """
 
 class RAG_Bot:
-    def __init__(self, vector_db, llm_api, n_results=2):
+    def __init__(self, vector_db, llm_api, n_results=2, cache=None):
         self.vector_db = vector_db
         self.llm_api = llm_api
         self.n_results = n_results
+        self.cache = cache  # 语义缓存（SemanticCache），为 None 时每次都检索并调用 LLM
 
     def chat(self, user_query):
+        # 0. 相似的问题之前回答过（且向量库没有变化）时直接返回缓存的回答
+        if self.cache is not None:
+            return self.cache.get_or_compute(user_query, self._chat)
+        return self._chat(user_query)
+
+    def _chat(self, user_query):
         # 1. 检索
         search_results = self.vector_db.search(user_query, self.n_results)
 
@@ -147,21 +118,38 @@ class RAG_Bot:
         response = self.llm_api(prompt)
         return response
 
+# 向量缓存在本地（.rag_cache），用同一模型算过的文本不会再次调用接口
+# 未缓存的文本自动分批、并发请求，不会超过接口单次请求的条数和 token 上限
+from embedding_utils import BatchedEmbeddings, CachedEmbeddings
+embedding_fn = CachedEmbeddings(BatchedEmbeddings(get_embeddings, max_concurrency=4), provider="openai", model="text-embedding-3-small")
+
 # 创建或关联一个向量数据库对象
-vector_db = MyVectorDBConnector("demo", get_embeddings)
+# LocalVectorDBConnector 把向量存在本地内存映射文件里（.rag_cache/vector_db），不需要启动 chroma 服务
+# 使用 chroma 服务时改为 vector_db = MyVectorDBConnector("demo", embedding_fn)
+from vector_db_utils import LocalVectorDBConnector
+vector_db = LocalVectorDBConnector("demo", embedding_fn)
 
 if isFirstRun:
     # 从PDF中提取文本
-    paragraphs = extract_text_from_pdf("llama2.pdf", page_numbers=[
+    paragraphs = cached_extract_text_from_pdf("llama2.pdf", page_numbers=[
                                       2, 3], min_line_length=10)
-    # 向向量数据库中添加文档
-    vector_db.add_documents(paragraphs, metadatainputs="llama 2")
+    # 向向量数据库中添加文档：id 是内容哈希，只有新增或改动的段落会调用 embedding，文件中已删除的段落同时删除
+    vector_db.sync(paragraphs, metadatainputs="llama 2")
+
+# 语义缓存：与之前的问题余弦相似度 ≥ 0.95、向量库版本相同且未超过 24 小时的，直接返回缓存的回答
+from semantic_cache_utils import SemanticCache
+answer_cache = SemanticCache(embedding_fn, threshold=0.95, ttl=24 * 3600, version_fn=lambda: vector_db.version)
 
 # 创建一个RAG机器人
 bot = RAG_Bot(
     vector_db,
-    llm_api=get_completion
+    llm_api=get_completion,
+    cache=answer_cache
 )
 
 response = bot.chat(user_query)
-print(response)
\ No newline at end of file
+print(response)
+
+# 再问一次同样的问题：命中缓存，不再检索和调用 LLM
+response = bot.chat(user_query)
+print(answer_cache.stats())  # 命中次数、未命中次数、命中率
\ No newline at end of file
@@ -23,38 +23,13 @@ top_n=2 # Number of retrieval results
 top_nc=5 # Number of retrieval results used for sorting
 
 
-from pdfminer.high_level import extract_pages
-from pdfminer.layout import LTTextContainer
-
-def extract_text_from_pdf(filename, page_numbers=None, min_line_length=10):
-    '''Extract text from a PDF file (by specified page number)'''
-    paragraphs = []
-    buffer = ''
-    full_text = ''
-    # Extract all text
-    for i, page_layout in enumerate(extract_pages(filename)):
-        # If a page range is specified, skip pages outside the range
-        if page_numbers is not None and i not in page_numbers:
-            continue
-        for element in page_layout:
-            if isinstance(element, LTTextContainer):
-                full_text += element.get_text() + '\n'
-    # Separate by blank lines and reorganize the text into paragraphs
-    lines = full_text.split('\n')
-    for text in lines:
-        if len(text) >= min_line_length:
-            buffer += (' '+text) if not text.endswith('-') else text.strip('-')
-        elif buffer:
-            paragraphs.append(buffer)
-            buffer = ''
-    if buffer:
-        paragraphs.append(buffer)
-    return paragraphs
-
-import chromadb
+from pdf_utils import cached_extract_text_from_pdf
+# The parsed text is cached in .rag_cache by file content, an unchanged file is not parsed again
+from cache_utils import make_key  # Content-hash ids of the chroma documents
 
 class MyVectorDBConnector: # Memory mode
     def __init__(self, collection_name, embedding_fn):
+        import chromadb  # Only needed when the chroma server is used
         chroma_client = chromadb.HttpClient(host='localhost', port=8000)
            
         # No need to clear previous content
@@ -65,12 +40,20 @@ class MyVectorDBConnector: # Memory mode
         self.embedding_fn = embedding_fn
 
     def add_documents(self, documents, metadatainputs=None):
-        '''Add documents and vectors to the collection'''
+        '''Add documents and vectors to the collection, documents already stored are skipped'''
+        metadata = {"source": metadatainputs}
+        # Ids are hashes of document and metadata, as in LocalVectorDBConnector:
+        # adding another PDF, or the same one again, does not overwrite earlier chunks
+        new = {make_key(doc, metadata): doc for doc in documents}
+        for id_ in (self.collection.get(ids=list(new), include=[])["ids"] if new else []):
+            del new[id_]
+        if not new:
+            return
         self.collection.add(
-            embeddings=self.embedding_fn(documents),  # Vector of each document
-            documents=documents,  # Original text of the document
-            metadatas=[{"source": metadatainputs} for _ in documents],  # Metadata of each document
-            ids=[f"id{i}" for i in range(len(documents))]  # id of each document
+            embeddings=self.embedding_fn(list(new.values())),  # Vector of each document
+            documents=list(new.values()),  # Original text of the document
+            metadatas=[metadata for _ in new],  # Metadata of each document
+            ids=list(new)  # id of each document
         )
 
     def search(self, query, top_n):
@@ -108,25 +91,20 @@ def get_completion(prompt, model="gpt-3.5-turbo"):
     )
     return response.choices[0].message.content
 
-def build_prompt(prompt_template, **kwargs):
-    '''Assign values to the Prompt template'''
-    # Initialize an empty dictionary to store the processed input
-    inputs = {}
-
-    # Traverse the input keyword parameters
-    for k, v in kwargs.items():
-        # If the value of the parameter is a list of strings
-        if isinstance(v, list) and all(isinstance(elem, str) for elem in v):
-            # Join all the strings in the list with two newline characters
-            val = '\n\n'.join(v)
-        else:
-            # Otherwise, use the value of the parameter directly
-            val = v
-        # Add the processed value to the dictionary
-        inputs[k] = val
-
-    # Use the processed input parameters to format the template, and return the result
-    return prompt_template.format(**inputs)
+def get_completion_stream(prompt, model="gpt-3.5-turbo"):
+    '''Encapsulate the openai interface, streamed: the answer is returned piece by piece as it is generated'''
+    messages = [{"role": "user", "content": prompt}]
+    response = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0,  # The randomness of the model output, 0 means the least randomness
+        stream=True  # See Example-1-4
+    )
+    return iter_completion(response)
+
+# Assign values to the Prompt template: sentences repeated by overlapping chunks are dropped and the chunks are packed
+# in rank order into a token budget (default 2000, budget=None keeps all of them), see prompt_utils.py
+from prompt_utils import build_prompt
 
 # Prompt template
 prompt_template = """
@@ -144,38 +122,28 @@ prompt_template = """
 请用中文回答用户问题。
 """
 
-from nltk.tokenize import sent_tokenize  # Import the sent_tokenize function from the NLTK library for splitting text into sentences
-
-def split_text(paragraphs, chunk_size=300, overlap_size=100):  # Define a function that takes a list of paragraphs and two optional parameters: chunk_size and overlap_size
-    '''Split the text by the specified chunk_size and overlap_size'''  # The function's docstring, explaining what the function does
-    sentences = [s.strip() for p in paragraphs for s in sent_tokenize(p)]  # Split each paragraph into sentences, and remove leading and trailing whitespace from each sentence
-    chunks = []  # Initialize an empty list to store the generated chunks
-    i = 0  # Initialize a variable i for indexing in the list of sentences
-    while i < len(sentences):  # Execute the loop while i is less than the length of the list of sentences
-        chunk = sentences[i]  # Take the i-th sentence from the list of sentences as the current chunk
-        overlap = ''  # Initialize an empty string to store the overlap with the previous chunk
-        prev = i - 1  # Initialize a variable prev, representing the index of the sentence before the current one
-        # Calculate the overlap forward
-        while prev >= 0 and len(sentences[prev])+len(overlap) <= overlap_size:  # Execute the loop while prev is not less than 0 and the length of the previous sentence plus the length of the overlap does not exceed overlap_size
-            overlap = sentences[prev] + ' ' + overlap  # Add the previous sentence to the front of the overlap
-            prev -= 1  # Decrement prev by 1, moving to the next sentence forward
-        chunk = overlap+chunk  # Add the overlap to the front of the current chunk
-        next = i + 1  # Initialize a variable next, representing the index of the sentence after the current one
-        # Calculate the current chunk backward
-        while next < len(sentences) and len(sentences[next])+len(chunk) <= chunk_size:  # Execute the loop while next is less than the length of the list of sentences and the length of the next sentence plus the length of the current chunk does not exceed chunk_size
-            chunk = chunk + ' ' + sentences[next]  # Add the next sentence to the end of the current chunk
-            next += 1  # Increment next by 1, moving to the next sentence backward
-        chunks.append(chunk)  # Add the current chunk to the list of chunks
-        i = next  # Set i to next, i.e., move to the next sentence to be processed
-    return chunks  # Return the generated list of chunks
+# Split the text into overlapping chunks, see text_split_utils.py (chunk size can also be measured in tokens with tiktoken_length)
+from text_split_utils import split_text
+
+# chat_stream of the bots returns the sources first, then the answer as it is generated, and the time to first token
+import time
+from stream_utils import iter_completion, print_stream, stream_answer
 
 class RAG_Bot:
-    def __init__(self, vector_db, llm_api, n_results=2):
+    def __init__(self, vector_db, llm_api, n_results=2, cache=None, llm_stream_api=None):
         self.vector_db = vector_db
         self.llm_api = llm_api
         self.n_results = n_results
+        self.cache = cache  # Semantic cache (SemanticCache), None to search and call the LLM every time
+        self.llm_stream_api = llm_stream_api  # Streamed llm_api, used by chat_stream
 
     def chat(self, user_query):
+        # 0. A similar question answered before (on the same collection version) gets the cached answer
+        if self.cache is not None:
+            return self.cache.get_or_compute(user_query, self._chat)
+        return self._chat(user_query)
+
+    def _chat(self, user_query):
         # 1. Search
         search_results = self.vector_db.search(user_query, self.n_results)
 
@@ -186,12 +154,36 @@ class RAG_Bot:
         # 3. Call LLM
         response = self.llm_api(prompt)
         return response
+
+    def chat_stream(self, user_query):
+        '''Like chat, but returns events: the sources first, then the answer piece by piece (see stream_utils)'''
+        start = time.monotonic()
+        # 0. A cached answer is sent as one piece; a new answer is cached for the collection version of now
+        on_done = None
+        if self.cache is not None:
+            answer, on_done = self.cache.lookup(user_query)
+            if answer is not None:
+                return stream_answer([], [answer], start, cached=True)
+
+        # 1. Search
+        search_results = self.vector_db.search(user_query, self.n_results)
+        sources = [{"id": doc_id, "distance": distance, "text": doc}
+                   for doc_id, doc, distance in zip(search_results['ids'][0], search_results['documents'][0],
+                                                    search_results['distances'][0])]
+
+        # 2. Build Prompt
+        prompt = build_prompt(
+            prompt_template, info=search_results['documents'][0], query=user_query)
+
+        # 3. Call LLM, streamed; the whole answer is cached when the stream is done
+        return stream_answer(sources, self.llm_stream_api(prompt), start, on_done)
     
 class RAG_BotC:
-    def __init__(self, vector_db, llm_api, n_results=5):
+    def __init__(self, vector_db, llm_api, n_results=5, llm_stream_api=None):
         self.vector_db = vector_db
         self.llm_api = llm_api
         self.n_results = n_results
+        self.llm_stream_api = llm_stream_api  # Streamed llm_api, used by chat_stream
 
     def chat(self, user_query, search_results):
         # 1. Build Prompt
@@ -202,40 +194,67 @@ class RAG_BotC:
         response = self.llm_api(prompt)
         return response
 
+    def chat_stream(self, user_query, search_results, scores=None):
+        '''Like chat, but returns events: the sources first, then the answer piece by piece (see stream_utils)'''
+        start = time.monotonic()
+        sources = [{"score": score, "text": doc}
+                   for doc, score in zip(search_results, scores or [None] * len(search_results))]
+        # 1. Build Prompt
+        prompt = build_prompt(
+            prompt_template, info=search_results, query=user_query)
+
+        # 2. Call LLM, streamed
+        return stream_answer(sources, self.llm_stream_api(prompt), start)
+
+# Cache embeddings on disk (.rag_cache): texts embedded before with the same model are not sent to the API again
+# Cache misses are split into batches within the per-request input and token limits and sent concurrently
+from embedding_utils import BatchedEmbeddings, CachedEmbeddings
+embedding_fn = CachedEmbeddings(BatchedEmbeddings(get_embeddings, max_concurrency=4), provider="openai", model="text-embedding-3-small")
+
 # Create or associate a vector database object
-vector_db = MyVectorDBConnector("demo_split", get_embeddings)
+# LocalVectorDBConnector keeps the vectors in a local memory-mapped file (.rag_cache/vector_db), no chroma server is needed
+# To use the chroma server instead: vector_db = MyVectorDBConnector("demo_split", embedding_fn)
+# engine="hnsw" is the local equivalent of chroma's {"hnsw:space": "cosine"} index (see ann_utils for the parameters)
+from vector_db_utils import LocalVectorDBConnector
+vector_db = LocalVectorDBConnector("demo_split", embedding_fn, space="cosine", engine="hnsw",
+                                   engine_params={"M": 16, "ef_construction": 100, "ef_search": 64})
 
 if isFirstRun:
     # Extract text from PDF
-    paragraphs = extract_text_from_pdf("llama2.pdf", page_numbers=[
+    paragraphs = cached_extract_text_from_pdf("llama2.pdf", page_numbers=[
                                       2, 3], min_line_length=10)
-    chunks = split_text(paragraphs, 300, 100)
-    # Add documents to the vector database
-    vector_db.add_documents(chunks, metadatainputs="llama2.pdf")
+    chunks = split_text(paragraphs, chunk_size, overlap_size)
+    # Add documents to the vector database: ids are content hashes, so only new or changed chunks are embedded
+    # and chunks that are no longer in the file are deleted
+    vector_db.sync(chunks, metadatainputs="llama2.pdf")
+    # Write the hnsw graph once, so the next run opens it instead of indexing the chunks again
+    vector_db.save_engine()
 
 if isResultSort==False:
+    # Semantic cache: a question with cosine similarity >= 0.95 to one answered on the same collection version
+    # within 24 hours is answered from the cache
+    from semantic_cache_utils import SemanticCache
+    answer_cache = SemanticCache(embedding_fn, threshold=0.95, ttl=24 * 3600, version_fn=lambda: vector_db.version)
     # Create a RAG bot
     bot = RAG_Bot(
         vector_db,
         llm_api=get_completion,
-        n_results=top_n
+        n_results=top_n,
+        cache=answer_cache,
+        llm_stream_api=get_completion_stream
     )
-    search_results = vector_db.search(user_query, top_n)
-    for doc in search_results['documents'][0]:
-        print(doc+"\n")
-    print("====Reply====")
-    print(bot.chat(user_query)) 
+    # The sources are printed first, then the answer as it is generated
+    print_stream(bot.chat_stream(user_query))
 else:
-    from sentence_transformers import CrossEncoder
+    from rerank_utils import CrossEncoderReranker
     search_results = vector_db.search(user_query, top_nc)
-    # model = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2', max_length=512)
-    model = CrossEncoder('BAAI/bge-reranker-large', max_length=512) # Multilingual, domestic, large model
-    scores = model.predict([(user_query, doc)
-                            for doc in search_results['documents'][0]])
+    # The model is loaded once per process and quantized to int8 on CPU, concurrent requests are scored in shared batches
+    # and scores are cached in .rag_cache, so candidates seen before are not scored again
+    # reranker = CrossEncoderReranker('cross-encoder/ms-marco-MiniLM-L-6-v2', max_length=256) # Small, fast on CPU
+    reranker = CrossEncoderReranker('BAAI/bge-reranker-large', max_length=512) # Multilingual, domestic, large model
 
     # Sort by score
-    sorted_list = sorted(
-        zip(scores, search_results['documents'][0]), key=lambda x: x[0], reverse=True)
+    sorted_list = reranker.rerank(user_query, search_results['documents'][0])
     for score, doc in sorted_list:
         print(f"{score}\t{doc}\n")
     
@@ -243,7 +262,8 @@ else:
     bot = RAG_BotC(
         vector_db,
         llm_api=get_completion,
-        n_results=top_nc
+        n_results=top_nc,
+        llm_stream_api=get_completion_stream
     )
-    print("====回复====")
-    print(bot.chat(user_query,[doc for score, doc in sorted_list[:top_n]]))
\ No newline at end of file
+    print_stream(bot.chat_stream(user_query, [doc for score, doc in sorted_list[:top_n]],
+                                 [score for score, doc in sorted_list[:top_n]]))
\ No newline at end of file
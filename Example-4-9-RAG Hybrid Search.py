@@ -10,6 +10,7 @@ RAG-Fusion 就是利用了 RRF 的原理来提升检索的准确性。
 """
 
 query = "非小细胞肺癌的患者"
+useElasticsearch = False  # 是否使用 Elasticsearch 服务做关键字检索；False 时在进程内检索，不需要安装 elasticsearch7
 
 documents = [
     "李某患有肺癌，癌细胞已转移",
@@ -21,32 +22,63 @@ documents = [
 # 1.基于关键字检索的排序
 
 import time  # 导入 time 模块，用于操作时间
-from elasticsearch7 import Elasticsearch, helpers
+from bm25_utils import doc_id  # 文档 ID 为内容哈希，ES、本地关键字检索与向量检索共用同一个定义
 
 class MyEsConnector:  # 定义一个名为 MyEsConnector 的类
-    def __init__(self, es_client, index_name, keyword_fn):  # 初始化方法，接收三个参数：es_client（Elasticsearch 客户端），index_name（索引名称），keyword_fn（关键词函数）
+    def __init__(self, es_client, index_name, keyword_fn, keyword_batch_fn=None):  # 初始化方法，接收参数：es_client（Elasticsearch 客户端），index_name（索引名称），keyword_fn（关键词函数），keyword_batch_fn（可选的批量关键词函数）
         self.es_client = es_client  # 将 es_client 参数赋值给实例的 es_client 属性
         self.index_name = index_name  # 将 index_name 参数赋值给实例的 index_name 属性
         self.keyword_fn = keyword_fn  # 将 keyword_fn 参数赋值给实例的 keyword_fn 属性
+        self.keyword_batch_fn = keyword_batch_fn  # 灌库时用批量函数一次性提取所有文档的关键词
     
-    def add_documents(self, documents):  # 定义一个名为 add_documents 的方法，接收一个参数：documents（文档列表）
+    def add_documents(self, documents, append=False, chunk_size=500, thread_count=4):  # 定义一个名为 add_documents 的方法，接收参数：documents（文档列表），append（是否增量写入），chunk_size（每个批量请求的文档数），thread_count（并发写入的线程数）
         '''文档灌库'''  # 方法的注释：文档灌库
-        if self.es_client.indices.exists(index=self.index_name):  # 如果索引已经存在
-            self.es_client.indices.delete(index=self.index_name)  # 删除索引
-        self.es_client.indices.create(index=self.index_name)  # 创建索引
+        from elasticsearch7 import helpers  # 只有使用 Elasticsearch 时才需要安装 elasticsearch7
+        if self.keyword_batch_fn is not None:  # 有批量函数时一次性提取关键词
+            keywords = self.keyword_batch_fn(documents)
+        else:
+            keywords = [self.keyword_fn(doc) for doc in documents]
+        # 文档 ID 为内容哈希（全量、增量都一样），同一文档重复灌库只会覆盖，不会重复
+        ids = [doc_id(doc) for doc in documents]
+        if append:  # 增量模式：直接写入现有索引，不删除重建
+            index = self.index_name
+            if not self.es_client.indices.exists(index=index):  # 索引不存在时才创建
+                self.es_client.indices.create(index=index)
+        else:  # 全量重建：先写入一个新索引，完成后再把别名切换过去，重建期间旧索引照常可检索
+            index = f"{self.index_name}_{int(time.time() * 1000)}"  # 新索引名称
+            self.es_client.indices.create(index=index)  # 创建新索引
         actions = [  # 定义一个名为 actions 的列表，用于存储批量操作的数据
             {
-                "_index": self.index_name,  # 索引名称
+                "_index": index,  # 索引名称
+                "_id": ids[i],  # ES 文档 ID，重复写入同一 ID 即覆盖
                 "_source": {  # 文档源数据
-                    "keywords": self.keyword_fn(doc),  # 关键词，通过 keyword_fn 函数处理 doc 得到
+                    "keywords": keywords[i],  # 关键词，通过 keyword_fn 函数处理 doc 得到
                     "text": doc,  # 文本，直接使用 doc
-                    "id": f"doc_{i}"  # 文档 ID，使用字符串格式化生成
+                    "id": ids[i]  # 文档 ID
                 }
             }
             for i,doc in enumerate(documents)  # 遍历 documents，同时获取元素的索引和值
         ]
-        helpers.bulk(self.es_client, actions)  # 使用 helpers.bulk 方法批量添加文档
-        time.sleep(1)  # 暂停 1 秒，等待 Elasticsearch 处理完批量操作
+        failed = 0  # 写入失败的文档数
+        for ok, _ in helpers.parallel_bulk(self.es_client, actions, chunk_size=chunk_size, thread_count=thread_count, raise_on_error=False):  # 多线程分块批量写入
+            failed += not ok
+        self.es_client.indices.refresh(index=index)  # 显式 refresh，返回后文档即可检索，不再固定 sleep 1 秒
+        if not append:
+            self._switch_alias(index)  # 把别名切换到新索引
+        return failed
+
+    def _switch_alias(self, index):
+        '''把别名 index_name 原子地指向新索引，并删除旧索引'''
+        old_indices = []
+        if self.es_client.indices.exists_alias(name=self.index_name):  # 别名已存在：记下它当前指向的索引
+            old_indices = list(self.es_client.indices.get_alias(name=self.index_name).keys())
+        elif self.es_client.indices.exists(index=self.index_name):  # 以前直接以 index_name 创建的索引，只能先删除
+            self.es_client.indices.delete(index=self.index_name)
+        actions = [{"remove": {"index": old, "alias": self.index_name}} for old in old_indices]
+        actions.append({"add": {"index": index, "alias": self.index_name}})
+        self.es_client.indices.update_aliases(body={"actions": actions})  # 一次请求完成切换，检索不会中断
+        for old in old_indices:
+            self.es_client.indices.delete(index=old)  # 删除旧索引
 
     def search(self, query_string, top_n=3):  # 定义一个名为 search 的方法，接收两个参数：query_string（查询字符串），top_n（返回的文档数量，默认为 3）
         '''检索'''  # 方法的注释：检索
@@ -64,28 +96,33 @@ class MyEsConnector:  # 定义一个名为 MyEsConnector 的类
             for i, hit in enumerate(res["hits"]["hits"])  # 遍历搜索结果，同时获取元素的索引和值
         }
     
-from chinese_and_english_utils import to_keywords # 使用中文、英文的关键字提取函数
+from chinese_and_english_utils import to_keywords, to_keywords_batch # 使用中文、英文的关键字提取函数
 
 import os
 
 # Introduce configuration file
 from dotenv import load_dotenv, find_dotenv
 _ = load_dotenv(find_dotenv())  # Read the local .env file, which defines ELASTICSEARCH_BASE_URL, ELASTICSEARCH_PASSWORD, ELASTICSEARCH_NAME, OPENAI_API_KEY
-ELASTICSEARCH_BASE_URL = os.getenv('ELASTICSEARCH_BASE_URL')
-ELASTICSEARCH_PASSWORD = os.getenv('ELASTICSEARCH_PASSWORD')
-ELASTICSEARCH_NAME= os.getenv('ELASTICSEARCH_NAME')
-print(ELASTICSEARCH_BASE_URL)
-# print(ELASTICSEARCH_PASSWORD)
-# print(ELASTICSEARCH_NAME)
-
-# 1. Create Elasticsearch connection
-es = Elasticsearch(
-    hosts=[ELASTICSEARCH_BASE_URL],  # Service address and port
-    http_auth=(ELASTICSEARCH_NAME, ELASTICSEARCH_PASSWORD),  # Username, password
-)
-
-# 创建 ES 连接器
-es_connector = MyEsConnector(es, "demo_es_lq", to_keywords)
+
+if useElasticsearch:
+    from elasticsearch7 import Elasticsearch
+    ELASTICSEARCH_BASE_URL = os.getenv('ELASTICSEARCH_BASE_URL')
+    ELASTICSEARCH_PASSWORD = os.getenv('ELASTICSEARCH_PASSWORD')
+    ELASTICSEARCH_NAME= os.getenv('ELASTICSEARCH_NAME')
+    print(ELASTICSEARCH_BASE_URL)
+    # print(ELASTICSEARCH_PASSWORD)
+    # print(ELASTICSEARCH_NAME)
+
+    # 1. Create Elasticsearch connection
+    es = Elasticsearch(
+        hosts=[ELASTICSEARCH_BASE_URL],  # Service address and port
+        http_auth=(ELASTICSEARCH_NAME, ELASTICSEARCH_PASSWORD),  # Username, password
+    )
+    es_connector = MyEsConnector(es, "demo_es_lq", to_keywords, to_keywords_batch)
+else:
+    # 创建关键字检索连接器：LocalBM25Connector 在进程内用 BM25 打分（与 ES 默认相同），不需要 Elasticsearch 服务
+    from bm25_utils import LocalBM25Connector
+    es_connector = LocalBM25Connector(to_keywords, to_keywords_batch)
 
 # 文档灌库
 es_connector.add_documents(documents)
@@ -115,7 +152,7 @@ class MyVectorDBConnector: #内存模式
         self.collection.add(
             embeddings=self.embedding_fn(documents),  # 每个文档的向量
             documents=documents,  # 文档的原文
-            ids=[f"id{i}" for i in range(len(documents))]  # 每个文档的 id
+            ids=[doc_id(doc) for doc in documents]  # 每个文档的 id：内容哈希，与关键字检索的 id 一致，融合时按 id 对齐
         )
 
     def search(self, query, top_n):
@@ -140,42 +177,50 @@ def get_embeddings(texts, model="text-embedding-3-small",dimensions=None):# text
         data = client.embeddings.create(input=texts, model=model).data
     return [x.embedding for x in data]
 
+# 向量缓存在本地（.rag_cache），用同一模型算过的文本不会再次调用接口
+# 未缓存的文本自动分批、并发请求，不会超过接口单次请求的条数和 token 上限
+from embedding_utils import BatchedEmbeddings, CachedEmbeddings
+embedding_fn = CachedEmbeddings(BatchedEmbeddings(get_embeddings, max_concurrency=4), provider="openai", model="text-embedding-3-small")
+
 # 创建向量数据库连接器
-vecdb_connector = MyVectorDBConnector("demo_vec_lq", get_embeddings)
+vecdb_connector = MyVectorDBConnector("demo_vec_lq", embedding_fn)
 
 # 文档灌库
 vecdb_connector.add_documents(documents)
 
 # 向量检索
-vector_search_results = {
-    "doc_"+str(documents.index(doc)) : {
-        "text" : doc,
-        "rank" : i
-    }
-    for i, doc in enumerate(
-        vecdb_connector.search(query, 3)["documents"][0]
-    )
-} # 把结果转成跟上面关键字检索结果一样的格式
+def vector_search(query, top_n):
+    results = vecdb_connector.search(query, top_n)
+    return {
+        id_ : {
+            "text" : doc,
+            "rank" : i
+        }
+        for i, (id_, doc) in enumerate(
+            zip(results["ids"][0], results["documents"][0])
+        )
+    } # 把结果转成跟上面关键字检索结果一样的格式，id 直接取向量检索返回的 id
+
+vector_search_results = vector_search(query, 3)
 
 print(vector_search_results)
 
 # 3.基于 RRF 的融合排序
-def rrf(ranks, k=1):
-    ret = {}
-    # 遍历每次的排序结果
-    for rank in ranks: 
-        # 遍历排序中每个元素
-        for id, val in rank.items():
-            if id not in ret:
-                ret[id] = { "score": 0, "text": val["text"] }
-            # 计算 RRF 得分
-            ret[id]["score"] += 1.0/(k+val["rank"])
-    # 按 RRF 得分排序，并返回
-    return dict(sorted(ret.items(), key=lambda item: item[1]["score"], reverse=True))
+# rank_fusion_utils 还支持加权得分、CombSUM/CombMNZ、归一化线性融合：fuse_rankings(ranks, method="combmnz")
+from rank_fusion_utils import rrf
 
 import json
 
 # 融合两次检索的排序结果
-reranked = rrf([keyword_search_results,vector_search_results])
+reranked = rrf([keyword_search_results,vector_search_results], k=1)
+
+print(json.dumps(reranked,indent=4,ensure_ascii=False))
+
+# 4.并发混合检索：关键字检索与向量检索同时进行，总耗时约为较慢的一路而不是两路之和
+# 某一路超时（这里 2 秒）或出错时，只融合按时返回的结果
+from hybrid_search_utils import HybridRetriever
 
-print(json.dumps(reranked,indent=4,ensure_ascii=False))
\ No newline at end of file
+with HybridRetriever({"keyword": es_connector.search, "vector": vector_search}, fuse_fn=lambda ranks: rrf(ranks, k=1), timeout=2.0) as hybrid_retriever:
+    reranked = hybrid_retriever.search(query, 3)
+    print(json.dumps(reranked,indent=4,ensure_ascii=False))
+    print(hybrid_retriever.last_stats)  # 各路耗时与错误
@@ -0,0 +1,574 @@
+# Function: 近似最近邻检索引擎（HNSW 图索引、IVF 倒排 + 乘积量化）
+# Pluggable engines of vector_db_utils.LocalVectorDBConnector for collections too large for exact search
+
+import os
+import zipfile
+
+import numpy as np
+
+from cache_utils import load_npz, save_npz
+from similarity_utils import cosine_topk, l2_topk
+
+
+def _distances(space, vectors, query):
+    '''Distances from one query to a matrix of vectors: 1 - dot for (normalized) cosine, squared l2 otherwise'''
+    if space == "cosine":
+        return 1 - vectors @ query
+    diff = vectors - query
+    return np.einsum('ij,ij->i', diff, diff)
+
+
+def _exact_search(space, vectors, queries, k):
+    '''Brute force search with the same distances as the engines'''
+    if space == "cosine":
+        rows, scores = cosine_topk(queries, vectors, k, normalized=True)
+        return list(rows), list(1 - scores)
+    rows, distances = l2_topk(queries, vectors, k)
+    return list(rows), list(distances ** 2)
+
+
+# Highest layer of a node, a node reaches it with probability M ** -16
+MAX_LEVEL = 16
+
+
+def _hnswlib():
+    '''The hnswlib module, or None when it is not installed'''
+    try:
+        import hnswlib
+    except ImportError:
+        return None
+    return hnswlib
+
+
+class HNSWIndex:
+    '''Hierarchical Navigable Small World graph (Malkov & Yashunin) in numpy
+
+    M is the number of links per node (2*M on the bottom layer), ef_construction the
+    candidate list size while inserting and ef_search the candidate list size while
+    searching: larger values give a better recall for a slower build / search.
+    The index only stores the graph, the vectors are passed in by the caller.
+    For space="cosine" the vectors and queries must be normalized.
+
+    The links are flat int32 arrays padded with -1: links0 (count, 2*M) for the bottom
+    layer, and for every upper layer the ascending node numbers with their (n, M) links.
+    save() writes them as they are and load() memory maps them, so opening a saved graph
+    is instant. Inserting runs a few numpy operations per step of the graph search
+    (about 2 ms per vector), fine for collections up to about a million vectors;
+    HNSWLibIndex, used by the "hnsw" engine when hnswlib is installed, builds in C++
+    with all cores (about 40 times faster on one core). num_threads is accepted for the
+    same engine_params as HNSWLibIndex and ignored: inserts run one at a time.
+    '''
+    def __init__(self, space="cosine", M=16, ef_construction=100, ef_search=64, seed=0, num_threads=-1):
+        self.space = space
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.rng = np.random.default_rng(seed)
+        self.count = 0
+        self.levels = np.zeros(0, dtype=np.int8)               # Top layer of every node
+        self.links0 = np.zeros((0, 2 * M), dtype=np.int32)
+        self.upper = []                                          # [nodes, links, size] of layers 1, 2, ...
+        self.entry = -1
+        self.max_level = -1
+        self._visited = np.zeros(0, dtype=np.int32)
+        self._slots = np.zeros(0, dtype=np.int64)
+        self._tag = 0
+
+    def params(self):
+        return {"M": self.M, "ef_construction": self.ef_construction, "ef_search": self.ef_search}
+
+    @staticmethod
+    def _grow(array, size):
+        '''array with room for at least size rows, doubling; memory mapped arrays are copied to memory'''
+        if len(array) >= size and array.flags.writeable and not isinstance(array, np.memmap):
+            return array
+        grown = np.full((max(size, 2 * len(array), 64),) + array.shape[1:], -1, dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def _row(self, level, node):
+        '''Links of node on level, a view of the link arrays'''
+        if level == 0:
+            return self.links0[node]
+        nodes, links, size = self.upper[level - 1]
+        return links[np.searchsorted(nodes[:size], node)]
+
+    def _rows(self, level, nodes):
+        '''Links of several nodes on level, one row each'''
+        if level == 0:
+            return self.links0[nodes]
+        layer_nodes, links, size = self.upper[level - 1]
+        return links[np.searchsorted(layer_nodes[:size], nodes)]
+
+    def _new_tag(self):
+        '''Mark for the nodes visited by one search, so the visited set is never cleared'''
+        if len(self._visited) < len(self.links0) or self._tag == np.iinfo(np.int32).max:
+            self._visited = np.zeros(len(self.links0), dtype=np.int32)
+            self._slots = np.zeros(len(self.links0), dtype=np.int64)
+            self._tag = 0
+        self._tag += 1
+        return self._tag
+
+    def _search_layer(self, data, query, entry_points, ef, level, beam=16):
+        '''Best-first search of one layer, returns up to ef (distance, node) pairs sorted by distance
+
+        The beam closest unexpanded candidates are expanded together: their neighbours are
+        gathered and compared with the query in one step, so the loop runs a few numpy
+        operations per beam instead of Python code per neighbour.
+        '''
+        tag = self._new_tag()
+        visited, slots = self._visited, self._slots
+        nodes = np.asarray(entry_points, dtype=np.int64)
+        visited[nodes] = tag
+        distances = _distances(self.space, data[nodes], query)
+        order = np.argsort(distances, kind='stable')
+        # Unexpanded candidates and the ef best found, both sorted by distance
+        candidates_d, candidates_n = distances[order], nodes[order]
+        results_d, results_n = candidates_d[:ef], candidates_n[:ef]
+        while len(candidates_d):
+            bound = results_d[-1] if len(results_d) >= ef else np.inf
+            # Candidates farther than the ef-th result cannot improve it any more
+            end = min(np.searchsorted(candidates_d, bound, side='right'), beam)
+            if not end:
+                break
+            expand = candidates_n[:end]
+            candidates_d, candidates_n = candidates_d[end:], candidates_n[end:]
+            neighbours = self._rows(level, expand).ravel()
+            neighbours = neighbours[neighbours >= 0]
+            neighbours = neighbours[visited[neighbours] != tag]
+            if not len(neighbours):
+                continue
+            # Drop duplicates (shared neighbours of the beam): only the last write of a node keeps its slot
+            positions = np.arange(len(neighbours))
+            slots[neighbours] = positions
+            neighbours = neighbours[slots[neighbours] == positions]
+            visited[neighbours] = tag
+            distances = _distances(self.space, data[neighbours], query)
+            better = distances < bound
+            if not better.any():
+                continue
+            distances, neighbours = distances[better], neighbours[better]
+            candidates_d = np.concatenate([candidates_d, distances])
+            candidates_n = np.concatenate([candidates_n, neighbours])
+            order = np.argsort(candidates_d, kind='stable')
+            candidates_d, candidates_n = candidates_d[order], candidates_n[order]
+            results_d = np.concatenate([results_d, distances])
+            results_n = np.concatenate([results_n, neighbours])
+            order = np.argsort(results_d, kind='stable')[:ef]
+            results_d, results_n = results_d[order], results_n[order]
+        return list(zip(results_d.tolist(), results_n.tolist()))
+
+    def _select_neighbours(self, data, candidates, m):
+        '''Neighbour selection heuristic: skip a candidate that is closer to an already selected one than to the query'''
+        if len(candidates) <= m:
+            return [n for _, n in candidates]
+        nodes = [n for _, n in candidates]
+        vectors = data[nodes]
+        if self.space == "cosine":
+            pairwise = 1 - vectors @ vectors.T
+        else:
+            sq = np.einsum('ij,ij->i', vectors, vectors)
+            pairwise = sq[:, None] + sq[None, :] - 2 * vectors @ vectors.T
+        selected = []
+        # Distance of every candidate to its closest selected one, updated once per selection
+        closest = np.full(len(nodes), np.inf, dtype=pairwise.dtype)
+        for i, (d, _) in enumerate(candidates):
+            if closest[i] > d:
+                selected.append(i)
+                if len(selected) == m:
+                    break
+                np.minimum(closest, pairwise[i], out=closest)
+        # Keep the degree: fill up with the closest of the skipped candidates
+        if len(selected) < m:
+            chosen = set(selected)
+            selected += [i for i in range(len(nodes)) if i not in chosen][:m - len(selected)]
+        return [nodes[i] for i in selected]
+
+    def _add_node(self, node, level):
+        self.levels[node] = level
+        for l in range(1, level + 1):
+            if len(self.upper) < l:
+                self.upper.append([np.zeros(0, dtype=np.int32), np.zeros((0, self.M), dtype=np.int32), 0])
+            layer = self.upper[l - 1]
+            layer[0] = self._grow(layer[0], layer[2] + 1)
+            layer[1] = self._grow(layer[1], layer[2] + 1)
+            layer[0][layer[2]] = node
+            layer[1][layer[2]] = -1
+            layer[2] += 1
+
+    def _insert(self, data, node, level):
+        query = data[node]
+        self._add_node(node, level)
+        if self.entry < 0:
+            self.entry, self.max_level = node, level
+            return
+        entry_points = [self.entry]
+        for l in range(self.max_level, level, -1):
+            entry_points = [self._search_layer(data, query, entry_points, 1, l)[0][1]]
+        for l in range(min(level, self.max_level), -1, -1):
+            found = self._search_layer(data, query, entry_points, self.ef_construction, l)
+            max_links = 2 * self.M if l == 0 else self.M
+            selected = self._select_neighbours(data, found, self.M)
+            self._row(l, node)[:len(selected)] = selected
+            for n in selected:
+                row = self._row(l, n)
+                degree = int(np.count_nonzero(row >= 0))
+                if degree < max_links:
+                    row[degree] = node
+                    continue
+                current = row.tolist() + [node]
+                d = _distances(self.space, data[current], data[n]).tolist()
+                row[:] = self._select_neighbours(data, sorted(zip(d, current)), max_links)
+            entry_points = [n for _, n in found]
+        if level > self.max_level:
+            self.entry, self.max_level = node, level
+
+    def update(self, vectors):
+        '''Insert the rows of vectors that are not in the graph yet'''
+        data = np.asarray(vectors, dtype=np.float32)
+        n = len(data)
+        if n <= self.count:
+            return
+        self.levels = self._grow(self.levels, n)
+        self.links0 = self._grow(self.links0, n)
+        self.links0[self.count:n] = -1
+        self.upper = [[self._grow(nodes, size), self._grow(links, size), size] for nodes, links, size in self.upper]
+        levels = np.minimum(-np.log(1 - self.rng.random(n - self.count)) / np.log(self.M), MAX_LEVEL).astype(np.int64)
+        for node, level in zip(range(self.count, n), levels.tolist()):
+            self._insert(data, node, level)
+        self.count = n
+
+    def search(self, vectors, queries, k):
+        '''Rows and distances of the k nearest vectors of every query'''
+        data = np.asarray(vectors, dtype=np.float32)
+        all_rows, all_distances = [], []
+        for query in np.atleast_2d(queries):
+            found = []
+            if self.entry >= 0:
+                entry_points = [self.entry]
+                for l in range(self.max_level, 0, -1):
+                    entry_points = [self._search_layer(data, query, entry_points, 1, l)[0][1]]
+                found = self._search_layer(data, query, entry_points, max(self.ef_search, k), 0)[:k]
+            all_rows.append(np.array([n for _, n in found], dtype=np.int64))
+            all_distances.append(np.array([d for d, _ in found], dtype=np.float32))
+        return all_rows, all_distances
+
+    def save(self, filename):
+        arrays = {"levels": self.levels[:self.count], "links0": self.links0[:self.count],
+                  "state": np.array([self.entry, self.max_level, self.count], dtype=np.int64)}
+        for l, (nodes, links, size) in enumerate(self.upper, 1):
+            arrays["nodes_%d" % l] = nodes[:size]
+            arrays["links_%d" % l] = links[:size]
+        save_npz(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename, space="cosine", **params):
+        '''Open a saved graph, memory mapped: it is copied to memory on the first insert only'''
+        index = cls(space, **params)
+        arrays = load_npz(filename, mmap_mode='r')
+        index.entry, index.max_level, index.count = (int(x) for x in arrays["state"])
+        index.levels = arrays["levels"]
+        index.links0 = arrays["links0"]
+        l = 1
+        while "nodes_%d" % l in arrays:
+            index.upper.append([arrays["nodes_%d" % l], arrays["links_%d" % l], len(arrays["nodes_%d" % l])])
+            l += 1
+        return index
+
+
+class HNSWLibIndex:
+    '''HNSW graph of hnswlib (C++, multi-threaded inserts), same interface and distances as HNSWIndex'''
+    def __init__(self, space="cosine", M=16, ef_construction=100, ef_search=64, seed=0, num_threads=-1):
+        self.space = space
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.seed = seed
+        self.num_threads = num_threads
+        self.index = None
+
+    @property
+    def count(self):
+        return self.index.get_current_count() if self.index is not None else 0
+
+    def params(self):
+        return {"M": self.M, "ef_construction": self.ef_construction, "ef_search": self.ef_search}
+
+    def update(self, vectors, block_size=65536):
+        '''Insert the rows of vectors that are not in the graph yet'''
+        n = len(vectors)
+        if n <= self.count:
+            return
+        if self.index is None:
+            # hnswlib's cosine and l2 are 1 - dot and the squared l2 distance, as in HNSWIndex
+            self.index = _hnswlib().Index(space="cosine" if self.space == "cosine" else "l2", dim=vectors.shape[1])
+            self.index.init_index(max_elements=n, ef_construction=self.ef_construction, M=self.M,
+                                  random_seed=self.seed)
+        elif n > self.index.get_max_elements():
+            self.index.resize_index(max(n, 2 * self.index.get_max_elements()))
+        for start in range(self.count, n, block_size):
+            end = min(start + block_size, n)
+            self.index.add_items(np.asarray(vectors[start:end], dtype=np.float32), np.arange(start, end),
+                                 num_threads=self.num_threads)
+
+    def search(self, vectors, queries, k):
+        '''Rows and distances of the k nearest vectors of every query'''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        k = min(k, self.count)
+        if not k:
+            return ([np.zeros(0, dtype=np.int64)] * len(queries), [np.zeros(0, dtype=np.float32)] * len(queries))
+        self.index.set_ef(max(self.ef_search, k))
+        rows, distances = self.index.knn_query(queries, k=k, num_threads=self.num_threads)
+        return list(rows.astype(np.int64)), list(distances.astype(np.float32))
+
+    def save(self, filename):
+        if self.index is None:
+            save_npz(filename)
+            return
+        self.index.save_index(filename + ".tmp")
+        os.replace(filename + ".tmp", filename)
+
+    @classmethod
+    def load(cls, filename, space="cosine", **params):
+        index = cls(space, **params)
+        if zipfile.is_zipfile(filename):
+            return index  # Saved before the first vector
+        # The header starts with six size_t: offsetLevel0, max_elements, cur_element_count,
+        # size_data_per_element, label_offset, offsetData; a vector is label_offset - offsetData bytes
+        header = np.fromfile(filename, dtype=np.uint64, count=6)
+        index.index = _hnswlib().Index(space="cosine" if space == "cosine" else "l2",
+                                       dim=int(header[4] - header[5]) // 4)
+        index.index.load_index(filename)
+        return index
+
+
+class HNSWEngine:
+    '''The "hnsw" engine of LocalVectorDBConnector: HNSWLibIndex when hnswlib is installed, HNSWIndex otherwise'''
+    def __new__(cls, space="cosine", **params):
+        return HNSWLibIndex(space, **params) if _hnswlib() is not None else HNSWIndex(space, **params)
+
+    @staticmethod
+    def load(filename, space="cosine", **params):
+        '''Open a saved graph of either kind; None (index again) if it cannot be opened here'''
+        if zipfile.is_zipfile(filename):
+            with zipfile.ZipFile(filename) as zf:
+                names = zf.namelist()
+            if "links0.npy" in names:
+                return HNSWIndex.load(filename, space, **params)
+            if "state.npy" in names:
+                return None  # Graph of an earlier version, stored as lists
+        if _hnswlib() is None:
+            return None
+        return HNSWLibIndex.load(filename, space, **params)
+
+
+def kmeans(x, k, n_iter=20, seed=0):
+    '''Plain Lloyd k-means, returns the (k, d) centroids'''
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = _nearest(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Restart empty clusters from random points
+        centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def _nearest(x, centroids, block_size=65536):
+    '''Index of the nearest centroid (l2) of every row of x'''
+    c_sq = np.einsum('ij,ij->i', centroids, centroids)
+    return np.concatenate([np.argmin(c_sq - 2 * x[i:i + block_size] @ centroids.T, axis=1)
+                           for i in range(0, len(x), block_size)]) if len(x) else np.zeros(0, dtype=np.int64)
+
+
+class IVFPQIndex:
+    '''Inverted file with product quantization, for corpora whose vectors do not fit in memory
+
+    Vectors are assigned to the nearest of nlist k-means centroids, and the residual to
+    that centroid is compressed to m codes of nbits bits (m bytes per vector for nbits=8).
+    A query scans the nprobe nearest lists with asymmetric distance tables, then the
+    rerank * k best candidates are re-scored exactly with the stored vectors (rerank=0
+    returns the approximate distances). Until enough vectors for training are added
+    (train_factor per list) search is exact. The dimension must be divisible by m.
+    '''
+    def __init__(self, space="cosine", nlist=256, nprobe=8, m=16, nbits=8, rerank=4,
+                 train_factor=39, train_size=100000, seed=0):
+        self.space = space
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.m = m
+        self.nbits = nbits
+        self.rerank = rerank
+        self.train_factor = train_factor
+        self.train_size = train_size
+        self.seed = seed
+        self.centroids = None
+        self.codebooks = None
+        self.assign = np.zeros(0, dtype=np.int32)
+        self.codes = np.zeros((0, m), dtype=np.uint8)
+        self.count = 0
+
+    def params(self):
+        return {"nlist": self.nlist, "nprobe": self.nprobe, "m": self.m, "nbits": self.nbits, "rerank": self.rerank}
+
+    def train(self, vectors):
+        '''Learn the coarse centroids and the product quantizer codebooks from a sample of vectors'''
+        if vectors.shape[1] % self.m:
+            raise ValueError("dimension %d is not divisible by m=%d" % (vectors.shape[1], self.m))
+        rng = np.random.default_rng(self.seed)
+        rows = np.sort(rng.choice(len(vectors), min(len(vectors), self.train_size), replace=False))
+        sample = np.asarray(vectors[rows], dtype=np.float32)
+        self.centroids = kmeans(sample, min(self.nlist, len(sample)), seed=self.seed)
+        residuals = sample - self.centroids[_nearest(sample, self.centroids)]
+        ksub = min(2 ** self.nbits, len(sample))
+        self.codebooks = np.stack([kmeans(sub, ksub, seed=self.seed)
+                                   for sub in np.split(residuals, self.m, axis=1)])
+        self.codebook_sq = np.einsum('jkd,jkd->jk', self.codebooks, self.codebooks)
+        self.assign = np.zeros(0, dtype=np.int32)
+        self.codes = np.zeros((0, self.m), dtype=np.uint8)
+        self.count = 0
+
+    def _encode(self, vectors):
+        assign = _nearest(vectors, self.centroids)
+        residuals = vectors - self.centroids[assign]
+        codes = np.stack([_nearest(sub, codebook)
+                          for sub, codebook in zip(np.split(residuals, self.m, axis=1), self.codebooks)], axis=1)
+        return assign.astype(np.int32), codes.astype(np.uint8 if self.nbits <= 8 else np.uint16)
+
+    def update(self, vectors, block_size=65536):
+        '''Encode the rows of vectors that are not in the index yet, training first once there are enough'''
+        if self.centroids is None:
+            if len(vectors) < max(self.nlist * self.train_factor, 2 ** self.nbits):
+                return
+            self.train(vectors)
+        assigns, codes = [self.assign], [self.codes]
+        for start in range(self.count, len(vectors), block_size):
+            a, c = self._encode(np.asarray(vectors[start:start + block_size], dtype=np.float32))
+            assigns.append(a)
+            codes.append(c)
+        self.assign = np.concatenate(assigns)
+        self.codes = np.concatenate(codes)
+        self.count = len(vectors)
+        self._build_lists()
+
+    def _build_lists(self):
+        '''Group the rows by list: rows of list i are order[offsets[i]:offsets[i + 1]]'''
+        self.order = np.argsort(self.assign, kind='stable')
+        self.offsets = np.searchsorted(self.assign[self.order], np.arange(len(self.centroids) + 1))
+
+    def search(self, vectors, queries, k):
+        '''Rows and distances of the k nearest vectors of every query'''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.centroids is None or self.count < len(vectors):
+            return _exact_search(self.space, vectors, queries, k)
+        all_rows, all_distances = [], []
+        n_probe = min(self.nprobe, len(self.centroids))
+        for query in queries:
+            coarse = _distances("l2", self.centroids, query)
+            probes = np.argpartition(coarse, n_probe - 1)[:n_probe]
+            sizes = self.offsets[probes + 1] - self.offsets[probes]
+            if not sizes.sum():
+                all_rows.append(np.zeros(0, dtype=np.int64))
+                all_distances.append(np.zeros(0, dtype=np.float32))
+                continue
+            rows = np.concatenate([self.order[self.offsets[p]:self.offsets[p + 1]] for p in probes])
+            # Distance tables of all probed lists: squared distance of every residual sub-vector to every code
+            residuals = (query - self.centroids[probes]).reshape(n_probe, self.m, -1)
+            tables = (np.einsum('pjd,pjd->pj', residuals, residuals)[:, :, None] + self.codebook_sq[None]
+                      - 2 * np.einsum('pjd,jkd->pjk', residuals, self.codebooks))
+            probe_of_row = np.repeat(np.arange(n_probe), sizes)
+            approx = tables[probe_of_row[:, None], np.arange(self.m), self.codes[rows]].sum(axis=1)
+            n_candidates = min(len(rows), k * self.rerank if self.rerank else k)
+            best = np.argpartition(approx, n_candidates - 1)[:n_candidates]
+            rows = rows[best]
+            if self.rerank:
+                distances = _distances(self.space, np.asarray(vectors[np.sort(rows)], dtype=np.float32), query)
+                rows = np.sort(rows)
+            else:
+                # |q - x|^2 = 2 - 2 q.x for normalized vectors
+                distances = approx[best] / 2 if self.space == "cosine" else approx[best]
+            top = np.argsort(distances, kind='stable')[:k]
+            all_rows.append(rows[top].astype(np.int64))
+            all_distances.append(distances[top].astype(np.float32))
+        return all_rows, all_distances
+
+    def save(self, filename):
+        if self.centroids is None:
+            save_npz(filename)
+            return
+        save_npz(filename, centroids=self.centroids, codebooks=self.codebooks, assign=self.assign, codes=self.codes)
+
+    @classmethod
+    def load(cls, filename, space="cosine", **params):
+        index = cls(space, **params)
+        with np.load(filename) as arrays:
+            if "centroids" in arrays:
+                index.centroids = arrays["centroids"]
+                index.codebooks = arrays["codebooks"]
+                index.assign = arrays["assign"]
+                index.codes = arrays["codes"]
+                index.count = len(index.assign)
+                index._build_lists()
+                index.codebook_sq = np.einsum('jkd,jkd->jk', index.codebooks, index.codebooks)
+        return index
+
+
+ENGINES = {"hnsw": HNSWEngine, "ivfpq": IVFPQIndex}
+
+
+if "__main__" == __name__:
+    # Recall / latency benchmark against exact search on a synthetic clustered corpus
+    # python ann_utils.py [n_vectors] [dimensions]
+    import sys
+    import time
+    from similarity_utils import normalize
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    dim = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    k = 10
+    rng = np.random.default_rng(0)
+    # Overlapping gaussian clusters, so the nearest neighbours are not trivially in one cluster
+    centers = rng.standard_normal((n // 100, dim), dtype=np.float32)
+    data = normalize(centers[rng.integers(0, len(centers), n)] + rng.standard_normal((n, dim), dtype=np.float32))
+    queries = normalize(centers[rng.integers(0, len(centers), 200)] + rng.standard_normal((200, dim), dtype=np.float32))
+
+    start = time.time()
+    exact_rows = [_exact_search("cosine", data, query[None], k)[0][0] for query in queries]
+    print("exact              {:8.3f} ms/query".format((time.time() - start) * 1000 / len(queries)))
+
+    def report(name, index, settings):
+        for attr, value in settings:
+            setattr(index, attr, value)
+            start = time.time()
+            rows, _ = index.search(data, queries, k)
+            ms = (time.time() - start) * 1000 / len(queries)
+            recall = np.mean([len(set(r.tolist()) & set(e.tolist())) / k for r, e in zip(rows, exact_rows)])
+            print("{:6} {:>10}={:<4} {:8.3f} ms/query  recall@{}: {:.3f}".format(name, attr, value, ms, k, recall))
+
+    import tempfile
+    for name, cls in [("hnsw", HNSWIndex)] + ([("hnswlib", HNSWLibIndex)] if _hnswlib() is not None else []):
+        start = time.time()
+        hnsw = cls(M=16, ef_construction=100)
+        hnsw.update(data)
+        print("{} build {:.1f}s".format(name, time.time() - start))
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.time()
+            hnsw.save(os.path.join(tmp, "engine.npz"))
+            saved = time.time() - start
+            start = time.time()
+            hnsw = cls.load(os.path.join(tmp, "engine.npz"), M=16, ef_construction=100)
+            print("{} save {:.3f}s, open {:.3f}s".format(name, saved, time.time() - start))
+            report(name, hnsw, [("ef_search", ef) for ef in (16, 32, 64, 128, 256)])
+
+    start = time.time()
+    ivfpq = IVFPQIndex(nlist=int(np.sqrt(n)), m=16, train_factor=1)
+    ivfpq.update(data)
+    print("ivfpq build {:.1f}s, {:.1f} bytes/vector in memory".format(
+        time.time() - start, ivfpq.codes.nbytes / n + 4))
+    report("ivfpq", ivfpq, [("nprobe", p) for p in (1, 4, 8, 16, 32)])
+    ivfpq.nprobe = 16
+    report("ivfpq", ivfpq, [("rerank", r) for r in (0, 1, 4, 16)])
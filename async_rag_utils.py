@@ -0,0 +1,193 @@
+# Function: 异步 RAG 流水线（AsyncOpenAI、检索与重排序在线程池中执行、并发上限与分阶段计时）
+# One asyncio process answers hundreds of questions at the same time: while some questions wait for the LLM,
+# the others are retrieved, instead of one blocking question after the other as in the examples
+
+import asyncio
+import functools
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from prompt_utils import DEFAULT_CONTEXT_BUDGET, build_prompt
+from rank_fusion_utils import rrf
+
+STAGES = ("queue", "retrieve", "rerank", "llm", "total")
+
+
+class Overloaded(Exception):
+    '''Raised by AsyncRAGPipeline.answer when max_pending questions are already waiting'''
+
+
+_async_client = None
+
+
+def get_async_client():
+    '''AsyncOpenAI client shared by the pipelines, created on first use from the .env file'''
+    global _async_client
+    if _async_client is None:
+        from openai import AsyncOpenAI
+        from dotenv import load_dotenv, find_dotenv
+        _ = load_dotenv(find_dotenv())  # Read the local .env file, which defines OPENAI_API_KEY
+        _async_client = AsyncOpenAI()
+    return _async_client
+
+
+def async_completion_fn(model="gpt-3.5-turbo", client=None, temperature=0):
+    '''Async get_completion of the examples: returns async fn(prompt) -> answer'''
+    async def get_completion(prompt):
+        response = await (client or get_async_client()).chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=temperature,
+        )
+        return response.choices[0].message.content
+    return get_completion
+
+
+class AsyncConnector:
+    '''Async view of a blocking connector: every method call runs on executor
+
+        vector_db = AsyncConnector(LocalVectorDBConnector("demo_split", embedding_fn), executor)
+        results = await vector_db.search(query, 5)
+
+    Works for the vector and keyword connectors and CrossEncoderReranker, whose embedding
+    requests and numpy / torch work release the GIL, so the event loop keeps serving
+    other questions meanwhile.
+    '''
+    def __init__(self, connector, executor):
+        self.connector = connector
+        self.executor = executor
+
+    def __getattr__(self, name):
+        method = getattr(self.connector, name)
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+        return call
+
+
+class AsyncRAGPipeline:
+    '''Retrieve, rerank, build the prompt and call the LLM for many questions concurrently
+
+    vector_db (and keyword_db, fused with rrf) are searched for n_results candidates,
+    reranker (CrossEncoderReranker) keeps the top_n best, or the top_n first without it.
+    llm_fn is an async fn(prompt) -> answer, e.g. async_completion_fn().
+
+    Back-pressure: at most max_concurrency questions are in the pipeline and at most
+    llm_concurrency of them call the LLM at the same time; further questions wait, and
+    once max_pending questions wait answer() raises Overloaded at once instead of
+    queueing without bound. The blocking connectors and building the prompt (tokenizing
+    the candidates for the budget) share a pool of worker threads.
+    Every answer has its timings per stage (queue, retrieve, rerank, llm including the
+    wait for an LLM slot, total); stats() reports their percentiles.
+    '''
+    def __init__(self, vector_db, llm_fn, prompt_template, keyword_db=None, reranker=None, n_results=5, top_n=2,
+                 max_concurrency=256, llm_concurrency=64, max_pending=1024, workers=16,
+                 budget=DEFAULT_CONTEXT_BUDGET, length_fn=None, history=10000):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.vector_db = AsyncConnector(vector_db, self.executor)
+        self.keyword_db = AsyncConnector(keyword_db, self.executor) if keyword_db is not None else None
+        self.reranker = AsyncConnector(reranker, self.executor) if reranker is not None else None
+        self.llm_fn = llm_fn
+        self.prompt_template = prompt_template
+        self.n_results = n_results
+        self.top_n = top_n
+        self.budget = budget
+        self.length_fn = length_fn
+        self.max_pending = max_pending
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.llm_slots = asyncio.Semaphore(llm_concurrency)
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timings = {stage: deque(maxlen=history) for stage in STAGES}
+
+    async def _retrieve(self, question):
+        '''Candidates as [{"id", "text", "score"}], best first'''
+        if self.keyword_db is None:
+            results = await self.vector_db.search(question, self.n_results)
+            # Smaller distance is better, the score is the negated distance
+            return [{"id": id_, "text": doc, "score": -distance}
+                    for id_, doc, distance in zip(results["ids"][0], results["documents"][0], results["distances"][0])]
+        results, keyword_results = await asyncio.gather(self.vector_db.search(question, self.n_results),
+                                                        self.keyword_db.search(question, self.n_results))
+        vector_results = {id_: {"text": doc, "rank": i}
+                          for i, (id_, doc) in enumerate(zip(results["ids"][0], results["documents"][0]))}
+        fused = rrf([keyword_results, vector_results])
+        return [{"id": id_, "text": val["text"], "score": val["score"]} for id_, val in fused.items()]
+
+    async def answer(self, question):
+        '''Answer one question, returns {"answer", "sources", "timings"}'''
+        start = time.monotonic()
+        if self.waiting >= self.max_pending:
+            self.rejected += 1
+            raise Overloaded("%d questions are waiting already" % self.waiting)
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        timings = {"queue": time.monotonic() - start}
+        try:
+            t = time.monotonic()
+            sources = await self._retrieve(question)
+            timings["retrieve"] = time.monotonic() - t
+
+            t = time.monotonic()
+            if self.reranker is not None and sources:
+                ranked = await self.reranker.rerank(question, [source["text"] for source in sources], self.top_n)
+                by_text = {source["text"]: source for source in sources}
+                sources = [dict(by_text[doc], score=score) for score, doc in ranked]
+            else:
+                sources = sources[:self.top_n]
+            timings["rerank"] = time.monotonic() - t
+
+            # Tokenizing the candidates for the budget is CPU work, it runs on the pool like retrieval
+            prompt = await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(
+                build_prompt, self.prompt_template, budget=self.budget, length_fn=self.length_fn,
+                info=[source["text"] for source in sources], query=question))
+            t = time.monotonic()
+            async with self.llm_slots:
+                answer = await self.llm_fn(prompt)
+            timings["llm"] = time.monotonic() - t
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+        timings["total"] = time.monotonic() - start
+        for stage, seconds in timings.items():
+            self.timings[stage].append(seconds)
+        self.completed += 1
+        return {"answer": answer, "sources": sources, "timings": timings}
+
+    async def answer_many(self, questions, return_exceptions=True):
+        '''Answer all questions concurrently, in input order (exceptions in place of failed answers)'''
+        return await asyncio.gather(*(self.answer(q) for q in questions), return_exceptions=return_exceptions)
+
+    def stats(self):
+        '''Counters and the p50 / p95 / max seconds of every stage over the last answers'''
+        result = {"completed": self.completed, "failed": self.failed, "rejected": self.rejected,
+                  "in_flight": self.in_flight, "waiting": self.waiting}
+        for stage, values in self.timings.items():
+            if values:
+                values = np.fromiter(values, dtype=np.float64, count=len(values))
+                result[stage] = {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95)),
+                                 "max": float(values.max())}
+        return result
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
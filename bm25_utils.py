@@ -0,0 +1,249 @@
+# Function: 进程内 BM25 关键字检索（CSR 倒排表、向量化打分，可选落盘）
+# Replaces the Elasticsearch keyword search of Example-4-2 / 4-9 when a few thousand (or million) paragraphs fit on one machine
+
+import json
+import os
+from collections import Counter
+
+import numpy as np
+
+from cache_utils import save_npz, sha256_text
+
+
+class BM25Index:
+    '''BM25 (Okapi, the default similarity of Elasticsearch) over pre-tokenized documents
+
+    Postings are stored CSR style: the documents containing term t are
+    doc_ids[indptr[t]:indptr[t + 1]], with their term frequencies in tfs. IDF and the
+    BM25 weight of every posting are computed once when the index is built, so scoring
+    a query is one bincount over the postings of its terms and top-k is an argpartition.
+    append() merges the postings of new documents with one stable sort, without
+    re-tokenizing the indexed ones.
+    '''
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.vocab = {}
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.doc_ids = np.zeros(0, dtype=np.int32)
+        self.tfs = np.zeros(0, dtype=np.float32)
+        self.doc_len = np.zeros(0, dtype=np.float32)
+
+    @property
+    def n_docs(self):
+        return len(self.doc_len)
+
+    def build(self, token_lists):
+        '''Index documents given as lists of terms, replacing the current content'''
+        self.__init__(self.k1, self.b)
+        self.append(token_lists)
+
+    def append(self, token_lists):
+        '''Add documents given as lists of terms after the indexed ones'''
+        n_old = self.n_docs
+        lengths = np.array([len(tokens) for tokens in token_lists], dtype=np.int64)
+        term_ids = np.array([self.vocab.setdefault(t, len(self.vocab)) for tokens in token_lists for t in tokens],
+                            dtype=np.int64)
+        docs = np.repeat(np.arange(len(token_lists), dtype=np.int64), lengths)
+        # One posting per (term, document) pair of the new documents
+        n_new = max(len(token_lists), 1)
+        pairs, tfs = np.unique(term_ids * n_new + docs, return_counts=True)
+        terms = np.concatenate([np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr)), pairs // n_new])
+        doc_ids = np.concatenate([self.doc_ids, pairs % n_new + n_old])
+        tfs = np.concatenate([self.tfs, tfs])
+        # Stable sort by term: the old postings of a term come first and have the lower document numbers
+        order = np.argsort(terms, kind='stable')
+        self.indptr = np.searchsorted(terms[order], np.arange(len(self.vocab) + 1)).astype(np.int64)
+        self.doc_ids = doc_ids[order].astype(np.int32)
+        self.tfs = tfs[order].astype(np.float32)
+        self.doc_len = np.concatenate([self.doc_len, lengths.astype(np.float32)])
+        self._precompute()
+
+    def _precompute(self):
+        '''IDF of every term and BM25 weight of every posting'''
+        df = np.diff(self.indptr).astype(np.float64)
+        self.idf = np.log(1 + (self.n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avgdl = self.doc_len.mean() if self.n_docs else 1.0
+        terms = np.repeat(np.arange(len(df)), np.diff(self.indptr))
+        norm = self.k1 * (1 - self.b + self.b * self.doc_len[self.doc_ids] / max(avgdl, 1e-9))
+        self.weights = (self.idf[terms] * self.tfs * (self.k1 + 1) / (self.tfs + norm)).astype(np.float32)
+
+    def scores(self, query_tokens):
+        '''(documents, scores) of the documents matching at least one query term'''
+        counts = Counter(self.vocab[t] for t in query_tokens if t in self.vocab)
+        if not counts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        terms = np.fromiter(counts.keys(), dtype=np.int64)
+        sizes = self.indptr[terms + 1] - self.indptr[terms]
+        # Positions of all postings of the query terms
+        positions = np.repeat(self.indptr[terms] - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+        # A term repeated in the query counts several times, as in a match query
+        weights = self.weights[positions] * np.repeat(np.fromiter(counts.values(), dtype=np.float32), sizes)
+        doc_ids = self.doc_ids[positions]
+        if len(positions) > self.n_docs // 8:
+            # Frequent terms: accumulate into one dense score array
+            scores = np.bincount(doc_ids, weights=weights, minlength=self.n_docs)
+            docs = np.flatnonzero(np.bincount(doc_ids, minlength=self.n_docs))
+            return docs, scores[docs].astype(np.float32)
+        docs, inverse = np.unique(doc_ids, return_inverse=True)
+        return docs, np.bincount(inverse, weights=weights).astype(np.float32)
+
+    def search(self, query_tokens, top_n=3):
+        '''Top top_n (documents, scores) by descending score, ties in document order'''
+        docs, scores = self.scores(query_tokens)
+        if len(docs) > top_n:
+            # Keep every document scoring at least the top_n-th score, so ties are cut in document order
+            kth = -np.partition(-scores, top_n - 1)[top_n - 1]
+            best = np.flatnonzero(scores >= kth)
+            docs, scores = docs[best], scores[best]
+        order = np.lexsort((docs, -scores))[:top_n]
+        return docs[order], scores[order]
+
+    def save(self, filename):
+        save_npz(filename, vocab=np.array(list(self.vocab), dtype=str), indptr=self.indptr,
+                 doc_ids=self.doc_ids, tfs=self.tfs, doc_len=self.doc_len, params=np.array([self.k1, self.b]))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as arrays:
+            index = cls(*arrays["params"].tolist())
+            index.vocab = {t: i for i, t in enumerate(arrays["vocab"].tolist())}
+            index.indptr = arrays["indptr"]
+            index.doc_ids = arrays["doc_ids"]
+            index.tfs = arrays["tfs"]
+            index.doc_len = arrays["doc_len"]
+        index._precompute()
+        return index
+
+
+def doc_id(text):
+    '''Id of a document: a hash of its text, the same in every index (and in MyEsConnector of Example-4-9)'''
+    return "doc_" + sha256_text(text)[:16]
+
+
+class LocalBM25Connector:
+    '''In-process replacement of MyEsConnector, with the same add_documents / search contract
+
+    keyword_fn turns a text into space separated keywords (to_keywords of
+    chinese_and_english_utils or Example-4-2), keyword_batch_fn optionally does it for a
+    list of texts. search returns {id: {"text": ..., "rank": ..., "score": ...}} in rank order.
+    With path the index is saved to <path>/index.npz and <path>/records.jsonl and loaded
+    again when the connector is created.
+
+    add_documents(documents, append=True) adds to the index instead of replacing it. Ids
+    are content hashes (doc_id) in both modes, so documents that are already indexed are
+    skipped, whether they were indexed by a rebuild or appended. As in
+    Elasticsearch, appended documents become searchable on refresh(), which add_documents
+    calls unless refresh=False (to refresh once after several batches).
+    '''
+    def __init__(self, keyword_fn, keyword_batch_fn=None, path=None, k1=1.2, b=0.75):
+        self.keyword_fn = keyword_fn
+        self.keyword_batch_fn = keyword_batch_fn
+        self.path = path
+        self.index = BM25Index(k1, b)
+        self.ids = []
+        self.texts = []
+        self.pending = []  # (id, text, tokens) appended but not refreshed yet
+        if path and os.path.exists(os.path.join(path, "index.npz")):
+            self.index = BM25Index.load(os.path.join(path, "index.npz"))
+            with open(os.path.join(path, "records.jsonl"), encoding='utf-8') as fp:
+                # Lines beyond the saved index are from an interrupted refresh
+                for line, _ in zip(fp, range(self.index.n_docs)):
+                    record = json.loads(line)
+                    self.ids.append(record["id"])
+                    self.texts.append(record["text"])
+        self._known_ids = set(self.ids)
+
+    @staticmethod
+    def _tokens(keywords):
+        return keywords.lower().split()
+
+    def _keywords(self, documents):
+        if self.keyword_batch_fn is not None:
+            return self.keyword_batch_fn(documents)
+        return [self.keyword_fn(doc) for doc in documents]
+
+    def add_documents(self, documents, append=False, refresh=True):
+        '''Index the documents, replacing the previous content (like deleting and recreating the ES index)
+
+        With append=True the documents that are not indexed yet are added instead.
+        '''
+        # A document given twice is indexed once
+        documents = {doc_id(doc): doc for doc in documents}
+        if not append:
+            self.index.build([self._tokens(k) for k in self._keywords(list(documents.values()))])
+            self.ids = list(documents)
+            self.texts = list(documents.values())
+            self._known_ids = set(self.ids)
+            self.pending = []
+            if self.path:
+                self.save()
+            return len(documents)
+        new = {id_: doc for id_, doc in documents.items() if id_ not in self._known_ids}
+        self._known_ids.update(new)
+        keywords = self._keywords(list(new.values())) if new else []
+        self.pending.extend((id_, doc, self._tokens(k)) for (id_, doc), k in zip(new.items(), keywords))
+        if refresh:
+            self.refresh()
+        return len(new)
+
+    def refresh(self):
+        '''Merge the appended documents into the index, making them searchable, and save it'''
+        if not self.pending:
+            return
+        start = len(self.ids)
+        self.index.append([tokens for _, _, tokens in self.pending])
+        self.ids.extend(id_ for id_, _, _ in self.pending)
+        self.texts.extend(text for _, text, _ in self.pending)
+        self.pending = []
+        if self.path:
+            self.save(start)
+
+    def save(self, start=0):
+        '''Write the index, and the records from number start on (the earlier ones are on disk already)'''
+        os.makedirs(self.path, exist_ok=True)
+        records = os.path.join(self.path, "records.jsonl")
+        if start:
+            with open(records, 'r+b') as fp:
+                # Drop the lines of an interrupted refresh after the start committed records
+                for _ in range(start):
+                    fp.readline()
+                fp.truncate()
+                for id_, text in zip(self.ids[start:], self.texts[start:]):
+                    fp.write((json.dumps({"id": id_, "text": text}, ensure_ascii=False) + '\n').encode('utf-8'))
+        else:
+            with open(records + ".tmp", 'w', encoding='utf-8') as fp:
+                for id_, text in zip(self.ids, self.texts):
+                    fp.write(json.dumps({"id": id_, "text": text}, ensure_ascii=False) + '\n')
+            os.replace(records + ".tmp", records)
+        # The index is written last: it decides how many records are valid
+        self.index.save(os.path.join(self.path, "index.npz"))
+
+    def search(self, query_string, top_n=3):
+        '''Search the index, the keywords of query_string are matched with the keywords of the documents'''
+        docs, scores = self.index.search(self._tokens(self.keyword_fn(query_string)), top_n)
+        return {
+            self.ids[doc]: {"text": self.texts[doc], "rank": i, "score": float(score)}
+            for i, (doc, score) in enumerate(zip(docs.tolist(), scores.tolist()))
+        }
+
+
+if "__main__" == __name__:
+    # Scoring speed on a synthetic Zipf corpus
+    # python bm25_utils.py [n_documents]
+    import sys
+    import time
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = np.random.default_rng(0)
+    words = np.array(["w%d" % i for i in range(50000)])
+    docs = [words[np.minimum(rng.zipf(1.3, 60), len(words)) - 1].tolist() for _ in range(n)]
+    start = time.time()
+    index = BM25Index()
+    index.build(docs)
+    print("build {} docs: {:.2f}s, {} terms, {} postings".format(n, time.time() - start, len(index.vocab), len(index.doc_ids)))
+    queries = [words[np.minimum(rng.zipf(1.3, 5), len(words)) - 1].tolist() for _ in range(200)]
+    start = time.time()
+    for q in queries:
+        index.search(q, 10)
+    print("search: {:.3f} ms/query".format((time.time() - start) * 1000 / len(queries)))
@@ -0,0 +1,183 @@
+# Function: 本地持久化缓存（sqlite 单文件，值压缩存储）
+# Used by pdf_utils.py and the RAG examples so that re-running ingestion on an unchanged corpus is a cheap lookup
+
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+import threading
+import zipfile
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+# Next to this module, not in the current working directory, so every script finds the same cache
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".rag_cache")
+DEFAULT_CACHE_PATH = os.path.join(CACHE_DIR, "cache.sqlite")
+
+
+def sha256_text(text):
+    '''sha256 of a string (utf-8)'''
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def sha256_file(filename, block_size=1 << 20):
+    '''sha256 of a file, read block by block'''
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def make_key(*parts):
+    '''Build a cache key from several parts (strings, numbers, lists, None)'''
+    return sha256_text(json.dumps(parts, ensure_ascii=False, sort_keys=True))
+
+
+def save_npz(filename, **arrays):
+    '''np.savez (uncompressed) to a temporary file, then replace the old file atomically'''
+    with open(filename + ".tmp", 'wb') as fp:
+        np.savez(fp, **arrays)
+    os.replace(filename + ".tmp", filename)
+
+
+def load_npz(filename, mmap_mode=None):
+    '''The arrays of a file written by save_npz, as a dict
+
+    With mmap_mode (e.g. 'r') the arrays are memory mapped from the file instead of read,
+    so opening a large index is instant and only the parts that are used are paged in.
+    '''
+    if mmap_mode is None:
+        with np.load(filename) as arrays:
+            return {name: arrays[name] for name in arrays.files}
+    arrays = {}
+    with zipfile.ZipFile(filename) as zf, open(filename, 'rb') as fp:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError("%s is compressed and cannot be memory mapped" % filename)
+            # The .npy member starts after its local file header, whose extra field may differ from the central one
+            fp.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', fp.read(4))
+            fp.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(fp)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(fp)
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(filename, dtype=dtype, mode=mmap_mode, offset=fp.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+    return arrays
+
+
+class SqliteCache:
+    '''Key-value cache stored in a single sqlite file, values are zlib compressed JSON'''
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, value BLOB, PRIMARY KEY (namespace, key))")
+        self.conn.commit()
+
+    @staticmethod
+    def _dumps(value):
+        return zlib.compress(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+    @staticmethod
+    def _loads(blob):
+        return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+    def get(self, namespace, key, default=None):
+        '''Read one value, return default if it is not cached'''
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM cache WHERE namespace=? AND key=?", (namespace, key)).fetchone()
+        return self._loads(row[0]) if row else default
+
+    def get_many(self, namespace, keys, batch_size=500):
+        '''Read several values, return a dict containing only the cached keys'''
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT key, value FROM cache WHERE namespace=? AND key IN (%s)" % ','.join('?' * len(batch)),
+                    [namespace] + batch).fetchall()
+            for key, blob in rows:
+                found[key] = self._loads(blob)
+        return found
+
+    def put(self, namespace, key, value):
+        '''Write one value'''
+        self.put_many(namespace, {key: value})
+
+    def put_many(self, namespace, items):
+        '''Write several values from a dict in one transaction'''
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cache (namespace, key, value) VALUES (?, ?, ?)",
+                [(namespace, key, self._dumps(value)) for key, value in items.items()])
+
+    def clear(self, namespace=None):
+        '''Delete one namespace, or everything'''
+        with self.lock, self.conn:
+            if namespace is None:
+                self.conn.execute("DELETE FROM cache")
+            else:
+                self.conn.execute("DELETE FROM cache WHERE namespace=?", (namespace,))
+
+    def close(self):
+        self.conn.close()
+
+
+class VectorCache(SqliteCache):
+    '''SqliteCache for vectors, values are stored as raw float32 bytes'''
+    @staticmethod
+    def _dumps(value):
+        return np.asarray(value, dtype=np.float32).tobytes()
+
+    @staticmethod
+    def _loads(blob):
+        return np.frombuffer(blob, dtype=np.float32)
+
+
+class LRUCache:
+    '''In-memory cache that keeps at most maxsize items, dropping the least recently used'''
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
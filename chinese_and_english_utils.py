@@ -3,39 +3,180 @@
 
 # !pip install jieba
 
+import os
 import re
-import nltk
-import jieba
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
+from concurrent.futures import ProcessPoolExecutor
 
+# nltk 和 jieba 在第一次用到时才导入，只用断句时不会加载它们
 # 首次需要科学上网运行下面这行代码下载停用词表
-# nltk.download('stopwords')  
+# import nltk; nltk.download('stopwords')
+
+# jieba 前缀词典的缓存目录，默认在系统临时目录，这里放到项目目录下，重启、清理临时文件后不用重新构建
+# 与 cache_utils.CACHE_DIR 相同，以本文件所在目录为准，不随当前工作目录变化
+JIEBA_CACHE_DIR = os.getenv('JIEBA_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.rag_cache', 'jieba'))
+
+# 中文分词前去掉英文、数字和中英文标点
+_CHINESE_CLEAN_RE = re.compile(r'[a-zA-Z0-9\.\,\!\?\;\:\(\)\。\，\！\？\；\：\（\）\'\"\‘\’\“\”]')
+# 英文分词前把所有非字母数字的字符替换为空格
+_ENGLISH_CLEAN_RE = re.compile(r'[^a-zA-Z0-9\s]')
+# 只剩字母数字和空白时，nltk.word_tokenize 等价于按空白切分再拆开 cannot、gonna 这几个词
+_ENGLISH_CONTRACTIONS_RE = re.compile(r'\b(can(?=not\b)|gim(?=me\b)|gon(?=na\b)|got(?=ta\b)|lem(?=me\b)|wan(?=na\b))', re.IGNORECASE)
+# 批量分词时文本之间的分隔符，jieba 会把它作为单独的词切出来
+_TEXT_SEP = '\x1e'
+
+def _jieba():
+    """导入 jieba 并设置词典缓存目录"""
+    import jieba
+    if jieba.dt.tmp_dir is None:
+        os.makedirs(JIEBA_CACHE_DIR, exist_ok=True)
+        jieba.dt.tmp_dir = JIEBA_CACHE_DIR
+    return jieba
+
+class KeywordExtractor:
+    """中英文关键词提取器，停用词表、正则和 jieba 词典只加载一次"""
+    def __init__(self, stop_words=None, user_dict=None):
+        # 加载中英文停用词表
+        if stop_words is None:
+            from nltk.corpus import stopwords
+            stop_words = set(stopwords.words('chinese')) | set(stopwords.words('english'))
+        self.stop_words = frozenset(stop_words)
+        # 加载 jieba 词典（有缓存时直接读缓存）
+        self.jieba = _jieba()
+        if user_dict:
+            self.jieba.load_userdict(user_dict)
+        self.jieba.initialize()
+
+    def _filter(self, chinese_tokens, input_string):
+        english_tokens = _ENGLISH_CONTRACTIONS_RE.sub(r'\1 ', _ENGLISH_CLEAN_RE.sub(' ', input_string)).split()
+        stop_words = self.stop_words
+        # 去除停用词
+        return ' '.join([w for w in chinese_tokens if not (w in stop_words or w == ' ')] +
+                        [w for w in english_tokens if w not in stop_words])
+
+    def to_keywords(self, input_string):
+        """将句子转成检索关键词序列"""
+        # 按搜索引擎模式分词
+        chinese_tokens = self.jieba.cut_for_search(_CHINESE_CLEAN_RE.sub(' ', input_string))
+        return self._filter(chinese_tokens, input_string)
+
+    def to_keywords_batch(self, texts, n_jobs=1, chunk_size=2000):
+        """批量提取关键词，n_jobs > 1 时用多进程"""
+        texts = list(texts)
+        if n_jobs != 1 and len(texts) > chunk_size:
+            chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(self.stop_words,)) as executor:
+                return [keywords for result in executor.map(_worker_to_keywords, chunks) for keywords in result]
+        if not texts:
+            return []
+        joined = _TEXT_SEP.join(_CHINESE_CLEAN_RE.sub(' ', text) for text in texts)
+        if joined.count(_TEXT_SEP) != len(texts) - 1:
+            # 文本里本身含有分隔符时逐条处理
+            return [self.to_keywords(text) for text in texts]
+        # 所有文本拼起来只调用一次 jieba，再按分隔符拆回各条
+        results = []
+        tokens = []
+        for w in self.jieba.cut_for_search(joined):
+            if w == _TEXT_SEP:
+                results.append(self._filter(tokens, texts[len(results)]))
+                tokens = []
+            else:
+                tokens.append(w)
+        results.append(self._filter(tokens, texts[len(results)]))
+        return results
+
+_worker_extractor = None
+
+def _init_worker(stop_words):
+    global _worker_extractor
+    _worker_extractor = KeywordExtractor(stop_words)
+
+def _worker_to_keywords(texts):
+    return _worker_extractor.to_keywords_batch(texts)
+
+_default_extractor = None
+
+def get_keyword_extractor():
+    """默认的关键词提取器（第一次使用时创建）"""
+    global _default_extractor
+    if _default_extractor is None:
+        _default_extractor = KeywordExtractor()
+    return _default_extractor
+
+def warmup():
+    """预热：加载停用词表和 jieba 词典并执行一次分词
+    在服务启动时（或 fork 工作进程之前）调用，第一个用户请求就不会有冷启动延迟"""
+    get_keyword_extractor().to_keywords("预热 warmup")
 
 def to_keywords(input_string):
     """将句子转成检索关键词序列"""
-    # 按搜索引擎模式分词
-        
-    chinese_tokens = jieba.cut_for_search(re.sub(r'[a-zA-Z0-9\.\,\!\?\;\:\(\)\。\，\！\？\；\：\（\）\'\"\‘\’\“\”]', ' ', input_string))
-    english_tokens = word_tokenize(re.sub(r'[^a-zA-Z0-9\s]', ' ', input_string))# 使用正则表达式替换所有非字母数字的字符为空格
-    word_tokens = list(chinese_tokens) + english_tokens
-    # word_tokens = list(chinese_tokens)
-    # 加载中英文停用词表
-    stop_words = set(stopwords.words('chinese')) | set(stopwords.words('english'))
-    # 去除停用词
-    filtered_sentence = [w for w in word_tokens if not (w in stop_words or w == ' ')]
-    return ' '.join(filtered_sentence)
+    return get_keyword_extractor().to_keywords(input_string)
+
+def to_keywords_batch(texts, n_jobs=1):
+    """批量将句子转成检索关键词序列"""
+    return get_keyword_extractor().to_keywords_batch(texts, n_jobs)
+
+# 句末标点：中文（全角）标点总是断句；英文标点后面必须是空白、结尾、右引号/括号或中文字符才断句，
+# 这样小数（3.14）、网址中间的点不会被切开。句末的右引号/括号跟着前一句
+_CLOSE = r'”’」』）)"\''
+# 英文缩写后的句点不断句：单个字母（J. Smith）、U.S./e.g. 这类字母加点的组合、常见缩写词
+_ABBREVIATIONS = ('mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'vs', 'etc', 'fig', 'figs', 'eq', 'eqs',
+                  'al', 'approx', 'inc', 'ltd', 'co', 'corp', 'dept', 'vol', 'pp', 'sec', 'ref', 'refs')
+# 后顾断言要求定宽，所以按长度分组；放在句点和其后的空白检查之后，只在候选句末处执行
+_NOT_ABBREVIATION = r'(?<!\b[a-z]\.)(?<![a-z]\.[a-z]\.)' + ''.join(
+    r'(?<!\b(?:%s)\.)' % '|'.join(a for a in _ABBREVIATIONS if len(a) == n)
+    for n in sorted(set(map(len, _ABBREVIATIONS))))
+_SENT_END_RE = re.compile(
+    r'(?:[。！？；…]+|[!?;]+(?=[\s%s]|$|[\u4e00-\u9fff])|\.+(?=[\s%s]|$|[\u4e00-\u9fff])%s)[%s]*'
+    % (_CLOSE, _CLOSE, _NOT_ABBREVIATION, _CLOSE), re.IGNORECASE)
+# 断句位置插入的标记，以及批量处理时段落之间的分隔符
+_SENT_MARK = '\x1f'
+_PARA_SEP = '\x1e'
 
 def sent_tokenize(input_string):
-    """按标点断句"""
-    # 按标点切分
-    sentences = re.split(r'(?<=[。！？；?!.;])', input_string)
+    """按标点断句（中英文混合）"""
+    # 在句末插入标记后切分，整个过程只有一次正则替换
+    sentences = _SENT_END_RE.sub('\\g<0>' + _SENT_MARK, input_string).split(_SENT_MARK)
     # 去掉空字符串
-    return [sentence.strip () for sentence in sentences if sentence.strip()]
+    return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+def sent_tokenize_batch(paragraphs):
+    """对一批段落断句，返回每个段落的句子列表"""
+    paragraphs = list(paragraphs)
+    if not paragraphs:
+        return []
+    text = _PARA_SEP.join(paragraphs)
+    if text.count(_PARA_SEP) != len(paragraphs) - 1 or _SENT_MARK in text:
+        # 文本里本身含有分隔符时逐段处理
+        return [sent_tokenize(p) for p in paragraphs]
+    # 所有段落拼起来做一次正则替换，再按分隔符拆回各段
+    marked = _SENT_END_RE.sub('\\g<0>' + _SENT_MARK, text).split(_PARA_SEP)
+    return [[sentence.strip() for sentence in p.split(_SENT_MARK) if sentence.strip()] for p in marked]
 
     
 if "__main__" == __name__:
+    # 预热后第一次提取关键词也很快
+    import time
+    start = time.time()
+    warmup()
+    print("warmup: {:.3f}s".format(time.time() - start))
     # 测试关键词提取
     print(to_keywords("小明硕士毕业于中国科学院计算所（Institute of Computing Technology, Chinese Academy of Sciences），后在日本京都大学（Kyoto University）深造。"))
     # 测试断句
-    print(sent_tokenize("这是，第一句。这是第二句吗？是的！一个是苹果；一个是桃子。英文的问号是?英文的感叹号是!英文的分号是;英文的句号是."))
\ No newline at end of file
+    print(sent_tokenize("这是，第一句。这是第二句吗？是的！一个是苹果；一个是桃子。英文的问号是?英文的感叹号是!英文的分号是;英文的句号是."))
+    print(sent_tokenize("Llama 2 has 70.5 billion parameters, e.g. the chat version. Dr. Smith said: “它可以商用。”It is trained on 2T tokens!"))
+
+    # 和原来的正则断句、NLTK 断句比较速度
+    texts = ["小明硕士毕业于中国科学院计算所。后在日本京都大学深造！Llama 2 has 70.5B parameters, e.g. the chat model. It is safe."] * 20000
+    start = time.time()
+    sent_tokenize_batch(texts)
+    print("sent_tokenize_batch: {:.3f}s".format(time.time() - start))
+    start = time.time()
+    [[s.strip() for s in re.split(r'(?<=[。！？；?!.;])', t) if s.strip()] for t in texts]
+    print("old regex split: {:.3f}s".format(time.time() - start))
+    try:
+        from nltk.tokenize import sent_tokenize as nltk_sent_tokenize
+        start = time.time()
+        [nltk_sent_tokenize(t) for t in texts]
+        print("nltk sent_tokenize: {:.3f}s".format(time.time() - start))
+    except LookupError:
+        print("nltk sent_tokenize: punkt not downloaded, nltk.download('punkt_tab')")
\ No newline at end of file
@@ -0,0 +1,249 @@
+# Function: Embedding 接口封装工具（持久化缓存、自动分批、并发请求）
+# Wraps the get_embeddings functions of the examples so that texts embedded before are not sent to the API again
+# and large corpora are embedded in concurrent, rate-limited batches
+
+import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from cache_utils import DEFAULT_CACHE_PATH, LRUCache, VectorCache, make_key, sha256_text
+
+
+_client = None
+
+
+def get_client():
+    '''OpenAI client shared by the helpers below, created on first use from the .env file'''
+    global _client
+    if _client is None:
+        from openai import OpenAI
+        from dotenv import load_dotenv, find_dotenv
+        _ = load_dotenv(find_dotenv())  # Read the local .env file, which defines OPENAI_API_KEY
+        _client = OpenAI()
+    return _client
+
+
+class Int8Vectors:
+    '''int8 quantized vectors with one float32 scale per vector: vector ~= values * scale'''
+    def __init__(self, values, scales):
+        self.values = values
+        self.scales = scales
+
+    def to_float32(self):
+        return self.values.astype(np.float32) * self.scales[:, None]
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.scales.nbytes
+
+
+def quantize(vectors, dtype="float32"):
+    '''Convert a (n, d) float matrix to float32, float16 or int8 (Int8Vectors, symmetric per-vector scale)'''
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "float32":
+        return np.ascontiguousarray(vectors)
+    if dtype == "float16":
+        return vectors.astype(np.float16)
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        values = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return Int8Vectors(values, scales.astype(np.float32))
+    raise ValueError("dtype must be float32, float16 or int8, got %r" % dtype)
+
+
+def get_embeddings_array(texts, model="text-embedding-3-small", dimensions=None, dtype="float32", client=None):
+    '''Encapsulate the Embedding model interface of OpenAI, returning one (n, d) numpy matrix
+
+    The vectors are requested base64 encoded and decoded straight into one contiguous
+    float32 array, without building a Python float list per vector.
+    '''
+    client = client or get_client()
+    if model == "text-embedding-ada-002":
+        dimensions = None
+    if dimensions:
+        data = client.embeddings.create(input=texts, model=model, dimensions=dimensions, encoding_format="base64").data
+    else:
+        data = client.embeddings.create(input=texts, model=model, encoding_format="base64").data
+    data = sorted(data, key=lambda x: x.index)
+    buffer = b''.join(base64.b64decode(x.embedding) for x in data)
+    vectors = np.frombuffer(buffer, dtype=np.float32).reshape(len(data), -1)
+    return quantize(vectors, dtype)
+
+
+class CachedEmbeddings:
+    '''Embedding function with a disk cache (sqlite, float32) and an in-memory LRU in front
+
+    Vectors are keyed by (provider, model, dimensions, sha256(text)), so only texts that were
+    never embedded with this model and size are sent to embedding_fn. embedding_fn must
+    return one vector per input text and must use the given model and dimensions, e.g.
+        embedding_fn = CachedEmbeddings(get_embeddings, provider="openai", model="text-embedding-3-small")
+    '''
+    def __init__(self, embedding_fn, provider="openai", model="text-embedding-3-small", dimensions=None,
+                 cache=None, memory_size=10000):
+        self.embedding_fn = embedding_fn
+        self.namespace = "embeddings:" + make_key(provider, model, dimensions)
+        self.cache = cache or VectorCache(DEFAULT_CACHE_PATH)
+        self.memory = LRUCache(memory_size)
+        self.hits = 0
+        self.misses = 0
+
+    def embed(self, texts):
+        '''Return the vectors of texts as float32 arrays, calling the API only for cache misses'''
+        keys = [sha256_text(text) for text in texts]
+        vectors = {}
+        for key in keys:
+            vec = self.memory.get(key)
+            if vec is not None:
+                vectors[key] = vec
+        missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+        if missing:
+            for key, vec in self.cache.get_many(self.namespace, missing).items():
+                vectors[key] = vec
+                self.memory.put(key, vec)
+        # Texts that are in neither cache, each distinct text is sent once
+        new_texts = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if new_texts:
+            new_vectors = {key: np.asarray(vec, dtype=np.float32)
+                           for key, vec in zip(new_texts, self.embedding_fn(list(new_texts.values())))}
+            self.cache.put_many(self.namespace, new_vectors)
+            for key, vec in new_vectors.items():
+                self.memory.put(key, vec)
+            vectors.update(new_vectors)
+        self.misses += len(new_texts)
+        self.hits += len(keys) - len(new_texts)
+        return [vectors[key] for key in keys]
+
+    def embed_array(self, texts, dtype="float32"):
+        '''Return the vectors of texts as one (n, d) matrix, see quantize() for dtype'''
+        vectors = self.embed(texts)
+        return quantize(np.stack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32), dtype)
+
+    def __call__(self, texts):
+        '''Same return type as the wrapped get_embeddings: a list of float lists'''
+        return [vec.tolist() for vec in self.embed(texts)]
+
+
+def utf8_length(text):
+    '''Upper bound of the token count of a text: a BPE token is at least one byte'''
+    return len(text.encode('utf-8'))
+
+
+def make_batches(lengths, max_batch_size=2048, max_batch_tokens=300000):
+    '''Split inputs with the given token lengths into (start, end) ranges within the per-request limits'''
+    batches = []
+    start = 0
+    tokens = 0
+    for i, n in enumerate(lengths):
+        if i > start and (i - start >= max_batch_size or tokens + n > max_batch_tokens):
+            batches.append((start, i))
+            start = i
+            tokens = 0
+        tokens += n
+    if start < len(lengths):
+        batches.append((start, len(lengths)))
+    return batches
+
+
+class RateLimiter:
+    '''Token bucket limiter for requests per minute and tokens per minute, shared by threads'''
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self.requests = requests_per_minute or 0
+        self.tokens = tokens_per_minute or 0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=0):
+        '''Block until one request with the given number of tokens is allowed'''
+        if self.tpm:
+            # A request larger than the whole bucket waits for a full bucket
+            tokens = min(tokens, self.tpm)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.updated
+                self.updated = now
+                wait = 0.0
+                if self.rpm:
+                    self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+                    wait = max(wait, (1 - self.requests) * 60 / self.rpm)
+                if self.tpm:
+                    self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+                    wait = max(wait, (tokens - self.tokens) * 60 / self.tpm)
+                if wait <= 0:
+                    if self.rpm:
+                        self.requests -= 1
+                    if self.tpm:
+                        self.tokens -= tokens
+                    return
+            time.sleep(wait)
+
+
+class BatchedEmbeddings:
+    '''Embedding function that splits the input into micro-batches and sends them concurrently
+
+    Each request has at most max_batch_size inputs and max_batch_tokens tokens. Tokens are
+    counted with length_fn, by default the utf-8 length, which is never below the real count
+    (pass text_split_utils.tiktoken_length() for exact counts). At most max_concurrency
+    requests are in flight, optionally limited by requests_per_minute / tokens_per_minute.
+    Failed requests are retried with exponential backoff. Results keep the input order and
+    last_stats reports the throughput of the last call.
+    '''
+    def __init__(self, embedding_fn, max_batch_size=2048, max_batch_tokens=300000, max_concurrency=4,
+                 requests_per_minute=None, tokens_per_minute=None, length_fn=utf8_length,
+                 max_retries=3, verbose=False):
+        self.embedding_fn = embedding_fn
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.length_fn = length_fn
+        self.max_retries = max_retries
+        self.verbose = verbose
+        self.last_stats = None
+
+    def _embed_batch(self, texts, tokens):
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(tokens)
+            try:
+                return self.embedding_fn(texts)
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(2 ** attempt)
+
+    def __call__(self, texts):
+        texts = list(texts)
+        start_time = time.time()
+        lengths = [self.length_fn(text) for text in texts]
+        batches = make_batches(lengths, self.max_batch_size, self.max_batch_tokens)
+        tasks = [(texts[a:b], sum(lengths[a:b])) for a, b in batches]
+        results = []
+        if len(tasks) <= 1 or self.max_concurrency == 1:
+            for batch, tokens in tasks:
+                results.extend(self._embed_batch(batch, tokens))
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                # map returns the batches in input order
+                for vectors in executor.map(lambda task: self._embed_batch(*task), tasks):
+                    results.extend(vectors)
+        seconds = time.time() - start_time
+        self.last_stats = {
+            "texts": len(texts),
+            "batches": len(batches),
+            "tokens": sum(lengths),
+            "seconds": seconds,
+            "texts_per_second": len(texts) / seconds if seconds > 0 else float('inf'),
+        }
+        if self.verbose:
+            print("Embedded {texts} texts in {batches} batches, {seconds:.2f}s, {texts_per_second:.1f} texts/s".format(
+                **self.last_stats))
+        return results
@@ -0,0 +1,159 @@
+# Function: 混合检索工具（多路检索、多查询检索并发执行，超时降级后融合排序）
+# Used by Example-4-9 so that hybrid latency is the slowest backend instead of the sum of all backends,
+# and by Example-4-12 so that the searches of generated queries overlap with their generation
+
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from rank_fusion_utils import rrf
+
+
+class HybridRetriever:
+    '''Run several retrievers concurrently and fuse their rankings
+
+    retrievers maps a name to a function (query, top_n) -> {id: {"text": ..., "rank": ...}},
+    e.g. {"keyword": es_connector.search, "vector": vector_search}. fuse_fn takes the list
+    of rankings that arrived, by default rrf of rank_fusion_utils. timeout is the time limit in seconds
+    for every retriever, or a dict with one limit per name (None: wait). A retriever that
+    raises or misses its limit is left out of the fusion, so a slow backend degrades the
+    result instead of failing it; last_stats records latencies and errors of the last search.
+    A retriever that timed out keeps running in its worker thread until it returns.
+    '''
+    def __init__(self, retrievers, fuse_fn=rrf, timeout=None, max_workers=None):
+        self.retrievers = dict(retrievers)
+        self.fuse_fn = fuse_fn
+        self.timeout = timeout
+        # Spare workers, so retrievers still running after a timeout do not block the next search
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or 2 * len(self.retrievers))
+        self.last_stats = None
+
+    def _timeout(self, name):
+        if isinstance(self.timeout, dict):
+            return self.timeout.get(name)
+        return self.timeout
+
+    @staticmethod
+    def _timed(fn, query, top_n):
+        start = time.monotonic()
+        result = fn(query, top_n)
+        return result, time.monotonic() - start
+
+    def retrieve(self, query, top_n=3):
+        '''Rankings of all retrievers that answered in time, {name: ranking}'''
+        start = time.monotonic()
+        futures = {name: self.executor.submit(self._timed, fn, query, top_n) for name, fn in self.retrievers.items()}
+        rankings, latencies, errors = {}, {}, {}
+        for name, future in futures.items():
+            timeout = self._timeout(name)
+            # Limits count from the start of the search, all retrievers run at the same time
+            remaining = None if timeout is None else max(0.0, start + timeout - time.monotonic())
+            try:
+                rankings[name], latencies[name] = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                future.cancel()
+                errors[name] = "timeout after %.3fs" % timeout
+            except Exception as e:
+                errors[name] = repr(e)
+        self.last_stats = {"seconds": time.monotonic() - start, "latencies": latencies, "errors": errors}
+        return rankings
+
+    def search(self, query, top_n=3):
+        '''Fused ranking of the retrievers that answered in time'''
+        return self.fuse_fn(list(self.retrieve(query, top_n).values()))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_lines(chunks):
+    '''Complete lines of a stream of text pieces (e.g. the deltas of a streamed completion), blank lines skipped'''
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            if line.strip():
+                yield line.strip()
+    if buffer.strip():
+        yield buffer.strip()
+
+
+class MultiQueryRetriever:
+    '''Search every query of a stream as soon as it arrives and fuse the rankings as they complete
+
+    search_fn is a function (query, top_n) -> {id: {"text": ..., "rank": ...}}, fuse_fn takes
+    the list of rankings, by default rrf of rank_fusion_utils. queries can be any iterable,
+    e.g. iter_lines() over a streamed completion: it is consumed in a background thread while
+    the searches of the queries already generated run on max_workers threads. A search that
+    raises is left out of the fusion and recorded in last_stats.
+    '''
+    def __init__(self, search_fn, fuse_fn=rrf, max_workers=4):
+        self.search_fn = search_fn
+        self.fuse_fn = fuse_fn
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.last_stats = None
+
+    def _produce(self, queries, top_n, done):
+        '''Submit the search of every query as soon as the iterator yields it'''
+        n = 0
+        try:
+            for query in queries:
+                future = self.executor.submit(self.search_fn, query, top_n)
+                future.add_done_callback(lambda f, i=n, q=query: done.put((i, q, f)))
+                n += 1
+            done.put(("end", n, None))
+        except Exception as e:
+            done.put(("end", n, e))
+
+    def iter_retrieve(self, queries, top_n=3):
+        '''Yield (query, ranking, fused ranking of all queries so far) as every search completes'''
+        start = time.monotonic()
+        done = queue.Queue()
+        threading.Thread(target=self._produce, args=(queries, top_n, done), daemon=True).start()
+        rankings = {}
+        errors = {}
+        n_queries = None
+        n_done = 0
+        generation_error = None
+        while n_queries is None or n_done < n_queries:
+            i, query, future = done.get()
+            if i == "end":
+                n_queries, generation_error = query, future
+                generation_seconds = time.monotonic() - start
+                continue
+            n_done += 1
+            try:
+                rankings[i] = future.result()
+            except Exception as e:
+                errors[query] = repr(e)
+                continue
+            # Fused in query order, so the result does not depend on which search finished first
+            yield query, rankings[i], self.fuse_fn([rankings[j] for j in sorted(rankings)])
+        self.last_stats = {"seconds": time.monotonic() - start, "generation_seconds": generation_seconds,
+                           "queries": n_queries, "errors": errors}
+        if generation_error is not None:
+            raise generation_error
+
+    def retrieve(self, queries, top_n=3):
+        '''Fused ranking of the searches of all queries'''
+        fused = self.fuse_fn([])
+        for _, _, fused in self.iter_retrieve(queries, top_n):
+            pass
+        return fused
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
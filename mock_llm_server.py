@@ -0,0 +1,160 @@
+# Function: 本地模拟 LLM 服务（OpenAI 兼容的 /v1/chat/completions 与 /v1/embeddings，可设定延迟）
+# Lets the async RAG pipeline be load tested with the real OpenAI client, without calling (and paying for) the API
+# python mock_llm_server.py [port] [delay_seconds]
+
+import asyncio
+import base64
+import hashlib
+import json
+import re
+import threading
+import time
+
+import numpy as np
+
+
+def mock_embedding(text, dim=256):
+    '''Deterministic bag-of-words vector: texts sharing words are similar, so retrieval stays meaningful'''
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in re.findall(r'\w+', text.lower()):
+        digest = hashlib.md5(word.encode('utf-8')).digest()
+        vector[int.from_bytes(digest[:4], 'little') % dim] += 1 if digest[4] & 1 else -1
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class MockLLMServer:
+    '''Minimal asyncio HTTP/1.1 server with keep-alive, answering like the OpenAI API
+
+    Chat completions wait delay seconds (like the generation of a real model) and answer
+    with a fixed text naming the question; with "stream": true the answer is sent as
+    server-sent events, first_token_delay after the request. Embeddings are mock_embedding
+    vectors, as float lists or base64 like the real API.
+    '''
+    def __init__(self, delay=0.5, first_token_delay=0.1, dim=256):
+        self.delay = delay
+        self.first_token_delay = first_token_delay
+        self.dim = dim
+        self.requests = 0
+
+    @staticmethod
+    def _last_line(prompt):
+        lines = [line for line in prompt.strip().splitlines() if line.strip()]
+        return lines[-1][:80] if lines else ""
+
+    def _completion(self, model, content, delta=False, finish=None):
+        choice = {"index": 0, "finish_reason": finish}
+        if delta:
+            choice["delta"] = {"role": "assistant", "content": content} if content is not None else {}
+        else:
+            choice["message"] = {"role": "assistant", "content": content}
+        return {"id": "chatcmpl-mock", "object": "chat.completion.chunk" if delta else "chat.completion",
+                "created": int(time.time()), "model": model, "choices": [choice],
+                "usage": None if delta else {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}}
+
+    async def _chat(self, body, writer):
+        model = body.get("model", "mock")
+        answer = "Mock answer to: " + self._last_line(body["messages"][-1]["content"])
+        if not body.get("stream"):
+            await asyncio.sleep(self.delay)
+            return self._completion(model, answer, finish="stop")
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        await asyncio.sleep(self.first_token_delay)
+        words = answer.split(' ')
+        events = [self._completion(model, w + ' ', delta=True) for w in words]
+        events.append(self._completion(model, None, delta=True, finish="stop"))
+        for i, event in enumerate(events):
+            if i:
+                await asyncio.sleep(max(self.delay - self.first_token_delay, 0) / len(events))
+            self._write_chunk(writer, ("data: " + json.dumps(event) + "\n\n").encode('utf-8'))
+            await writer.drain()
+        self._write_chunk(writer, b"data: [DONE]\n\n")
+        self._write_chunk(writer, b"")
+        await writer.drain()
+        return None
+
+    @staticmethod
+    def _write_chunk(writer, data):
+        writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def _embeddings(self, body):
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        data = []
+        for i, text in enumerate(inputs):
+            vector = mock_embedding(text, self.dim)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.astype(np.float32).tobytes()).decode('ascii')
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        return {"object": "list", "data": data, "model": body.get("model", "mock"),
+                "usage": {"prompt_tokens": 0, "total_tokens": 0}}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                self.requests += 1
+                path = request_line.split()[1].decode('latin-1').split('?')[0]
+                if path.endswith("/chat/completions"):
+                    response = await self._chat(json.loads(body), writer)
+                    if response is None:
+                        continue
+                    status = b"200 OK"
+                elif path.endswith("/embeddings"):
+                    response, status = self._embeddings(json.loads(body)), b"200 OK"
+                else:
+                    response, status = {"error": {"message": "not found: " + path}}, b"404 Not Found"
+                payload = json.dumps(response).encode('utf-8')
+                writer.write(b"HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s"
+                             % (status, len(payload), payload))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=0):
+        '''Start serving, returns the asyncio server (port 0 picks a free port)'''
+        return await asyncio.start_server(self.handle, host, port, backlog=4096)
+
+    def start_in_thread(self, host="127.0.0.1", port=0):
+        '''Serve on an event loop of its own in a daemon thread, returns the base_url for OpenAI(base_url=...)'''
+        started = threading.Event()
+        address = {}
+
+        def run():
+            loop = asyncio.new_event_loop()
+            server = loop.run_until_complete(self.start(host, port))
+            address["port"] = server.sockets[0].getsockname()[1]
+            started.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+        return "http://%s:%d/v1" % (host, address["port"])
+
+
+if "__main__" == __name__:
+    import sys
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8001
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+
+    async def main():
+        server = await MockLLMServer(delay).start("127.0.0.1", port)
+        print("Mock OpenAI API on http://127.0.0.1:%d/v1 (delay %.2fs)" % (port, delay))
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
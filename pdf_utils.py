@@ -0,0 +1,188 @@
+# Function: PDF 文本流式提取工具（按页解析、多进程并行、按内容缓存）
+# Shared by the RAG examples (Example-4-*) instead of each script copying extract_text_from_pdf
+
+# !pip install pdfminer.six
+
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+from pdfminer.high_level import extract_pages
+from pdfminer.layout import LTTextContainer
+from pdfminer.pdftypes import PDFObjRef, PDFStream, resolve1
+from pdfminer.pdfpage import PDFPage
+
+from cache_utils import SqliteCache, make_key, sha256_file
+
+_cache = None
+
+
+def get_cache():
+    '''SqliteCache shared by the calls of cached_extract_text_from_pdf, opened on first use'''
+    global _cache
+    if _cache is None:
+        _cache = SqliteCache()
+    return _cache
+
+
+def count_pdf_pages(filename):
+    '''Count the pages of a PDF file without running layout analysis'''
+    with open(filename, 'rb') as fp:
+        return sum(1 for _ in PDFPage.get_pages(fp))
+
+
+def _object_digest(obj, digests):
+    '''sha256 of a PDF object and everything it references (fonts, ToUnicode CMaps, images), memoized by object id'''
+    if isinstance(obj, PDFObjRef):
+        if obj.objid not in digests:
+            digests[obj.objid] = b''  # A reference cycle hashes to the empty digest
+            digests[obj.objid] = _object_digest(obj.resolve(), digests)
+        return digests[obj.objid]
+    h = hashlib.sha256()
+    if isinstance(obj, PDFStream):
+        h.update(_object_digest(obj.attrs, digests))
+        data = obj.get_rawdata()
+        h.update(obj.get_data() if data is None else data)
+    elif isinstance(obj, dict):
+        for key in sorted(obj, key=str):
+            h.update(repr(key).encode('utf-8'))
+            h.update(_object_digest(obj[key], digests))
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'[')
+        for item in obj:
+            h.update(_object_digest(item, digests))
+        h.update(b']')
+    else:
+        h.update(repr(obj).encode('utf-8'))
+    return h.digest()
+
+
+def page_fingerprints(filename):
+    '''sha256 of the content streams and resources of every page, a page whose text changed gets a new fingerprint
+
+    The resources (fonts with their encodings and ToUnicode CMaps) are part of the
+    fingerprint: the same content stream shows a different text with other fonts.
+    '''
+    fingerprints = []
+    digests = {}  # Resources shared by several pages are hashed once
+    with open(filename, 'rb') as fp:
+        for page in PDFPage.get_pages(fp):
+            h = hashlib.sha256()
+            h.update(repr((page.mediabox, page.rotate)).encode('utf-8'))
+            h.update(_object_digest(page.resources, digests))
+            for stream in page.contents:
+                h.update(resolve1(stream).get_data())
+            fingerprints.append(h.hexdigest())
+    return fingerprints
+
+
+def _extract_page_texts(filename, page_numbers):
+    '''Return the texts of the given pages in page order, one list of text container texts per page'''
+    pages = []
+    # page_numbers lets pdfminer skip the layout analysis of all other pages
+    for page_layout in extract_pages(filename, page_numbers=page_numbers):
+        pages.append([element.get_text() + '\n'
+                      for element in page_layout if isinstance(element, LTTextContainer)])
+    return pages
+
+
+def _normalize_page_numbers(page_numbers, n_pages):
+    '''Same semantics as the serial path: document order, each page once'''
+    if page_numbers is None:
+        return list(range(n_pages))
+    return sorted(i for i in set(page_numbers) if 0 <= i < n_pages)
+
+
+def _iter_pages(filename, page_numbers=None, max_workers=1, pages_per_task=16, n_pages=None):
+    '''Yield the text list of every selected page, optionally using a process pool'''
+    if max_workers == 1:
+        yield from _extract_page_texts(filename, page_numbers)
+        return
+    if n_pages is None:
+        n_pages = count_pdf_pages(filename)
+    pages = _normalize_page_numbers(page_numbers, n_pages)
+    tasks = [pages[i:i + pages_per_task] for i in range(0, len(pages), pages_per_task)]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # map keeps the task order, so paragraphs come out in document order
+        for page_texts in executor.map(_extract_page_texts, [filename] * len(tasks), tasks):
+            yield from page_texts
+
+
+def iter_paragraphs(texts, min_line_length=1):
+    '''Join a stream of text pieces into paragraphs separated by short (blank) lines'''
+    buffer = []
+    pending = ''
+    for piece in texts:
+        lines = (pending + piece).split('\n')
+        # The last element is an unfinished line, keep it for the next piece
+        pending = lines.pop()
+        for text in lines:
+            if len(text) >= min_line_length:
+                # Lines ending with a hyphen are merged with the next line without a space
+                # (a line of hyphens only adds nothing, so it does not start a paragraph)
+                text = (' ' + text) if not text.endswith('-') else text.strip('-')
+                if text:
+                    buffer.append(text)
+            elif buffer:
+                yield ''.join(buffer)
+                buffer = []
+    # Handle the last line in the same way as the others
+    if len(pending) >= min_line_length:
+        pending = (' ' + pending) if not pending.endswith('-') else pending.strip('-')
+        if pending:
+            buffer.append(pending)
+    elif buffer:
+        yield ''.join(buffer)
+        buffer = []
+    if buffer:
+        yield ''.join(buffer)
+
+
+def iter_text_from_pdf(filename, page_numbers=None, min_line_length=1, max_workers=1, pages_per_task=16):
+    '''Extract paragraphs from a PDF file (by specified page number) as a generator
+
+    max_workers > 1 parses pages in a process pool (None means one worker per CPU).
+    When using the pool from a script, put the call under if __name__ == "__main__":
+    '''
+    pages = _iter_pages(filename, page_numbers, max_workers, pages_per_task)
+    return iter_paragraphs((text for texts in pages for text in texts), min_line_length)
+
+
+def extract_text_from_pdf(filename, page_numbers=None, min_line_length=1, max_workers=1):
+    '''Extract text from a PDF file (by specified page number)'''
+    return list(iter_text_from_pdf(filename, page_numbers, min_line_length, max_workers))
+
+
+def cached_extract_text_from_pdf(filename, page_numbers=None, min_line_length=1, max_workers=1, cache=None):
+    '''Same as extract_text_from_pdf, but the result is cached on disk by content
+
+    An unchanged file (same sha256, pages and min_line_length) is a single lookup.
+    For a changed file only the pages whose content streams changed are parsed again.
+    '''
+    cache = cache or get_cache()
+    page_key = None if page_numbers is None else sorted(set(page_numbers))
+    doc_key = make_key(sha256_file(filename), page_key, min_line_length)
+    paragraphs = cache.get("pdf_paragraphs", doc_key)
+    if paragraphs is not None:
+        return paragraphs
+
+    fingerprints = page_fingerprints(filename)
+    pages = _normalize_page_numbers(page_numbers, len(fingerprints))
+    page_texts = cache.get_many("pdf_pages", [fingerprints[i] for i in pages])
+    missing = [i for i in pages if fingerprints[i] not in page_texts]
+    if missing:
+        parsed = _iter_pages(filename, missing, max_workers, n_pages=len(fingerprints))
+        new_texts = {fingerprints[i]: texts for i, texts in zip(missing, parsed)}
+        cache.put_many("pdf_pages", new_texts)
+        page_texts.update(new_texts)
+
+    texts = (text for i in pages for text in page_texts[fingerprints[i]])
+    paragraphs = list(iter_paragraphs(texts, min_line_length))
+    cache.put("pdf_paragraphs", doc_key, paragraphs)
+    return paragraphs
+
+
+if "__main__" == __name__:
+    import sys
+    # python pdf_utils.py llama2.pdf
+    for para in iter_text_from_pdf(sys.argv[1] if len(sys.argv) > 1 else "llama2.pdf", min_line_length=10, max_workers=None):
+        print(para + "\n")
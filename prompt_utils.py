@@ -0,0 +1,105 @@
+# Function: Prompt 组装工具（去掉检索结果之间重叠的句子，按得分把检索结果装进 token 预算）
+# Shared by Example-4-7 / 4-8 / 4-12 instead of each script joining every retrieved chunk into the prompt
+
+from functools import lru_cache
+
+from chinese_and_english_utils import sent_tokenize_batch
+from text_split_utils import tiktoken_length
+
+DEFAULT_CONTEXT_BUDGET = 2000  # Tokens of retrieved text per prompt
+
+
+@lru_cache(maxsize=None)
+def default_length_fn():
+    '''tiktoken_length() of gpt-3.5-turbo, or len when tiktoken is not installed or its encoding cannot be loaded
+
+    tiktoken downloads the encoding on first use; without network the budget is counted
+    in characters instead, so the prompts are still built.
+    '''
+    try:
+        return tiktoken_length("gpt-3.5-turbo")
+    except Exception:
+        return len
+
+
+def pack_context(chunks, budget=DEFAULT_CONTEXT_BUDGET, scores=None, length_fn=None, tokenize_batch=sent_tokenize_batch):
+    '''The best chunks that fit into budget tokens, without the sentences of better chunks
+
+    chunks are taken by descending score (by their order if scores is None). The sentences
+    of a chunk that a better chunk already contains (the overlap of split_text) are
+    dropped, so each sentence is paid for once. A chunk that does not fit whole
+    contributes its leading sentences that still fit. Tokens are counted with length_fn,
+    by default default_length_fn() (tiktoken counts are cached per sentence).
+    Returns the packed chunks, best first.
+    '''
+    length_fn = length_fn or default_length_fn()
+    order = list(range(len(chunks)))
+    if scores is not None:
+        order.sort(key=lambda i: -scores[i])
+    seen = set()
+    packed = []
+    used = 0
+    for i, sentences in zip(order, tokenize_batch([chunks[i] for i in order])):
+        # Sentences are compared with their whitespace collapsed, a chunk boundary may change the spacing
+        new = {}
+        for sentence in sentences:
+            key = ' '.join(sentence.split())
+            if key and key not in seen and key not in new:
+                new[key] = sentence.strip()
+        if not new:
+            continue
+        kept = []
+        # The blank line between two chunks costs about one token
+        cost = 1 if packed else 0
+        for key, sentence in new.items():
+            n = length_fn(sentence)
+            if used + cost + n > budget:
+                break
+            kept.append(key)
+            cost += n
+        if not kept:
+            continue
+        seen.update(kept)
+        used += cost
+        packed.append(chunks[i].strip() if len(kept) == len(sentences) else ' '.join(new[key] for key in kept))
+    return packed
+
+
+def build_prompt(prompt_template, budget=DEFAULT_CONTEXT_BUDGET, scores=None, length_fn=None, **kwargs):
+    '''Assign values to the Prompt template
+
+    A list of strings (e.g. info=the retrieved chunks) is packed into budget tokens with
+    pack_context, then joined with two newline characters; budget=None keeps all of them,
+    like the build_prompt of the examples.
+    '''
+    inputs = {}
+    for k, v in kwargs.items():
+        if isinstance(v, list) and all(isinstance(elem, str) for elem in v):
+            if budget is not None:
+                v = pack_context(v, budget, scores, length_fn)
+            inputs[k] = '\n\n'.join(v)
+        else:
+            inputs[k] = v
+    return prompt_template.format(**inputs)
+
+
+if "__main__" == __name__:
+    # Prompt size of top 5 overlapping chunks, joined as in the examples and packed
+    # python prompt_utils.py [budget]
+    import sys
+    from text_split_utils import split_text
+
+    length_fn = default_length_fn()
+    unit = "characters" if length_fn is len else "tokens"
+    budget = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    text = ["Llama 2 is a collection of pretrained and fine-tuned large language models. "
+            "The models range in scale from 7 billion to 70 billion parameters. "
+            "Our fine-tuned LLMs, called Llama 2-Chat, are optimized for dialogue use cases. "
+            "Our models outperform open-source chat models on most benchmarks we tested. "
+            "Based on our human evaluations for helpfulness and safety, they may be a suitable substitute for closed-source models. "
+            "We provide a detailed description of our approach to fine-tuning and safety improvements of Llama 2-Chat."]
+    chunks = split_text(text, chunk_size=200, overlap_size=100)[:5]
+    joined = '\n\n'.join(chunks)
+    packed = '\n\n'.join(pack_context(chunks, budget, length_fn=length_fn))
+    print("{} chunks  joined: {} {}  packed (budget {}): {} {}".format(
+        len(chunks), length_fn(joined), unit, budget, length_fn(packed), unit))
@@ -0,0 +1,124 @@
+# Function: 异步 RAG 流水线压测（本地模拟 LLM 服务，统计吞吐量、延迟分位数与各阶段耗时）
+# Runs AsyncRAGPipeline with the real OpenAI clients against mock_llm_server, so no API key is needed
+# python rag_load_test.py [n_questions] [concurrency] [llm_delay] [max_concurrency]
+
+import asyncio
+import re
+import sys
+import tempfile
+import time
+
+import numpy as np
+from openai import AsyncOpenAI, OpenAI
+
+from async_rag_utils import AsyncRAGPipeline, Overloaded, async_completion_fn
+from bm25_utils import LocalBM25Connector
+from embedding_utils import get_embeddings_array, utf8_length
+from mock_llm_server import MockLLMServer
+from vector_db_utils import LocalVectorDBConnector
+
+PROMPT_TEMPLATE = """
+你是一个问答机器人。
+你的任务是根据下述给定的已知信息回答用户问题。
+
+已知信息:
+{info}
+
+用户问：
+{query}
+
+如果已知信息不包含用户问题的答案，或者已知信息不足以回答用户的问题，请直接回复"我无法回答您的问题"。
+请不要输出已知信息中不包含的信息或答案。
+请用中文回答用户问题。
+"""
+
+TOPICS = ["llama", "pretraining", "fine-tuning", "safety", "reward model", "context length", "tokenizer",
+          "attention", "evaluation", "benchmark", "dialogue", "parameters", "training data", "red teaming"]
+
+
+def make_corpus(n, rng):
+    '''n synthetic paragraphs, each about two of TOPICS'''
+    words = ["model", "results", "human", "chat", "data", "scale", "performance", "method", "tokens", "study"]
+    corpus = []
+    for i in range(n):
+        a, b = rng.choice(len(TOPICS), 2, replace=False)
+        filler = ' '.join(rng.choice(words, 12))
+        corpus.append("Paragraph %d discusses %s and %s. The %s %s. %s is compared with %s."
+                      % (i, TOPICS[a], TOPICS[b], TOPICS[a], filler, TOPICS[b], TOPICS[a]))
+    return corpus
+
+
+def keyword_fn(text):
+    # Plain words instead of to_keywords, which needs the nltk stop words download
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+
+async def run_users(pipeline, questions, concurrency):
+    '''concurrency users, each sending its next question as soon as the previous one is answered'''
+    pending = iter(questions)
+    latencies = []
+    rejected = 0
+    failed = 0
+
+    async def user():
+        nonlocal rejected, failed
+        for question in pending:
+            start = time.monotonic()
+            try:
+                await pipeline.answer(question)
+            except Overloaded:
+                rejected += 1
+                continue
+            except Exception:
+                failed += 1
+                continue
+            latencies.append(time.monotonic() - start)
+
+    start = time.monotonic()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    return time.monotonic() - start, latencies, rejected, failed
+
+
+def main():
+    n_questions = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    llm_delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+    max_concurrency = int(sys.argv[4]) if len(sys.argv) > 4 else 256
+
+    base_url = MockLLMServer(delay=llm_delay).start_in_thread()
+    client = OpenAI(base_url=base_url, api_key="mock")
+    rng = np.random.default_rng(0)
+    corpus = make_corpus(2000, rng)
+    questions = ["How does %s relate to %s?" % tuple(rng.choice(TOPICS, 2, replace=False)) for _ in range(n_questions)]
+
+    with tempfile.TemporaryDirectory() as path:
+        vector_db = LocalVectorDBConnector("load_test", lambda texts: get_embeddings_array(texts, client=client), path=path)
+        vector_db.add_documents(corpus)
+        keyword_db = LocalBM25Connector(keyword_fn)
+        keyword_db.add_documents(corpus)
+
+        async def load_test():
+            llm_fn = async_completion_fn(client=AsyncOpenAI(base_url=base_url, api_key="mock"))
+            # Prompt size is bounded in UTF-8 bytes, tiktoken would download its encoding
+            async with AsyncRAGPipeline(vector_db, llm_fn, PROMPT_TEMPLATE, keyword_db=keyword_db,
+                                        max_concurrency=max_concurrency, max_pending=max_concurrency,
+                                        length_fn=utf8_length) as pipeline:
+                return await run_users(pipeline, questions, concurrency), pipeline.stats()
+
+        (seconds, latencies, rejected, failed), stats = asyncio.run(load_test())
+
+    print("{} questions, {} concurrent users, LLM delay {:.2f}s, max_concurrency {}".format(
+        n_questions, concurrency, llm_delay, max_concurrency))
+    print("answered {}, rejected {}, failed {} in {:.2f}s: {:.1f} questions/s (one at a time: ~{:.0f}s)".format(
+        len(latencies), rejected, failed, seconds, len(latencies) / seconds, n_questions * llm_delay))
+    if latencies:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print("latency p50 {:.3f}s  p95 {:.3f}s  p99 {:.3f}s".format(p50, p95, p99))
+    for stage in ("queue", "retrieve", "rerank", "llm", "total"):
+        if stage in stats:
+            print("{:>9}  p50 {:.4f}s  p95 {:.4f}s  max {:.4f}s".format(
+                stage, stats[stage]["p50"], stats[stage]["p95"], stats[stage]["max"]))
+
+
+if "__main__" == __name__:
+    main()
@@ -0,0 +1,168 @@
+# Function: 多路检索结果融合排序（RRF、加权得分、CombSUM/CombMNZ、归一化线性融合）
+# Shared by Example-4-9 / 4-12 and hybrid_search_utils instead of one dict-looping rrf() per example
+
+from itertools import chain
+from operator import itemgetter
+
+import numpy as np
+
+METHODS = ("rrf", "weighted", "combsum", "combmnz", "linear")
+
+
+def _normalize_scores(scores, lists, n_lists, lengths, normalization):
+    '''Normalize the scores of every list separately, scores of all lists concatenated'''
+    if normalization is None:
+        return scores
+    if normalization == "minmax":
+        starts = np.cumsum(lengths) - lengths
+        present = lengths > 0
+        lo, hi = np.zeros(n_lists), np.zeros(n_lists)
+        lo[present] = np.minimum.reduceat(scores, starts[present])
+        hi[present] = np.maximum.reduceat(scores, starts[present])
+        span = (hi - lo)[lists]
+        # A list whose scores are all equal gives every result 1
+        return np.where(span > 0, (scores - lo[lists]) / np.where(span > 0, span, 1), 1.0)
+    if normalization == "zscore":
+        counts = np.maximum(lengths, 1)
+        mean = np.bincount(lists, weights=scores, minlength=n_lists) / counts
+        std = np.sqrt(np.bincount(lists, weights=(scores - mean[lists]) ** 2, minlength=n_lists) / counts)[lists]
+        return np.where(std > 0, (scores - mean[lists]) / np.where(std > 0, std, 1), 0.0)
+    raise ValueError("unknown normalization: %r" % (normalization,))
+
+
+def fuse(id_lists, score_lists=None, method="rrf", k=60, weights=None, normalization="minmax", top_n=None,
+         rank_lists=None):
+    '''Fuse the results of several retrievers, returns (ids, scores) by descending fused score
+
+    id_lists holds the result ids of every retriever, best first; score_lists their scores
+    (higher is better, e.g. BM25 scores or negated distances), needed by every method but rrf.
+    rrf uses the positions in id_lists as ranks, or rank_lists when given.
+    weights gives one weight per retriever (default 1). The methods:
+
+      rrf       sum of weight / (k + rank), rank counted from 0 as the "rank" of the connectors
+      weighted  sum of weight * score, for retrievers whose scores share one scale
+      combsum   sum of weight * normalized score
+      combmnz   combsum times the number of retrievers that returned the document
+      linear    combsum with the weights scaled to sum to 1
+
+    normalization is "minmax", "zscore" or None, applied to the scores of every retriever.
+    All lists are concatenated and accumulated with one bincount, and only the top_n
+    best are sorted. Ties keep the order in which the ids first appear.
+    '''
+    if method not in METHODS:
+        raise ValueError("unknown fusion method: %r, expected one of %s" % (method, ", ".join(METHODS)))
+    n_lists = len(id_lists)
+    lengths = np.array([len(ids) for ids in id_lists], dtype=np.int64)
+    if not lengths.sum():
+        return [], np.zeros(0)
+    weights = np.ones(n_lists) if weights is None else np.asarray(weights, dtype=np.float64)
+    if len(weights) != n_lists:
+        raise ValueError("expected %d weights, got %d" % (n_lists, len(weights)))
+    if method == "linear":
+        weights = weights / weights.sum()
+    lists = np.repeat(np.arange(n_lists), lengths)
+    # Ids of all retrievers mapped to one integer per distinct document, numbered in order of first appearance
+    uniq = list(dict.fromkeys(chain.from_iterable(id_lists)))
+    numbers = {id_: i for i, id_ in enumerate(uniq)}
+    inverse = np.fromiter(map(numbers.__getitem__, chain.from_iterable(id_lists)), dtype=np.int64, count=lengths.sum())
+    if method == "rrf":
+        if rank_lists is None:
+            ranks = np.arange(len(inverse)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        else:
+            ranks = np.concatenate([np.asarray(r, dtype=np.float64) for r in rank_lists] + [np.zeros(0)])
+        contributions = weights[lists] / (k + ranks)
+    else:
+        if score_lists is None or [len(s) for s in score_lists] != lengths.tolist():
+            raise ValueError("method %r needs one score per result id" % method)
+        scores = np.concatenate([np.asarray(s, dtype=np.float64) for s in score_lists if len(s)])
+        if method != "weighted":
+            scores = _normalize_scores(scores, lists, n_lists, lengths, normalization)
+        contributions = weights[lists] * scores
+    fused = np.bincount(inverse, weights=contributions, minlength=len(uniq))
+    if method == "combmnz":
+        fused *= np.bincount(inverse, minlength=len(uniq))
+    if top_n is not None and top_n < len(fused):
+        if top_n <= 0:
+            return [], np.zeros(0)
+        # Keep every document scoring at least the top_n-th score, so ties are cut in order of appearance
+        kth = np.partition(fused, len(fused) - top_n)[len(fused) - top_n]
+        best = np.flatnonzero(fused >= kth)
+    else:
+        best = np.arange(len(fused))
+    # Stable sort: among equal scores the lower number, i.e. the earlier id, comes first
+    order = best[np.argsort(-fused[best], kind='stable')][:top_n]
+    return [uniq[i] for i in order.tolist()], fused[order]
+
+
+def fuse_rankings(rankings, method="rrf", k=60, weights=None, normalization="minmax", top_n=None):
+    '''fuse() for the rankings of the connectors, {id: {"text": ..., "rank": ...[, "score": ...]}}
+
+    rrf uses the "rank" of every result, the other methods its "score". Returns
+    {id: {"score": ..., "text": ...}} in descending order of the fused score.
+    '''
+    id_lists = [list(ranking) for ranking in rankings]
+    rank_lists = score_lists = None
+    if method == "rrf":
+        rank_lists = [np.fromiter(map(itemgetter("rank"), ranking.values()), dtype=np.float64, count=len(ranking))
+                      for ranking in rankings]
+    else:
+        try:
+            score_lists = [np.fromiter(map(itemgetter("score"), ranking.values()), dtype=np.float64, count=len(ranking))
+                           for ranking in rankings]
+        except KeyError:
+            raise ValueError("method %r needs a \"score\" in every result" % method) from None
+    ids, scores = fuse(id_lists, score_lists, method, k, weights, normalization, top_n, rank_lists)
+    # The text of every id from the first ranking that returned it: later rankings are applied first
+    texts = {}
+    for ranking in reversed(rankings):
+        texts.update(zip(ranking, map(itemgetter("text"), ranking.values())))
+    return {id_: {"score": score, "text": texts[id_]} for id_, score in zip(ids, scores.tolist())}
+
+
+def rrf(rankings, k=60, weights=None, top_n=None):
+    '''Reciprocal rank fusion of the rankings of the connectors, k=1 is the rrf() of Example-4-9'''
+    return fuse_rankings(rankings, "rrf", k, weights, top_n=top_n)
+
+
+if "__main__" == __name__:
+    # Fusing 10 lists of 1000 candidates: the dict loop of Example-4-9 against fuse_rankings
+    # python rank_fusion_utils.py [n_lists] [n_candidates]
+    import sys
+    import time
+
+    def rrf_loop(ranks, k=1):
+        ret = {}
+        for rank in ranks:
+            for id, val in rank.items():
+                if id not in ret:
+                    ret[id] = {"score": 0, "text": val["text"]}
+                ret[id]["score"] += 1.0/(k+val["rank"])
+        return dict(sorted(ret.items(), key=lambda item: item[1]["score"], reverse=True))
+
+    n_lists = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    n_candidates = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    rng = np.random.default_rng(0)
+    rankings = [
+        {"doc_%d" % d: {"text": "text %d" % d, "rank": i} for i, d in enumerate(rng.choice(5 * n_candidates, n_candidates, replace=False))}
+        for _ in range(n_lists)
+    ]
+    start = time.time()
+    for _ in range(20):
+        expected = rrf_loop(rankings)
+    loop_time = (time.time() - start) / 20
+    start = time.time()
+    for _ in range(20):
+        fused = rrf(rankings, k=1)
+    fuse_time = (time.time() - start) / 20
+    assert list(fused)[:100] == list(expected)[:100]
+    start = time.time()
+    for _ in range(20):
+        rrf(rankings, k=1, top_n=10)
+    top_time = (time.time() - start) / 20
+    id_lists = [list(r) for r in rankings]
+    start = time.time()
+    for _ in range(20):
+        fuse(id_lists, k=1, top_n=10)
+    array_time = (time.time() - start) / 20
+    print("{} lists x {} candidates  loop: {:.2f} ms  rrf: {:.2f} ms  top 10: {:.2f} ms  id arrays: {:.2f} ms".format(
+        n_lists, n_candidates, loop_time * 1000, fuse_time * 1000, top_time * 1000, array_time * 1000))
@@ -0,0 +1,256 @@
+# Function: 交叉编码器重排序服务（模型只加载一次、跨请求动态批处理、截断与打分缓存）
+# Used by Example-4-8 instead of loading a CrossEncoder and calling predict on every request
+
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from functools import lru_cache
+
+import numpy as np
+
+from cache_utils import DEFAULT_CACHE_PATH, LRUCache, SqliteCache, make_key, sha256_text
+
+DEFAULT_RERANK_MODEL = 'BAAI/bge-reranker-large'
+# English MiniLM of the examples, small enough to rerank 50 candidates on CPU in tens of milliseconds
+CPU_RERANK_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+
+# Ends of sentences where a truncated document is preferably cut
+SENTENCE_ENDS = ('。', '！', '？', '；', '. ', '! ', '? ', '\n')
+
+
+@lru_cache(maxsize=None)
+def _load_cross_encoder(model_name, max_length, device, quantize, num_threads):
+    from sentence_transformers import CrossEncoder
+    import torch
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    model = CrossEncoder(model_name, max_length=max_length, device=device)
+    if quantize:
+        # int8 weights for the Linear layers, the bulk of the compute of a transformer on CPU
+        model.model = torch.quantization.quantize_dynamic(model.model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.model.eval()
+    return model
+
+
+def load_cross_encoder(model_name=DEFAULT_RERANK_MODEL, max_length=512, device=None, quantize=None, num_threads=None):
+    '''CrossEncoder loaded once per process for the same settings
+
+    quantize=None quantizes the model to int8 (torch dynamic quantization) when it runs on CPU.
+    '''
+    if quantize is None:
+        import torch
+        quantize = (device or ("cuda" if torch.cuda.is_available() else "cpu")) == "cpu"
+    return _load_cross_encoder(model_name, max_length, device, bool(quantize), num_threads)
+
+
+def truncate_pairs(tokenizer, query, documents, max_length=512, max_query_tokens=64):
+    '''Fit (query, document) pairs into max_length tokens, returns (pairs, token lengths)
+
+    The query is kept whole up to max_query_tokens and the documents get the rest of the
+    budget, instead of the tokenizer cutting both sides of the pair. A document is cut at the
+    last sentence end of its kept part when that keeps at least 80% of it. Needs a fast
+    (offset mapping) tokenizer.
+    '''
+    query_offsets = tokenizer(query, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    if len(query_offsets) > max_query_tokens:
+        query = query[:query_offsets[max_query_tokens - 1][1]]
+        query_offsets = query_offsets[:max_query_tokens]
+    overhead = len(query_offsets) + tokenizer.num_special_tokens_to_add(pair=True)
+    budget = max(max_length - overhead, 1)
+    pairs, lengths = [], []
+    for doc, offsets in zip(documents, tokenizer(list(documents), add_special_tokens=False,
+                                                 return_offsets_mapping=True)["offset_mapping"]):
+        if len(offsets) > budget:
+            end = offsets[budget - 1][1]
+            cut = max(doc.rfind(mark, 0, end) + len(mark) for mark in SENTENCE_ENDS)
+            doc = doc[:cut if cut >= 0.8 * end else end]
+        pairs.append((query, doc))
+        lengths.append(overhead + min(len(offsets), budget))
+    return pairs, lengths
+
+
+def model_name_of(model):
+    '''Class and path / hub name a loaded model was created from, None if it cannot be told'''
+    config = getattr(getattr(model, "model", None), "config", None) or getattr(model, "config", None)
+    name = getattr(config, "_name_or_path", None)
+    if not name:
+        return None
+    return "%s.%s:%s" % (type(model).__module__, type(model).__qualname__, name)
+
+
+class CrossEncoderReranker:
+    '''Cross-encoder reranking shared by concurrent requests
+
+    The model is loaded once per process (load_cross_encoder), a worker thread collects the
+    pairs of all requests that arrive within max_wait seconds and scores them together, sorted
+    by length so that batches carry little padding. Scores are cached by (model, query, sha256
+    of the document) on disk and in memory, so candidates seen before are not scored again:
+        reranker = CrossEncoderReranker('BAAI/bge-reranker-large')
+        sorted_list = reranker.rerank(user_query, documents)  # [(score, doc), ...] best first
+    On CPU the model is quantized to int8; a small model such as CPU_RERANK_MODEL with
+    max_length=256 keeps 50 candidates well under 100 ms. model can be an already loaded
+    CrossEncoder (or any object with predict(pairs, batch_size=...) and tokenizer); its
+    scores are cached under the name it was loaded from (model_name_of), or only in
+    memory when that name is unknown, never under model_name.
+    '''
+    def __init__(self, model_name=DEFAULT_RERANK_MODEL, max_length=512, device=None, quantize=None,
+                 num_threads=None, batch_size=32, max_wait=0.005, max_query_tokens=64,
+                 cache=None, memory_size=100000, model=None):
+        self.model_name = model_name
+        self.max_length = max_length
+        self.device = device
+        self.quantize = quantize
+        self.num_threads = num_threads
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_query_tokens = max_query_tokens
+        self._model = model
+        if model is None:
+            identity = make_key(model_name, max_length, quantize, max_query_tokens)
+        elif model_name_of(model) is not None:
+            identity = make_key(model_name_of(model), max_length, max_query_tokens)
+        else:
+            # A model of unknown origin gets a namespace of its own and no shared disk cache
+            identity = uuid.uuid4().hex
+            cache = cache or SqliteCache(":memory:")
+        self.namespace = "rerank:" + identity
+        self.cache = cache or SqliteCache(DEFAULT_CACHE_PATH)
+        self.memory = LRUCache(memory_size)
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = load_cross_encoder(self.model_name, self.max_length, self.device, self.quantize,
+                                             self.num_threads)
+        return self._model
+
+    def _predict(self, pairs, lengths):
+        '''Scores of pairs, predicted in order of length'''
+        order = np.argsort(lengths, kind='stable')
+        scores = np.asarray(self.model.predict([pairs[i] for i in order], batch_size=self.batch_size,
+                                               show_progress_bar=False), dtype=np.float32)
+        result = np.empty(len(pairs), dtype=np.float32)
+        result[order] = scores.reshape(len(pairs), -1)[:, 0]
+        return result
+
+    def _run(self):
+        while True:
+            request = self.queue.get()
+            if request is None:
+                return
+            # Dynamic batching: wait up to max_wait for more requests, or until a few batches are full
+            requests = [request]
+            n_pairs = len(request[0])
+            deadline = time.monotonic() + self.max_wait
+            stop = False
+            while n_pairs < 4 * self.batch_size:
+                try:
+                    request = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                requests.append(request)
+                n_pairs += len(request[0])
+            try:
+                scores = self._predict([p for pairs, _, _ in requests for p in pairs],
+                                       [n for _, lengths, _ in requests for n in lengths])
+                self.batches += 1
+                start = 0
+                for pairs, _, future in requests:
+                    future.set_result(scores[start:start + len(pairs)])
+                    start += len(pairs)
+            except Exception as e:
+                for _, _, future in requests:
+                    future.set_exception(e)
+            if stop:
+                return
+
+    def _submit(self, pairs, lengths):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, daemon=True)
+                self.worker.start()
+        future = Future()
+        self.queue.put((pairs, lengths, future))
+        return future
+
+    def score(self, query, documents):
+        '''Cross-encoder score of every document for query, a float32 array in input order'''
+        query_key = sha256_text(query)
+        keys = [query_key + sha256_text(doc) for doc in documents]
+        scores = {}
+        for key in keys:
+            value = self.memory.get(key)
+            if value is not None:
+                scores[key] = value
+        missing = [key for key in dict.fromkeys(keys) if key not in scores]
+        if missing:
+            for key, value in self.cache.get_many(self.namespace, missing).items():
+                scores[key] = value
+                self.memory.put(key, value)
+        new_docs = {key: doc for key, doc in zip(keys, documents) if key not in scores}
+        if new_docs:
+            tokenizer = getattr(self.model, "tokenizer", None)
+            if getattr(tokenizer, "is_fast", False):
+                pairs, lengths = truncate_pairs(tokenizer, query, list(new_docs.values()), self.max_length,
+                                                self.max_query_tokens)
+            else:
+                pairs = [(query, doc) for doc in new_docs.values()]
+                lengths = [len(query) + len(doc) for doc in new_docs.values()]
+            new_scores = dict(zip(new_docs, self._submit(pairs, lengths).result().tolist()))
+            self.cache.put_many(self.namespace, new_scores)
+            for key, value in new_scores.items():
+                self.memory.put(key, value)
+            scores.update(new_scores)
+        self.misses += len(new_docs)
+        self.hits += len(keys) - len(new_docs)
+        return np.array([scores[key] for key in keys], dtype=np.float32)
+
+    def rerank(self, query, documents, top_n=None):
+        '''[(score, document), ...] sorted by descending score, the top_n best if given'''
+        scores = self.score(query, documents)
+        order = np.argsort(-scores, kind='stable')[:top_n]
+        return [(float(scores[i]), documents[i]) for i in order]
+
+    def close(self):
+        '''Stop the worker thread, requests already queued are scored first'''
+        with self.lock:
+            if self.worker is not None:
+                self.queue.put(None)
+                self.worker.join()
+                self.worker = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if "__main__" == __name__:
+    # Latency of reranking 50 candidates, cold (model scores) and warm (cache hits)
+    # python rerank_utils.py [model_name] [max_length]
+    import sys
+
+    model_name = sys.argv[1] if len(sys.argv) > 1 else CPU_RERANK_MODEL
+    max_length = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    rng = np.random.default_rng(0)
+    words = ["llama", "model", "training", "safety", "data", "tokens", "reward", "human", "fine-tuning", "context"]
+    docs = [" ".join(rng.choice(words, int(rng.integers(20, 150)))) for _ in range(50)]
+    reranker = CrossEncoderReranker(model_name, max_length=max_length, cache=SqliteCache(":memory:"))
+    reranker.rerank("warm up", docs[:2])
+    for label in ("cold", "warm"):
+        start = time.time()
+        reranker.rerank("how safe is llama 2", docs)
+        print("{} {}: {:.1f} ms for {} candidates".format(model_name, label, (time.time() - start) * 1000, len(docs)))
+    reranker.close()
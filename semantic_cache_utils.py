@@ -0,0 +1,161 @@
+# Function: 语义缓存（与之前问过的问题足够相似时直接返回缓存的回答，不再检索和调用 LLM）
+# Sits in front of RAG_Bot.chat of the examples, where the same questions are asked again and again in different words
+
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from ann_utils import HNSWIndex
+from similarity_utils import cosine_topk, normalize
+
+
+class SemanticCache:
+    '''Answers of past queries, found again by the cosine similarity of the query embeddings
+
+    A query whose embedding has a similarity of at least threshold with a cached query gets
+    the cached answer, if the entry is younger than ttl seconds and was stored for the
+    current version_fn() (e.g. lambda: vector_db.version, so answers are not served for an
+    older content of the collection). At most maxsize entries are kept, the least recently
+    used are evicted first. Past queries are searched with an HNSW graph (engine="hnsw") or
+    exactly (engine="exact", fine for a few thousand entries):
+        cache = SemanticCache(embedding_fn, threshold=0.95, version_fn=lambda: vector_db.version)
+        answer = cache.get_or_compute(user_query, bot.chat)
+    hits, misses and stats() report the hit rate.
+    '''
+    def __init__(self, embedding_fn, threshold=0.95, ttl=24 * 3600, maxsize=10000, version_fn=None,
+                 engine="hnsw", engine_params=None, candidates=8):
+        if engine not in ("hnsw", "exact"):
+            raise ValueError("engine must be hnsw or exact, got %r" % engine)
+        self.embedding_fn = embedding_fn
+        self.threshold = threshold
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.version_fn = version_fn
+        self.engine_name = engine
+        self.engine_params = engine_params or {}
+        self.candidates = candidates
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        '''Drop all entries, the counters are kept'''
+        with self.lock:
+            self._build(np.zeros((0, 1), dtype=np.float32), [])
+
+    def _build(self, vectors, entries):
+        '''Start over with the given rows: vectors (n, dim) and their (query, answer, version, created) entries'''
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        self.n = len(entries)
+        self.entries = list(entries)
+        self.lru = OrderedDict((row, None) for row in range(self.n))
+        self.index = HNSWIndex("cosine", **self.engine_params) if self.engine_name == "hnsw" else None
+        if self.index is not None and self.n:
+            self.index.update(self.vectors[:self.n])
+
+    def _embed(self, query):
+        '''Normalized embedding of one query'''
+        if hasattr(self.embedding_fn, "embed_array"):
+            vector = self.embedding_fn.embed_array([query])[0]
+        else:
+            vector = np.asarray(self.embedding_fn([query])[0], dtype=np.float32)
+        return normalize(vector)
+
+    def _version(self):
+        return self.version_fn() if self.version_fn is not None else None
+
+    def _evict(self, row):
+        self.entries[row] = None
+        self.lru.pop(row, None)
+        self.evictions += 1
+
+    def _lookup(self, vector, version):
+        '''Row of the most similar live entry above threshold, or None'''
+        if not self.lru:
+            return None
+        k = min(self.candidates, self.n)
+        if self.index is not None:
+            rows, distances = self.index.search(self.vectors[:self.n], vector, k)
+            rows, similarities = rows[0].tolist(), (1 - distances[0]).tolist()
+        else:
+            rows, similarities = cosine_topk(vector, self.vectors[:self.n], k, normalized=True)
+            rows, similarities = rows.tolist(), similarities.tolist()
+        now = time.time()
+        for row, similarity in zip(rows, similarities):
+            if similarity < self.threshold:
+                break
+            entry = self.entries[row]
+            if entry is None:
+                continue
+            if entry[2] != version or (self.ttl is not None and now - entry[3] > self.ttl):
+                self._evict(row)
+                continue
+            return row
+        return None
+
+    def get(self, query, vector=None):
+        '''Cached answer of the most similar past query, None on a miss'''
+        vector = self._embed(query) if vector is None else vector
+        version = self._version()
+        with self.lock:
+            row = self._lookup(vector, version)
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.lru.move_to_end(row)
+            return self.entries[row][1]
+
+    def put(self, query, answer, vector=None, version=None):
+        '''Cache the answer of query, for the given collection version (default: the current one)'''
+        vector = self._embed(query) if vector is None else vector
+        version = self._version() if version is None else version
+        with self.lock:
+            # Evicted rows stay in the graph until they are the majority, then the live rows are re-indexed
+            if self.n - len(self.lru) > max(self.n // 2, 64):
+                rows = list(self.lru)
+                self._build(self.vectors[rows], [self.entries[row] for row in rows])
+            if self.n == len(self.vectors):
+                # Grow the matrix by doubling, the graph keeps its row numbers
+                grown = np.zeros((max(2 * self.n, 64), len(vector)), dtype=np.float32)
+                grown[:self.n] = self.vectors[:self.n]
+                self.vectors = grown
+            row = self.n
+            self.vectors[row] = vector
+            self.entries.append((query, answer, version, time.time()))
+            self.n += 1
+            self.lru[row] = None
+            if self.index is not None:
+                self.index.update(self.vectors[:self.n])
+            while len(self.lru) > self.maxsize:
+                self._evict(next(iter(self.lru)))
+
+    def lookup(self, query):
+        '''(cached answer of query or None, put): put(answer) caches an answer computed afterwards
+
+        put stores the answer for the version from before computing: if the collection
+        changes meanwhile, the entry is already stale. The query is embedded once.
+        '''
+        vector = self._embed(query)
+        version = self._version()
+        return self.get(query, vector), lambda answer: self.put(query, answer, vector, version)
+
+    def get_or_compute(self, query, compute_fn):
+        '''Cached answer of query, or compute_fn(query) which is then cached'''
+        answer, put = self.lookup(query)
+        if answer is None:
+            answer = compute_fn(query)
+            put(answer)
+        return answer
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self.lru), "evictions": self.evictions}
+
+    def __len__(self):
+        return len(self.lru)
@@ -0,0 +1,125 @@
+# Function: 向量相似度批量计算工具（余弦相似度、欧式距离的 top-k 检索）
+# One normalization, one BLAS matrix product per block of documents and argpartition instead of a Python loop per document
+
+import numpy as np
+
+
+def normalize(vectors):
+    '''Scale every row (or a single vector) to unit length, zero vectors are left as they are'''
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _topk(scores, k, largest=True):
+    '''Indices and values of the k best scores of every row, sorted best first'''
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        empty = np.zeros((scores.shape[0], 0))
+        return empty.astype(np.int64), empty.astype(scores.dtype)
+    keys = -scores if largest else scores
+    if k < scores.shape[1]:
+        # argpartition is O(n), only the k candidates are sorted
+        idx = np.argpartition(keys, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(np.take_along_axis(keys, idx, axis=1), axis=1, kind='stable')
+    idx = np.take_along_axis(idx, order, axis=1)
+    return idx, np.take_along_axis(scores, idx, axis=1)
+
+
+def _blocked_topk(queries, docs, k, score_fn, largest, block_size):
+    '''Score the documents block by block, keeping the k best of every block, then merge'''
+    all_idx, all_val = [], []
+    for start in range(0, len(docs), block_size):
+        idx, val = _topk(score_fn(queries, docs[start:start + block_size]), k, largest)
+        all_idx.append(idx + start)
+        all_val.append(val)
+    if not all_idx:
+        return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+    if len(all_idx) == 1:
+        return all_idx[0], all_val[0]
+    idx, val = np.concatenate(all_idx, axis=1), np.concatenate(all_val, axis=1)
+    order, val = _topk(val, k, largest)
+    return np.take_along_axis(idx, order, axis=1), val
+
+
+def cosine_topk(queries, docs, k=10, normalized=False, block_size=262144):
+    '''Top-k documents by cosine similarity for one query (vector) or many queries (matrix)
+
+    Returns (indices, scores), sorted by descending similarity, with shape (k,) for one
+    query or (n_queries, k). Pass normalized=True when the rows already have unit length
+    (e.g. an index that stores normalized vectors) to skip normalizing docs on every call.
+    '''
+    single = np.ndim(queries) == 1
+    queries = np.atleast_2d(queries if normalized else normalize(queries)).astype(np.float32, copy=False)
+    docs = np.asarray(docs if normalized else normalize(docs), dtype=np.float32)
+    idx, val = _blocked_topk(queries, docs, k, lambda q, d: q @ d.T, True, block_size)
+    return (idx[0], val[0]) if single else (idx, val)
+
+
+def l2_topk(queries, docs, k=10, doc_sq_norms=None, block_size=262144):
+    '''Top-k documents by Euclidean distance for one query (vector) or many queries (matrix)
+
+    Returns (indices, distances), sorted by ascending distance. |q-d|^2 = |q|^2 + |d|^2 - 2q.d,
+    so the ranking needs one matrix product; doc_sq_norms (|d|^2 of every row) can be
+    precomputed once and passed in.
+    '''
+    single = np.ndim(queries) == 1
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    docs = np.asarray(docs, dtype=np.float32)
+    if doc_sq_norms is None:
+        doc_sq_norms = np.einsum('ij,ij->i', docs, docs)
+    offsets = iter(range(0, len(docs), block_size))
+
+    def score_fn(q, d):
+        start = next(offsets)
+        # |q|^2 is the same for every document of a query, it is added after ranking
+        return doc_sq_norms[start:start + len(d)] - 2 * (q @ d.T)
+
+    idx, val = _blocked_topk(queries, docs, k, score_fn, False, block_size)
+    q_sq_norms = np.einsum('ij,ij->i', queries, queries)[:, None]
+    val = np.sqrt(np.maximum(val + q_sq_norms, 0))
+    return (idx[0], val[0]) if single else (idx, val)
+
+
+if "__main__" == __name__:
+    # Micro benchmark: the per-document Python loop of Example-4-3 / 4-10 against cosine_topk
+    # python similarity_utils.py [dimensions]
+    import sys
+    import time
+    from numpy import dot
+    from numpy.linalg import norm
+
+    def cos_sim(a, b):
+        return dot(a, b)/(norm(a)*norm(b))
+
+    dim = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    rng = np.random.default_rng(0)
+    for n_docs in (1000, 100000, 1000000):
+        docs = rng.standard_normal((n_docs, dim), dtype=np.float32)
+        query = rng.standard_normal(dim, dtype=np.float32)
+        queries = rng.standard_normal((32, dim), dtype=np.float32)
+
+        # The loop is timed on at most 100k documents and scaled up linearly
+        n_loop = min(n_docs, 100000)
+        start = time.time()
+        loop_scores = [cos_sim(query, vec) for vec in docs[:n_loop]]
+        loop_top = np.argsort(loop_scores)[::-1][:10]
+        loop_time = (time.time() - start) * n_docs / n_loop
+
+        start = time.time()
+        idx, _ = cosine_topk(query, docs, k=10)
+        one_time = time.time() - start
+        start = time.time()
+        cosine_topk(queries, docs, k=10)
+        many_time = (time.time() - start) / len(queries)
+        docs_n = normalize(docs)
+        start = time.time()
+        cosine_topk(normalize(queries), docs_n, k=10, normalized=True)
+        pre_time = (time.time() - start) / len(queries)
+        if n_loop == n_docs:
+            assert list(idx) == list(loop_top)
+        print("{:>8} docs  loop: {:8.3f}s{}  cosine_topk: {:.4f}s  32 queries: {:.4f}s/query  pre-normalized: {:.4f}s/query".format(
+            n_docs, loop_time, " (scaled)" if n_loop < n_docs else "         ", one_time, many_time, pre_time))
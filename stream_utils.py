@@ -0,0 +1,54 @@
+# Function: 流式回答工具（先返回检索来源，再逐段返回 LLM 的回答，统计首字延迟）
+# Used by chat_stream of the RAG bots of Example-4-8 / 4-12: the user sees the sources and the first words
+# of the answer instead of waiting for the whole generation
+
+import time
+
+
+def iter_completion(response):
+    '''Text pieces of a streamed chat completion (client.chat.completions.create(..., stream=True))'''
+    for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def stream_answer(sources, pieces, start=None, on_done=None, cached=False):
+    '''Events of a streamed RAG answer, as dicts with a "type"
+
+        {"type": "sources", "sources": [...], "cached": ..., "seconds": retrieval time}
+        {"type": "token", "text": ...}  one per piece of the answer, as it arrives
+        {"type": "done", "time_to_first_token": ..., "seconds": ..., "pieces": ...}
+
+    Times are in seconds from start (time.monotonic(), by default the first event), so
+    time_to_first_token includes retrieval. on_done(answer) is called with the whole
+    answer once the stream is exhausted, e.g. to cache it.
+    '''
+    start = time.monotonic() if start is None else start
+    yield {"type": "sources", "sources": sources, "cached": cached, "seconds": time.monotonic() - start}
+    first = None
+    answer = []
+    for text in pieces:
+        if first is None:
+            first = time.monotonic() - start
+        answer.append(text)
+        yield {"type": "token", "text": text}
+    if on_done is not None:
+        on_done(''.join(answer))
+    yield {"type": "done", "time_to_first_token": first, "seconds": time.monotonic() - start, "pieces": len(answer)}
+
+
+def print_stream(events):
+    '''Print the events of chat_stream as they arrive, returns the whole answer'''
+    answer = []
+    for event in events:
+        if event["type"] == "sources":
+            for source in event["sources"]:
+                print(source)
+            print("====回复====" + ("（缓存）" if event["cached"] else ""))
+        elif event["type"] == "token":
+            print(event["text"], end="", flush=True)
+            answer.append(event["text"])
+        else:
+            print("\n\ntime to first token: {:.3f}s, total: {:.3f}s".format(
+                event["time_to_first_token"] or 0.0, event["seconds"]))
+    return ''.join(answer)
@@ -0,0 +1,136 @@
+# Function: 文本切块工具（带重叠，可按字符数或 token 数计长度）
+# Shared by Example-4-8 and Example-4-12 instead of each script copying split_text
+
+# !pip install tiktoken  # Only needed when measuring chunk size in tokens
+
+from functools import lru_cache
+from itertools import islice
+
+from chinese_and_english_utils import sent_tokenize_batch
+
+
+@lru_cache(maxsize=None)
+def tiktoken_length(model="text-embedding-3-small", cache_size=65536):
+    '''Return a function that counts the tokens of a text with the tokenizer of an OpenAI model
+
+    The encoding is loaded once per model, and the counts of the last cache_size texts
+    are kept, so sentences repeated by overlapping chunks are encoded once.
+    '''
+    import tiktoken
+    encoding = tiktoken.encoding_for_model(model)
+
+    @lru_cache(maxsize=cache_size)
+    def length(text):
+        return len(encoding.encode(text, disallowed_special=()))
+    return length
+
+
+def _split_long_sentence(sentence, max_len, length_fn):
+    '''Cut a sentence that is longer than max_len into pieces that fit (binary search on the cut position)'''
+    pieces = []
+    while length_fn(sentence) > max_len:
+        lo, hi = 1, len(sentence)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if length_fn(sentence[:mid]) <= max_len:
+                lo = mid
+            else:
+                hi = mid - 1
+        pieces.append(sentence[:lo])
+        sentence = sentence[lo:]
+    if sentence:
+        pieces.append(sentence)
+    return pieces
+
+
+def iter_sentences(paragraphs, tokenize_batch=sent_tokenize_batch, batch_size=256):
+    '''Split a stream of paragraphs into a stream of stripped, non-empty sentences
+
+    tokenize_batch takes a list of paragraphs and returns a list of sentences per paragraph,
+    for NLTK use e.g. lambda ps: [nltk.sent_tokenize(p) for p in ps]
+    '''
+    paragraphs = iter(paragraphs)
+    while True:
+        batch = list(islice(paragraphs, batch_size))
+        if not batch:
+            return
+        for sentences in tokenize_batch(batch):
+            for s in sentences:
+                s = s.strip()
+                if s:
+                    yield s
+
+
+def iter_chunks(paragraphs, chunk_size=300, overlap_size=100, length_fn=len, sep_len=None,
+                strict=False, tokenize_batch=sent_tokenize_batch):
+    '''Split the text by the specified chunk_size and overlap_size, yielding chunks as a generator
+
+    Each chunk starts with up to overlap_size of the preceding sentences, then takes
+    following sentences while the chunk stays within chunk_size. Sizes are measured
+    with length_fn (len for characters, or e.g. tiktoken_length() for tokens).
+    sep_len is the size of the ' ' joining two sentences: 1 for characters, 0 for tokens.
+    With strict=True no chunk exceeds chunk_size: long sentences are cut and the overlap
+    is shortened when needed.
+
+    Sentences are split with the Chinese/English sentence splitter of chinese_and_english_utils.
+    Sentence sizes are computed once and kept as prefix sums, so the overlap and the
+    chunk end are found by moving two pointers forward: the whole pass is O(n).
+    '''
+    if sep_len is None:
+        sep_len = 1 if length_fn is len else 0
+    sentences = iter_sentences(paragraphs, tokenize_batch)
+    if strict:
+        sentences = (piece for s in sentences for piece in _split_long_sentence(s, chunk_size, length_fn))
+
+    sents = []    # Loaded sentences, sents[k - base] is sentence k
+    prefix = [0]  # prefix[k - base] is the total size of sentences before k, each followed by a separator
+    base = 0
+
+    def load(k):
+        '''Make sure sentence k is loaded, return False at the end of the text'''
+        while k - base >= len(sents):
+            s = next(sentences, None)
+            if s is None:
+                return False
+            sents.append(s)
+            prefix.append(prefix[-1] + length_fn(s) + sep_len)
+        return True
+
+    def size(a, b):
+        '''Size of sentences a..b-1 joined with separators'''
+        return prefix[b - base] - prefix[a - base] - sep_len
+
+    i = 0      # First new sentence of the current chunk
+    start = 0  # First sentence of the overlap
+    while load(i):
+        # Calculate the overlap forward: sentences before i whose joined size fits overlap_size
+        start = max(start, base)
+        while start < i and size(start, i) > overlap_size:
+            start += 1
+        if strict:
+            while start < i and size(start, i + 1) > chunk_size:
+                start += 1
+        # Calculate the current chunk backward: add sentences while the chunk fits chunk_size
+        end = i + 1
+        while load(end) and size(start, end + 1) <= chunk_size:
+            end += 1
+        yield ' '.join(sents[start - base:end - base])
+        i = end
+        # Drop sentences that can no longer be part of an overlap
+        if start - base > 1024:
+            del sents[:start - base]
+            del prefix[:start - base]
+            base = start
+
+
+def split_text(paragraphs, chunk_size=300, overlap_size=100, length_fn=len, sep_len=None, strict=False):
+    '''Split the text by the specified chunk_size and overlap_size'''
+    return list(iter_chunks(paragraphs, chunk_size, overlap_size, length_fn, sep_len, strict))
+
+
+if "__main__" == __name__:
+    text = ["Llama 2 is a collection of pretrained and fine-tuned large language models. "
+            "The models range in scale from 7 billion to 70 billion parameters. "
+            "Our fine-tuned LLMs, called Llama 2-Chat, are optimized for dialogue use cases."]
+    for chunk in split_text(text, chunk_size=120, overlap_size=60):
+        print(chunk + "\n")
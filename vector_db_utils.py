@@ -0,0 +1,453 @@
+# Function: 本地向量索引（内存映射文件存储，无需启动向量数据库服务）
+# Drop-in replacement for the chroma based MyVectorDBConnector of the examples, the index survives restarts
+
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from ann_utils import ENGINES
+from cache_utils import CACHE_DIR, make_key
+from similarity_utils import cosine_topk, l2_topk, normalize
+
+DEFAULT_DB_PATH = os.path.join(CACHE_DIR, "vector_db")
+
+
+class LocalVectorDBConnector:
+    '''Vector collection stored in a directory, with the add_documents / search interface of MyVectorDBConnector
+
+    <path>/<collection_name>/ holds
+        vectors.f32    float32 (count, dim) matrix, memory mapped, so opening is instant
+        records.jsonl  one JSON line per vector: id, document, metadata, content hash
+        offsets.i64    byte offset of every line of records.jsonl, so only the hits are read
+        deleted.u8     1 for rows that were deleted or replaced by a newer version
+        collection.json  dim, count, space and version, rewritten after every change
+        engine.npz     graph / inverted lists of the ANN engine, if any, written by close()
+    space is "cosine" (vectors are stored normalized) or "l2". By default search is exact:
+    the query is compared with all vectors by blocked matrix products (see similarity_utils).
+    engine="hnsw" or "ivfpq" searches an approximate index instead (see ann_utils, hnsw
+    uses hnswlib when it is installed), with engine_params such as {"M": 16,
+    "ef_construction": 100, "ef_search": 64} or {"nlist": 1024, "nprobe": 16, "m": 16}.
+    Engine and parameters are stored with the collection; passing new parameters when
+    opening it changes them (e.g. ef_search, nprobe). The index is updated by every add
+    and written by close() (or with the connector as a context manager); rows added
+    after the last save are indexed again when the collection is opened.
+    search returns the same dict as chroma's collection.query: ids, documents, metadatas,
+    distances, each a list with one list per query.
+
+    Ids default to a hash of the document and its metadata. Writing an id that exists
+    with the same content is a no-op, so re-adding a corpus only embeds the new or
+    changed chunks. Rows are never rewritten in place: a changed or deleted id only marks
+    its old row deleted, and compact() drops those rows from the files.
+
+    search(query, top_n, where={"source": "llama2.pdf"}) only considers documents whose
+    metadata matches where, see _where_mask for the operators. The rows of every metadata
+    value are indexed on the first filtered search, so a filter selects its rows without
+    scanning the collection, and exact search then only compares the query with those
+    rows. ANN engines search the whole index with a larger top_n when the selection is
+    larger than filter_exact_limit rows, and search the selected rows exactly otherwise.
+    '''
+    def __init__(self, collection_name, embedding_fn, path=DEFAULT_DB_PATH, space=None, block_size=262144,
+                 engine=None, engine_params=None, filter_exact_limit=200000):
+        self.dir = os.path.join(path, collection_name)
+        os.makedirs(self.dir, exist_ok=True)
+        self.embedding_fn = embedding_fn
+        self.block_size = block_size
+        self.filter_exact_limit = filter_exact_limit
+        self.lock = threading.RLock()
+        info = self._read_info()
+        if space and info.get("space", space) != space:
+            raise ValueError("collection %r was created with space %r" % (collection_name, info["space"]))
+        self.space = info.get("space", space or "cosine")
+        if self.space not in ("cosine", "l2"):
+            raise ValueError("space must be cosine or l2, got %r" % self.space)
+        self.engine_name = engine or info.get("engine", "exact")
+        if self.engine_name != "exact" and self.engine_name not in ENGINES:
+            raise ValueError("engine must be exact or one of %s, got %r" % (', '.join(ENGINES), self.engine_name))
+        self.engine_params = dict(info.get("engine_params", {}), **(engine_params or {}))
+        self.dim = info.get("dim")
+        self.count = info.get("count", 0)
+        # Incremented by every add, delete and compact, e.g. to invalidate answers cached for older content
+        self.version = info.get("version", 0)
+        self._open()
+        if self.engine_name != info.get("engine", "exact") and os.path.exists(self._file("engine.npz")):
+            os.remove(self._file("engine.npz"))
+        self._load_engine()
+        if info and (self.engine_name, self.engine_params) != (info.get("engine", "exact"), info.get("engine_params", {})):
+            self._write_info()
+
+    def _file(self, name):
+        return os.path.join(self.dir, name)
+
+    def _read_info(self):
+        if not os.path.exists(self._file("collection.json")):
+            return {}
+        with open(self._file("collection.json"), encoding='utf-8') as fp:
+            return json.load(fp)
+
+    def _write_info(self):
+        # Written last and replaced atomically: rows beyond count (an interrupted add) are ignored
+        tmp = self._file("collection.json.tmp")
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump({"dim": self.dim, "count": self.count, "space": self.space, "version": self.version,
+                       "engine": self.engine_name, "engine_params": self.engine_params}, fp)
+        os.replace(tmp, self._file("collection.json"))
+
+    def _open(self):
+        '''Map the files of the committed rows'''
+        if self.count:
+            self.vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode='r', shape=(self.count, self.dim))
+            self.offsets = np.memmap(self._file("offsets.i64"), dtype=np.int64, mode='r', shape=(self.count + 1,))
+            deleted = np.fromfile(self._file("deleted.u8"), dtype=np.uint8, count=self.count)
+            self.deleted = np.zeros(self.count, dtype=bool)
+            self.deleted[:len(deleted)] = deleted.astype(bool)
+        else:
+            self.vectors = np.zeros((0, self.dim or 0), dtype=np.float32)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self.deleted = np.zeros(0, dtype=bool)
+        self.n_deleted = int(self.deleted.sum())
+        self._sq_norms = None
+        self._ids = None
+        self._postings = None
+
+    def _load_engine(self):
+        '''Open the ANN index of the collection, indexing the rows it does not cover yet'''
+        self.engine = None
+        self._engine_saved = True
+        if self.engine_name == "exact":
+            return
+        engine_cls = ENGINES[self.engine_name]
+        if os.path.exists(self._file("engine.npz")):
+            self.engine = engine_cls.load(self._file("engine.npz"), self.space, **self.engine_params)
+        if self.engine is None or self.engine.count > self.count:
+            # No index yet, or one covering rows of an interrupted add: build it again
+            self.engine = engine_cls(self.space, **self.engine_params)
+        if self.engine.count < self.count:
+            self.engine.update(self.vectors)
+            self.engine.save(self._file("engine.npz"))
+
+    def save_engine(self):
+        '''Write the ANN index if rows were added since it was last saved
+
+        Called by close(). Rows added after the last save are indexed again when the
+        collection is opened, so an unsaved index only costs time, never results.
+        '''
+        with self.lock:
+            if self.engine is not None and not self._engine_saved:
+                self.engine.save(self._file("engine.npz"))
+                self._engine_saved = True
+
+    def close(self):
+        self.save_engine()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _embed(self, texts):
+        '''Vectors of texts as a float32 matrix (CachedEmbeddings can return one directly)'''
+        if hasattr(self.embedding_fn, "embed_array"):
+            return self.embedding_fn.embed_array(texts)
+        return np.asarray(self.embedding_fn(texts), dtype=np.float32)
+
+    @staticmethod
+    def _append(filename, size, data):
+        '''Write data after the first size bytes of a file, dropping anything an interrupted write left behind'''
+        with open(filename, 'ab') as fp:
+            fp.truncate(size)
+            fp.write(data)
+
+    def _append_rows(self, vectors, records):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError("expected vectors of dimension %d, got %d" % (self.dim, vectors.shape[1]))
+        if self.space == "cosine":
+            vectors = normalize(vectors)
+        lines = [(json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8') for record in records]
+        end = int(self.offsets[-1])
+        offsets = end + np.cumsum([len(line) for line in lines], dtype=np.int64)
+        self._append(self._file("vectors.f32"), self.count * self.dim * 4, vectors.tobytes())
+        self._append(self._file("records.jsonl"), end, b''.join(lines))
+        if not self.count:
+            self._append(self._file("offsets.i64"), 0, np.zeros(1, dtype=np.int64).tobytes())
+        self._append(self._file("offsets.i64"), (self.count + 1) * 8, offsets.tobytes())
+        self._append(self._file("deleted.u8"), self.count, bytes(len(records)))
+        ids, postings = self._ids, self._postings
+        start = self.count
+        self.count += len(records)
+        self._open()
+        self._ids = ids
+        if postings is not None:
+            self._add_postings(postings, start, [record["metadata"] for record in records])
+            self._postings = postings
+        if self.engine is not None:
+            # The graph / lists are saved by save_engine(), not after every add
+            self.engine.update(self.vectors)
+            self._engine_saved = False
+        self.version += 1
+        self._write_info()
+
+    def _mark_deleted(self, rows):
+        if not rows:
+            return
+        with open(self._file("deleted.u8"), 'r+b') as fp:
+            for row in rows:
+                fp.seek(row)
+                fp.write(b'\x01')
+        self.deleted[rows] = True
+        self.n_deleted = int(self.deleted.sum())
+        self.version += 1
+        self._write_info()
+
+    @staticmethod
+    def _add_postings(postings, start, metadatas):
+        '''Add the rows start, start + 1, ... with the given metadata to the field -> value -> rows index'''
+        new = {}
+        for row, metadata in enumerate(metadatas, start):
+            for field, value in (metadata or {}).items():
+                # Only scalar values can be filtered on
+                if value is None or isinstance(value, (str, int, float, bool)):
+                    new.setdefault(field, {}).setdefault(value, []).append(row)
+        for field, values in new.items():
+            field_postings = postings.setdefault(field, {})
+            for value, rows in values.items():
+                rows = np.array(rows, dtype=np.int64)
+                old = field_postings.get(value)
+                field_postings[value] = rows if old is None else np.concatenate([old, rows])
+
+    def _scan_records(self):
+        '''Read the whole sidecar once to build the id index and the metadata postings'''
+        ids = {}
+        duplicates = []
+        metadatas = []
+        lines = []
+        if self.count:
+            with open(self._file("records.jsonl"), 'rb') as fp:
+                lines = fp.read(int(self.offsets[-1])).splitlines()
+        for row, line in enumerate(lines):
+            record = json.loads(line)
+            metadatas.append(record["metadata"])
+            if self.deleted[row]:
+                continue
+            if record["id"] in ids:
+                # An upsert interrupted before the old row was marked deleted
+                duplicates.append(ids[record["id"]][0])
+            ids[record["id"]] = (row, record.get("hash"), record["metadata"])
+        self._mark_deleted(duplicates)
+        self._ids = ids
+        self._postings = {}
+        self._add_postings(self._postings, 0, metadatas)
+
+    def _id_index(self):
+        '''id -> (row, content hash, metadata) of the live rows, read from the sidecar on first use'''
+        if self._ids is None:
+            self._scan_records()
+        return self._ids
+
+    def _where_mask(self, where):
+        '''Boolean mask of the rows whose metadata matches where (deleted rows included)
+
+        where maps fields to a value or to {"$eq": v}, {"$ne": v}, {"$in": [...]}, {"$nin": [...]};
+        several fields must all match. {"$and": [where, ...]} and {"$or": [where, ...]} combine filters.
+        '''
+        if self._postings is None:
+            self._scan_records()
+        mask = np.ones(self.count, dtype=bool)
+        for field, condition in where.items():
+            if field in ("$and", "$or"):
+                masks = [self._where_mask(sub) for sub in condition]
+                if not masks:
+                    mask &= field == "$and"
+                else:
+                    mask &= np.logical_and.reduce(masks) if field == "$and" else np.logical_or.reduce(masks)
+                continue
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            postings = self._postings.get(field, {})
+            for op, value in condition.items():
+                values = [value] if op in ("$eq", "$ne") else value
+                if op not in ("$eq", "$ne", "$in", "$nin"):
+                    raise ValueError("unsupported operator %r in where" % op)
+                selected = np.zeros(self.count, dtype=bool)
+                for v in values:
+                    if v in postings:
+                        selected[postings[v]] = True
+                mask &= selected if op in ("$eq", "$in") else ~selected
+        return mask
+
+    def upsert(self, documents, metadatas=None, ids=None):
+        '''Insert or replace documents by id, only new or changed documents are embedded
+
+        ids default to a hash of document and metadata. Returns the ids that were written.
+        '''
+        metadatas = metadatas or [None] * len(documents)
+        hashes = [make_key(doc, meta) for doc, meta in zip(documents, metadatas)]
+        ids = ids or hashes
+        if not len(ids) == len(documents) == len(metadatas):
+            raise ValueError("documents, metadatas and ids must have the same length")
+        # The last occurrence of an id in the batch wins
+        batch = {id_: i for i, id_ in enumerate(ids)}
+        with self.lock:
+            index = self._id_index()
+            changed = [i for id_, i in batch.items() if id_ not in index or index[id_][1] != hashes[i]]
+            if not changed:
+                return []
+            vectors = self._embed([documents[i] for i in changed])
+            old_rows = [index[ids[i]][0] for i in changed if ids[i] in index]
+            records = [{"id": ids[i], "document": documents[i], "metadata": metadatas[i], "hash": hashes[i]}
+                       for i in changed]
+            start = self.count
+            self._append_rows(vectors, records)
+            self._mark_deleted(old_rows)
+            for row, i in enumerate(changed, start):
+                index[ids[i]] = (row, hashes[i], metadatas[i])
+        return [ids[i] for i in changed]
+
+    def add_documents(self, documents, metadatainputs=None, ids=None):
+        '''Add documents and vectors to the collection, documents already stored are skipped'''
+        if not documents:
+            return []
+        return self.upsert(documents, [{"source": metadatainputs} for _ in documents], ids)
+
+    def delete(self, ids):
+        '''Delete documents by id, returns the number of deleted documents'''
+        with self.lock:
+            index = self._id_index()
+            rows = [index.pop(id_)[0] for id_ in ids if id_ in index]
+            self._mark_deleted(rows)
+        return len(rows)
+
+    def sync(self, documents, metadatainputs=None, ids=None):
+        '''Make the documents of one source (metadatainputs) exactly documents
+
+        New and changed documents are embedded and added, documents of the source that
+        are no longer in documents are deleted: a refresh of a changed file only costs its delta.
+        Returns (written ids, number of deleted documents).
+        '''
+        with self.lock:
+            written = self.add_documents(documents, metadatainputs, ids)
+            keep = set(ids or [make_key(doc, {"source": metadatainputs}) for doc in documents])
+            stale = [id_ for id_, (_, _, meta) in self._id_index().items()
+                     if id_ not in keep and (meta or {}).get("source") == metadatainputs]
+            return written, self.delete(stale)
+
+    def compact(self):
+        '''Rewrite the collection without deleted rows and rebuild the ANN index'''
+        with self.lock:
+            if not self.n_deleted:
+                return
+            tmp_dir = self.dir + ".compact"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            # The copy is exact, the ANN index is built once on the compacted rows by _load_engine
+            new = LocalVectorDBConnector(os.path.basename(tmp_dir), self.embedding_fn, os.path.dirname(self.dir),
+                                         self.space, self.block_size, "exact")
+            live = np.flatnonzero(~self.deleted)
+            for start in range(0, len(live), 65536):
+                rows = live[start:start + 65536]
+                new._append_rows(self.vectors[rows], self._records(rows))
+            old_dir = self.dir + ".old"
+            os.replace(self.dir, old_dir)
+            os.replace(tmp_dir, self.dir)
+            shutil.rmtree(old_dir)
+            self.count = new.count
+            self.dim = new.dim
+            self.version += 1
+            self._write_info()
+            self._open()
+            self._load_engine()
+
+    def _records(self, rows):
+        '''Read the sidecar records of the given rows'''
+        records = []
+        if not len(rows):
+            return records
+        with open(self._file("records.jsonl"), 'rb') as fp:
+            for row in rows:
+                fp.seek(int(self.offsets[row]))
+                records.append(json.loads(fp.read(int(self.offsets[row + 1] - self.offsets[row]))))
+        return records
+
+    def _exact_search(self, query_vectors, top_n, rows=None):
+        '''Brute force search of all vectors, or only of the given rows'''
+        vectors = self.vectors if rows is None else self.vectors[rows]
+        if self.space == "cosine":
+            # The stored vectors are normalized already, only the queries are
+            found, scores = cosine_topk(normalize(query_vectors), vectors, top_n, normalized=True,
+                                        block_size=self.block_size)
+            distances = 1 - scores
+        else:
+            if self._sq_norms is None:
+                self._sq_norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+            sq_norms = self._sq_norms if rows is None else self._sq_norms[rows]
+            found, distances = l2_topk(query_vectors, vectors, top_n, doc_sq_norms=sq_norms,
+                                       block_size=self.block_size)
+            # chroma reports squared euclidean distances
+            distances = distances ** 2
+        return (found if rows is None else rows[found]), distances
+
+    def _search_vectors(self, query_vectors, top_n):
+        '''Row indices and chroma style distances of the top_n vectors for every query'''
+        if self.engine is not None:
+            if self.space == "cosine":
+                query_vectors = normalize(query_vectors)
+            return self.engine.search(self.vectors, query_vectors, top_n)
+        return self._exact_search(query_vectors, top_n)
+
+    def _search_live(self, query_vectors, top_n, where=None):
+        '''_search_vectors without deleted rows and rows not matching where'''
+        if where:
+            mask = self._where_mask(where) & ~self.deleted
+            selected = np.flatnonzero(mask)
+            if self.engine is None or len(selected) <= self.filter_exact_limit:
+                # The filter is applied first, only the selected rows are compared with the queries
+                return self._exact_search(query_vectors, top_n, selected)
+            # Ask the engine for enough rows to expect top_n matching ones
+            n = min(self.count, top_n * self.count // len(selected) + top_n)
+        elif self.n_deleted:
+            mask = ~self.deleted
+            # Ask for top_n plus the number of deleted rows, then drop them
+            n = min(self.count, top_n + self.n_deleted)
+        else:
+            return self._search_vectors(query_vectors, top_n)
+        rows, distances = self._search_vectors(query_vectors, n)
+        keep = [mask[r] for r in rows]
+        return ([r[k][:top_n] for r, k in zip(rows, keep)],
+                [d[k][:top_n] for d, k in zip(distances, keep)])
+
+    def _results(self, rows, distances):
+        # Rows found by several queries are read once
+        unique = sorted(set(int(row) for query_rows in rows for row in query_rows))
+        by_row = dict(zip(unique, self._records(unique)))
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for query_rows, query_distances in zip(rows, distances):
+            records = [by_row[int(row)] for row in query_rows]
+            results["ids"].append([record["id"] for record in records])
+            results["documents"].append([record["document"] for record in records])
+            results["metadatas"].append([record["metadata"] for record in records])
+            results["distances"].append([float(d) for d in query_distances])
+        return results
+
+    def search(self, query, top_n, where=None):
+        '''Search the vector database, optionally only documents whose metadata matches where'''
+        return self.search_many([query], top_n, where)
+
+    def search_many(self, queries, top_n, where=None):
+        '''Search several queries at once: one embedding request and one batched similarity pass
+
+        The result has one list per query, in the order of queries, as chroma's query does.
+        '''
+        if not queries:
+            return {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        query_vectors = self._embed(list(queries))
+        with self.lock:
+            rows, distances = self._search_live(query_vectors, top_n, where)
+            return self._results(rows, distances)
+
+    def __len__(self):
+        return self.count - self.n_deleted